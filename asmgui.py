@@ -25,10 +25,11 @@ from PySide2.QtWidgets import QMenu, QFileDialog, QAbstractItemView
 from PySide2.QtWidgets import QSplitter, QTreeView, QLineEdit
 from PySide2.QtWidgets import QGridLayout, QApplication, QPushButton
 from PySide2.QtWidgets import QMessageBox, QAction, QDialog, QHeaderView
-from PySide2.QtGui import QStandardItemModel, QStandardItem, QColor, QBrush
-from PySide2.QtCore import Qt, QItemSelectionModel
+from PySide2.QtGui import QColor, QBrush, QFont
+from PySide2.QtCore import Qt, QItemSelectionModel, QAbstractItemModel
+from PySide2.QtCore import QModelIndex, QObject, Signal
 from PySide2.QtWidgets import QComboBox, QCheckBox
-import os, zipfile, time
+import os, zipfile, time, threading, traceback, concurrent.futures
 
 import pprint, shutil
 
@@ -187,10 +188,10 @@ class ExportDialog(QDialog):
         urls = []
         fnl = []
         d = db.get_db_instance()
-        for k in self._data:
-            rid = self._data[k]["rid"]
-            drawings_and_urls = d.get_drawings_and_urls_by_rid(rid)
-            fnl += [utils.find_filename(x[1]) for x in drawings_and_urls]
+        rids = [self._data[k]["rid"] for k in self._data]
+        drawings = d.get_drawings_by_rids(rids)
+        for rid in rids:
+            fnl += [utils.find_filename(x[1]) for x in drawings[rid]]
 
         fnl2 = []
         progress.setMaximum(len(fnl) + 1)
@@ -336,7 +337,244 @@ class ExportDialog(QDialog):
         with utils.OverrideCursor(Qt.ArrowCursor):
             QMessageBox.information(self, "BOMBrowser", "Export ended")
 
-    
+
+def _actions_to_style(actions):
+    style = dict()
+    for action in actions:
+        if action.startswith("bg="):
+            style[Qt.BackgroundRole] = QBrush(QColor(action[3:]))
+        elif action.startswith("fg="):
+            style[Qt.ForegroundRole] = QBrush(QColor(action[3:]))
+        elif action.startswith("italic"):
+            f = style.setdefault(Qt.FontRole, QFont())
+            f.setItalic(True)
+        elif action.startswith("bold"):
+            f = style.setdefault(Qt.FontRole, QFont())
+            f.setBold(True)
+        else:
+            print("WARNING: unknown action '%s'"%(action))
+    return style
+
+class _BomTreeNode:
+    __slots__ = ("key", "parent", "row", "children", "style")
+
+    def __init__(self, key, parent, row):
+        self.key = key
+        self.parent = parent
+        self.row = row
+        self.children = None
+        self.style = None
+
+class BomTreeModel(QAbstractItemModel):
+    """Tree model over a bom. The rows of a node are created only when the
+    node is expanded (see fetchMore()); before the children count is
+    taken from the bom data. The list of children of a code is computed
+    only once and shared between all the occurrences of the code.
+    The colors are computed by 'colors' (a utils.BomColors) when a row is
+    shown."""
+
+    def __init__(self, top, data, headers, colors=None):
+        QAbstractItemModel.__init__(self)
+        self._data = data
+        self._headers = headers
+        self._colors = colors
+        self._styles = dict()
+        self._deps_keys = dict()
+        self._top = _BomTreeNode(top, None, 0)
+
+    def _node(self, idx):
+        if not idx.isValid():
+            return None
+        return idx.internalPointer()
+
+    def _get_deps_keys(self, key):
+        if not key in self._deps_keys:
+            self._deps_keys[key] = list(self._data[key]["deps"])
+        return self._deps_keys[key]
+
+    def _get_node_path(self, node):
+        path = []
+        while not node is None:
+            path.append(node.key)
+            node = node.parent
+        path.reverse()
+        return path
+
+    def _get_node_style(self, node):
+        # the state of the parent is needed to evaluate a node
+        todo = []
+        while not node is None and node.style is None:
+            todo.append(node)
+            node = node.parent
+
+        state = 0
+        if not node is None:
+            state = node.style[0]
+
+        for node in reversed(todo):
+            d = self._data[node.key]
+            if node.parent is None:
+                state, actions = self._colors.match(state, node.key, d)
+            else:
+                pkey = node.parent.key
+                state, actions = self._colors.match(state, node.key, d,
+                                    pkey, self._data[pkey]["deps"][node.key])
+            if not actions in self._styles:
+                self._styles[actions] = _actions_to_style(actions)
+            node.style = (state, self._styles[actions])
+
+        return node.style[1]
+
+    def get_path(self, idx):
+        node = self._node(idx)
+        if node is None:
+            return []
+        return self._get_node_path(node)
+
+    def index(self, row, column, parent=QModelIndex()):
+        if not self.hasIndex(row, column, parent):
+            return QModelIndex()
+        node = self._node(parent)
+        if node is None:
+            return self.createIndex(row, column, self._top)
+        return self.createIndex(row, column, node.children[row])
+
+    def parent(self, idx):
+        node = self._node(idx)
+        if node is None or node.parent is None:
+            return QModelIndex()
+        return self.createIndex(node.parent.row, 0, node.parent)
+
+    def rowCount(self, parent=QModelIndex()):
+        if parent.column() > 0:
+            return 0
+        node = self._node(parent)
+        if node is None:
+            return 1
+        if node.children is None:
+            return 0
+        return len(node.children)
+
+    def columnCount(self, parent=QModelIndex()):
+        return len(self._headers)
+
+    def hasChildren(self, parent=QModelIndex()):
+        if parent.column() > 0:
+            return False
+        node = self._node(parent)
+        if node is None:
+            return True
+        if node.children is None:
+            return len(self._data[node.key]["deps"]) > 0
+        return len(node.children) > 0
+
+    def canFetchMore(self, parent):
+        node = self._node(parent)
+        if node is None:
+            return False
+        return node.children is None
+
+    def fetchMore(self, parent):
+        node = self._node(parent)
+        if node is None or not node.children is None:
+            return
+
+        # skip the children which are also an ancestor: it is a loop
+        path = set(self._get_node_path(node))
+        keys = [k for k in self._get_deps_keys(node.key) if not k in path]
+        if len(keys) == 0:
+            node.children = []
+            return
+
+        self.beginInsertRows(parent, 0, len(keys) - 1)
+        node.children = [_BomTreeNode(k, node, i)
+                            for (i, k) in enumerate(keys)]
+        self.endInsertRows()
+
+    def fetch_up_to(self, lev, parent=QModelIndex()):
+        if lev == 0:
+            return
+        if not parent.isValid():
+            parent = self.index(0, 0)
+        self.fetchMore(parent)
+        for i in range(self.rowCount(parent)):
+            self.fetch_up_to(lev - 1, self.index(i, 0, parent))
+
+    def flags(self, idx):
+        return Qt.ItemIsSelectable | Qt.ItemIsEnabled
+
+    def headerData(self, section, orientation, role=Qt.DisplayRole):
+        if orientation == Qt.Horizontal and role == Qt.DisplayRole:
+            return self._headers[section]
+        return None
+
+    def data(self, idx, role=Qt.DisplayRole):
+        node = self._node(idx)
+        if node is None:
+            return None
+
+        if role == Qt.DisplayRole:
+            d = self._data[node.key]
+            if idx.column() == 0:
+                return d["code"]
+            elif idx.column() == 1:
+                return d["descr"]
+            elif len(d["deps"]) > 0:
+                return str(len(d["deps"]))
+            return ""
+
+        if self._colors is None:
+            return None
+        return self._get_node_style(node).get(role)
+
+# the boms are loaded in background by these threads, so the windows
+# don't freeze and several windows can load their bom at the same time
+bom_loader_threads = 4
+_bom_loader_pool = concurrent.futures.ThreadPoolExecutor(
+                            max_workers=bom_loader_threads)
+
+class _BomLoadCancelled(Exception):
+    pass
+
+class BomLoader(QObject):
+    """Call reload_fn(progress) in a worker thread; reload_fn returns
+    (top, data, date) and calls progress(nodes, depth) during the loading.
+    The signals are delivered in the gui thread; after cancel() nothing is
+    emitted anymore."""
+
+    progress = Signal(object, int, int)
+    finished = Signal(object, object)
+    failed = Signal(object, str)
+
+    def __init__(self, reload_fn):
+        QObject.__init__(self)
+        self._reload_fn = reload_fn
+        self._cancelled = threading.Event()
+
+    def start(self):
+        _bom_loader_pool.submit(self._run)
+
+    def cancel(self):
+        self._cancelled.set()
+
+    def _progress(self, nodes, depth):
+        if self._cancelled.is_set():
+            raise _BomLoadCancelled()
+        self.progress.emit(self, nodes, depth)
+
+    def _run(self):
+        try:
+            ret = self._reload_fn(self._progress)
+        except _BomLoadCancelled:
+            return
+        except Exception:
+            if not self._cancelled.is_set():
+                self.failed.emit(self, traceback.format_exc())
+            return
+
+        if not self._cancelled.is_set():
+            self.finished.emit(self, ret)
+
 class FindDialog(QDialog):
     def __init__(self, parent, tree):
         QDialog.__init__(self, parent)
@@ -367,56 +605,51 @@ class FindDialog(QDialog):
         self.setLayout(grid)
         self.setWindowTitle("Search")
 
+    def _row_count(self, idx):
+        # the children are loaded only when needed
+        model = self._tree.model()
+        if model.canFetchMore(idx):
+            model.fetchMore(idx)
+        return model.rowCount(idx)
+
     def _move_next(self, selection, idx):
-        item = self._tree.model().itemFromIndex(idx)
+        model = self._tree.model()
 
         # check if exists a child
-        if item.hasChildren():
-            idx = self._tree.model().index(0, 0, idx)
-            return idx
-
-        # check if exist a next sibling
-        parent_item = self._tree.model().itemFromIndex(idx.parent())
-        if parent_item.rowCount() > item.row() + 1:
-            idx = self._tree.model().index(item.row() + 1, 0, idx.parent())
+        if self._row_count(idx) > 0:
+            idx = model.index(0, 0, idx)
             return idx
 
-        # ok, we should go up
-        while self._tree.model().itemFromIndex(idx.parent()):
-            parent_item = self._tree.model().itemFromIndex(idx.parent())
-            if idx.row() +1 < parent_item.rowCount():
-                idx = self._tree.model().index(idx.row() + 1, 0, idx.parent())
+        # check if exist a next sibling, otherwise go up
+        while idx.isValid():
+            if idx.row() + 1 < model.rowCount(idx.parent()):
+                idx = model.index(idx.row() + 1, 0, idx.parent())
                 return idx
             idx = idx.parent()
         return None
 
     def _move_prev(self, selection, idx):
-        item = self._tree.model().itemFromIndex(idx)
+        model = self._tree.model()
 
         # check if exist a previous sibling
-        parent_item = self._tree.model().itemFromIndex(idx.parent())
-        if item.row() > 0:
-            idx = self._tree.model().index(item.row() - 1, 0, idx.parent())
+        if idx.row() > 0:
+            idx = model.index(idx.row() - 1, 0, idx.parent())
 
             # move to the last item
-            item = self._tree.model().itemFromIndex(idx)
-            while item.hasChildren():
-                idx = self._tree.model().index(item.rowCount() - 1, 0, idx)
-                item = self._tree.model().itemFromIndex(idx)
+            while self._row_count(idx) > 0:
+                idx = model.index(model.rowCount(idx) - 1, 0, idx)
 
             return idx
 
         # ok, we should go up
-        if (self._tree.model().itemFromIndex(idx.parent())):
+        if idx.parent().isValid():
             idx = idx.parent()
             return idx
 
         return None
 
     def _get_item(self, idx):
-        item = self._tree.model().itemFromIndex(idx)
-        item2 = self._tree.model().itemFromIndex(idx.siblingAtColumn(1))
-        return item, item2
+        return idx.data(), idx.siblingAtColumn(1).data()
 
     def _do_search(self, next=True):
         if next:
@@ -434,7 +667,7 @@ class FindDialog(QDialog):
             selection.select(selection.currentIndex(),
                 QItemSelectionModel.Select|QItemSelectionModel.Rows)
 
-        idx = selection.selectedIndexes()[0]
+        idx = selection.selectedIndexes()[0].siblingAtColumn(0)
 
         while True:
             if not self._first_search:
@@ -448,9 +681,9 @@ class FindDialog(QDialog):
             self._first_search = False
             item1, item2 = self._get_item(idx)
 
-            if self._stext.text().lower() in item1.text().lower():
+            if self._stext.text().lower() in item1.lower():
                 break;
-            if self._stext.text().lower() in item2.text().lower():
+            if self._stext.text().lower() in item2.lower():
                 break;
 
         selection.clearSelection()
@@ -477,7 +710,10 @@ class AssemblyWindow(bbwindow.BBMainWindow):
         self._mode = mode
         self._data = dict()
         self._bom_reload = None
+        self._bom_code_id = None
         self._top_reference = ''
+        self._model = None
+        self._loader = None
 
         self._init_gui()
         self.resize(1024, 600)
@@ -488,6 +724,11 @@ class AssemblyWindow(bbwindow.BBMainWindow):
         self._my_statusbar.showMessage("Status Bar Is Ready", 3000)
         self.setStatusBar(self._my_statusbar)
 
+        self._cancel_button = QPushButton("Cancel")
+        self._cancel_button.clicked.connect(self._bom_load_cancel)
+        self._cancel_button.hide()
+        self._my_statusbar.addPermanentWidget(self._cancel_button)
+
 
     def _create_menu(self):
         mainMenu = self.menuBar()
@@ -496,7 +737,7 @@ class AssemblyWindow(bbwindow.BBMainWindow):
 
         a = QAction("Refresh", self)
         a.setShortcut("F5")
-        a.triggered.connect(self.bom_reload)
+        a.triggered.connect(self.bom_refresh)
         m.addAction(a)
         m.addSeparator()
 
@@ -656,30 +897,12 @@ class AssemblyWindow(bbwindow.BBMainWindow):
         utils.copy_text_to_clipboard(data)
 
     def _show_up_to(self, lev):
-        if lev == -1:
-            self._tree.expandAll()
-            return
-
-        parent_item = self._tree.model().item(0,0)
-
-        def rec_iterate(parent, l):
-            c = parent.rowCount()
-            if c == 0:
-                return
-
-            for i in range(c):
-                child = parent.child(i, 0)
-                child_idx = child.index()
-                if l >= lev:
-                    if self._tree.isExpanded(child_idx):
-                        self._tree.setExpanded(child_idx, False)
-                else:
-                    if not self._tree.isExpanded(child_idx):
-                        self._tree.setExpanded(child_idx, True)
-                    rec_iterate(child, l+1)
-
         with utils.OverrideCursor():
-            rec_iterate(parent_item, 1)
+            self._model.fetch_up_to(lev)
+            if lev == -1:
+                self._tree.expandAll()
+            else:
+                self._tree.expandToDepth(lev - 1)
 
     def _start_find(self):
         self._find = FindDialog(self, self._tree)
@@ -730,64 +953,6 @@ class AssemblyWindow(bbwindow.BBMainWindow):
             parent=self)
         contextMenu.exec_(self._tree.viewport().mapToGlobal(point))
 
-    def _set_bom_colors(self, path, colors_filter, item):
-        if len(path) == 0:
-            return
-
-        def match(k, v):
-            if k.startswith("*"):
-                k = k[1:]
-                l = range(len(path))
-            else:
-                l = [len(path) - 1]
-
-            for idx in l:
-                i = path[idx]
-                tmp = self._data[i]
-                if k in tmp:
-                    if v.startswith("!") and str(tmp[k]) != v[1:]:
-                        return True
-                    if str(tmp[k]) == v:
-                        return True
-
-                if idx == 0:
-                    continue
-
-                j = path[idx-1]
-                tmp2 = self._data[j]["deps"][i]
-                if k in tmp2:
-                    if v.startswith("!") and str(tmp2[k]) != v[1:]:
-                        return True
-                    if str(tmp2[k]) == v:
-                        return True
-
-            return False
-
-        def apply_actions(actions):
-            for action in actions:
-                if action.startswith("bg="):
-                    item.setBackground(QColor(action[3:]))
-                elif action.startswith("fg="):
-                    item.setForeground(QColor(action[3:]))
-                elif action.startswith("italic"):
-                    f = item.font()
-                    f.setItalic(True)
-                    item.setFont(f)
-                elif action.startswith("bold"):
-                    f = item.font()
-                    f.setBold(True)
-                    item.setFont(f)
-                else:
-                    print("WARNING: unknown action '%s'"%(action))
-
-        for (filters, actions) in colors_filter:
-            for f in filters:
-                k,v = f.split("=")[:2]
-                if not match(k, v):
-                    break
-            else:
-                apply_actions(actions)
-
     def populate(self, top, data, bom_date=None):
         top_code = data[top]["code"]
 
@@ -817,45 +982,20 @@ class AssemblyWindow(bbwindow.BBMainWindow):
         self._data = data
         self._top = top
 
-        model = QStandardItemModel()
-        self._tree.setModel(model)
-        model.setHorizontalHeaderLabels(["Code", "Description"])
-        recursive_error = set()
-
-        def rec_update(n, path):
-            cnt = 1
-            d = data[n]
-            #if self._valid_where_used and d["date_to"] != "":
-            #    return None
-            i =  QStandardItem(d["code"])
-            i.setData(n)
-            i.setFlags(Qt.ItemIsSelectable | Qt.ItemIsEnabled)
-            i2 =  QStandardItem(d["descr"])
-            i2.setFlags(Qt.ItemIsSelectable | Qt.ItemIsEnabled)
-
-            if len(colors_filter):
-                self._set_bom_colors(path, colors_filter, i)
-                self._set_bom_colors(path, colors_filter, i2)
-            for c in data[n]["deps"]:
-                if c in path:
-                    recursive_error.add((d["code"], d["descr"]))
-                    continue
-                ci, cnt2 = rec_update(c, path+[c])
-                cnt += cnt2
-                if not ci is None:
-                    i.appendRow(ci)
+        colors = None
+        if len(colors_filter):
+            colors = utils.BomColors(colors_filter)
 
-            return (i, i2), cnt
+        model = BomTreeModel(top, data, ["Code", "Description", "Children"],
+                                colors)
+        self._tree.setModel(model)
+        self._model = model
 
-        root_items, num_items = rec_update(top, [top])
-        if root_items is None:
-            model.appendRow((QStandardItem("Empty"),))
-        else:
-            model.appendRow(root_items)
+        num_items, recursive_error = _scan_bom(top, data)
         num_items += 1
 
-        idx = model.indexFromItem(root_items[0])
-        self._tree.expandAll()
+        idx = model.index(0, 0)
+        self._tree.expand(idx)
         self._tree.selectionModel().selectionChanged.connect(self._change_selection)
         self._tree.selectionModel().select(idx, self._tree.selectionModel().Rows)
 
@@ -886,25 +1026,13 @@ class AssemblyWindow(bbwindow.BBMainWindow):
         if idxs is None:
             return []
 
-        idx = idxs[0]
-
-        path = []
-        while self._tree.model().itemFromIndex(idx):
-            path.insert(0, self._tree.model().itemFromIndex(idx).data())
-            idx = idx.parent()
-
-        return path
+        return self._model.get_path(idxs[0])
 
     def _change_selection(self, to, from_):
         if len(to.indexes()) < 1:
             return
 
-        idx = to.indexes()[0]
-
-        path = []
-        while self._tree.model().itemFromIndex(idx):
-            path.insert(0, self._tree.model().itemFromIndex(idx).data())
-            idx = idx.parent()
+        path = self._model.get_path(to.indexes()[0])
 
         #path = self._get_path()
 
@@ -950,19 +1078,133 @@ class AssemblyWindow(bbwindow.BBMainWindow):
         if not self._bom_reload:
             return
 
-        with utils.OverrideCursor():
-            time0 = time.time()
-            top, data, dt = self._bom_reload()
-            time1 = time.time()
+        if not self._loader is None:
+            self._loader.cancel()
+
+        # the window has nothing to work on until the first bom is loaded
+        if self._model is None:
+            self.menuBar().setEnabled(False)
+
+        self._loader = BomLoader(self._bom_reload)
+        self._loader.progress.connect(self._bom_load_progress)
+        self._loader.finished.connect(self._bom_load_finished)
+        self._loader.failed.connect(self._bom_load_failed)
+        self._load_time0 = time.time()
+        self._cancel_button.show()
+        self._my_statusbar.showMessage("Loading...")
+        self._loader.start()
+
+    def _bom_load_end(self):
+        self._loader = None
+        self._cancel_button.hide()
+        self.menuBar().setEnabled(True)
+
+        # nothing was loaded before
+        if self._model is None:
+            self.close()
+
+    def _bom_load_cancel(self):
+        if self._loader is None:
+            return
+        self._loader.cancel()
+        self._bom_load_end()
+        self._my_statusbar.showMessage("Loading cancelled", 3000)
 
-        cnt = self.populate(top, data, dt)
-        time2 = time.time()
+    def _bom_load_progress(self, loader, nodes, depth):
+        if not loader is self._loader:
+            return
+        self._my_statusbar.showMessage(
+            "Loading: %i codes fetched, level %i..."%(nodes, depth))
 
-        self._my_statusbar.showMessage("%i items in %.2f+%.2f sec"%(
-            cnt, time1-time0, time2-time1))
+    def _bom_load_failed(self, loader, msg):
+        if not loader is self._loader:
+            return
+        self._my_statusbar.clearMessage()
+        QMessageBox.critical(self, "BOMBrowser",
+            "ERROR: the bom can't be loaded\n\n" + msg)
+        self._bom_load_end()
 
-    def set_bom_reload(self, f):
+    def _bom_load_finished(self, loader, ret):
+        if not loader is self._loader:
+            return
+
+        time1 = time.time()
+        top, data, dt = ret
+        with utils.OverrideCursor():
+            cnt = self.populate(top, data, dt)
+        time2 = time.time()
+        self._bom_load_end()
+
+        stats = db.get_db_instance().get_bom_cache_stats()
+        self._my_statusbar.showMessage(
+            "%i items in %.2f+%.2f sec (cache: %i hits, %i misses)"%(
+            cnt, time1-self._load_time0, time2-time1,
+            stats["hits"], stats["misses"]))
+
+    def closeEvent(self, event):
+        if not self._loader is None:
+            self._loader.cancel()
+            self._loader = None
+        bbwindow.BBMainWindow.closeEvent(self, event)
+
+    def bom_refresh(self):
+        # the user asked explicitly a refresh: don't trust the cache
+        if not self._bom_code_id is None:
+            db.get_db_instance().invalidate_bom_cache(self._bom_code_id)
+        self.bom_reload()
+
+    def set_bom_reload(self, f, code_id=None):
         self._bom_reload = f
+        self._bom_code_id = code_id
+
+def _count_loop_rows(n, data, members, count):
+    # the rows below a code of a loop: the paths inside the loop are
+    # followed until a code repeats, as the tree does
+    total = 1
+    path = [n]
+    onpath = set(path)
+    stack = [iter(data[n]["deps"])]
+    while len(stack):
+        for c in stack[-1]:
+            if c in onpath:
+                continue
+            if not c in members:
+                total += count[c]
+                continue
+            total += 1
+            path.append(c)
+            onpath.add(c)
+            stack.append(iter(data[c]["deps"]))
+            break
+        else:
+            stack.pop()
+            onpath.remove(path.pop())
+    return total
+
+def _scan_bom(top, data):
+    """Return the number of rows of the bom when it is fully expanded and
+    the set of (code, descr) which have a child in the same loop. The bom
+    is visited without expanding the repeated sub-assemblies."""
+    recursive_error = set()
+    count = dict()
+
+    # the children come first
+    for comp in utils.bom_components(top, data):
+        if len(comp) == 1:
+            n = comp[0]
+            deps = data[n]["deps"]
+            if n in deps:
+                recursive_error.add((data[n]["code"], data[n]["descr"]))
+            count[n] = 1 + sum(count[c] for c in deps if c != n)
+            continue
+
+        members = set(comp)
+        for n in comp:
+            if len(members & set(data[n]["deps"])) > 0:
+                recursive_error.add((data[n]["code"], data[n]["descr"]))
+            count[n] = _count_loop_rows(n, data, members, count)
+
+    return count[top], recursive_error
 
 def _smart_filter(top, data):
     top_node = data[top]
@@ -1019,7 +1261,7 @@ def where_used(code_id, mode="where_used"):
 
     w.show()
 
-    def bom_reload_():
+    def bom_reload_(progress):
         d = db.get_db_instance()
 
         valid = mode in ["smart_where_used", "valid_where_used"]
@@ -1051,12 +1293,13 @@ def show_assembly(code_id, winParent):
     w = AssemblyWindow(None)
     w.show()
 
-    def bom_reload_():
+    def bom_reload_(progress):
         d = db.get_db_instance()
-        top, data = d.get_bom_by_code_id3(code_id, date_from_days)
+        top, data = d.get_bom_by_code_id3(code_id, date_from_days,
+                                          progress=progress)
         return top, data, date_from_days
 
-    w.set_bom_reload(bom_reload_)
+    w.set_bom_reload(bom_reload_, code_id)
     w.bom_reload()
 
 def show_latest_assembly(code_id):
@@ -1067,7 +1310,7 @@ def show_latest_assembly(code_id):
     w = AssemblyWindow(None)
     w.show()
 
-    def bom_reload_():
+    def bom_reload_(progress):
         d = db.get_db_instance()
         dates = d.get_dates_by_code_id3(code_id)
 
@@ -1081,10 +1324,10 @@ def show_latest_assembly(code_id):
         else:
             dt = min(db.prototype_date - 1, dates[0][3])
 
-        top, data = d.get_bom_by_code_id3(code_id, dt)
+        top, data = d.get_bom_by_code_id3(code_id, dt, progress=progress)
         return top, data, dt
 
-    w.set_bom_reload(bom_reload_)
+    w.set_bom_reload(bom_reload_, code_id)
     w.bom_reload()
 
 def show_proto_assembly(code_id):
@@ -1095,14 +1338,15 @@ def show_proto_assembly(code_id):
     w = AssemblyWindow(None)
     w.show()
 
-    def bom_reload_():
+    def bom_reload_(progress):
         d = db.get_db_instance()
         dates = d.get_dates_by_code_id3(code_id)
         dt = min(db.end_of_the_world, dates[0][3])
-        top, data = d.get_bom_by_code_id3(code_id, dates[0][3])
+        top, data = d.get_bom_by_code_id3(code_id, dates[0][3],
+                                          progress=progress)
         return top, data, db.end_of_the_world
 
-    w.set_bom_reload(bom_reload_)
+    w.set_bom_reload(bom_reload_, code_id)
     w.bom_reload()
 
 def show_assembly_by_date(code_id, dt):
@@ -1112,10 +1356,10 @@ def show_assembly_by_date(code_id, dt):
 
     w = AssemblyWindow(None)
     w.show()
-    def bom_reload_():
+    def bom_reload_(progress):
         d = db.get_db_instance()
-        top, data = d.get_bom_by_code_id3(code_id, dt)
+        top, data = d.get_bom_by_code_id3(code_id, dt, progress=progress)
         return top, data, dt
 
-    w.set_bom_reload(bom_reload_)
+    w.set_bom_reload(bom_reload_, code_id)
     w.bom_reload()
@@ -19,64 +19,182 @@ Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
 
 import socketserver
 import socket
+import asyncio
+import concurrent.futures
 import pickle
 import struct
 import sys
+import zlib
 import time
+import threading
+import collections
 
 import db
 
 _server_istance = None
 
+# every message is prefixed by an header with the protocol version,
+# the flags below, an unused field and the size of the (pickled) payload
+_frame_format = "!bbhl"
+_frame_header_size = struct.calcsize(_frame_format)
+_socket_buffer_size = 4 * 1024 * 1024
+# below this size, the header and the payload are sent in one go
+_frame_join_size = 64 * 1024
+
+# the payload is compressed by zlib
+FLAG_ZLIB = 1
+# set in the remote_server_do_auth request (and in its reply) if the
+# client (the server) accepts compressed messages; the old clients and
+# servers leave this field to 0, so they never see a compressed message
+FLAG_ACCEPT_ZLIB = 2
+
+# the payloads smaller than this size are never compressed
+compression_min_size = 16 * 1024
+compression_level = 1
+
+# the largest payload accepted; the requests are small, the replies
+# (e.g. the one of dump_tables()) may be big
+max_request_size = 64 * 1024 * 1024
+max_reply_size = 1024 * 1024 * 1024
+
+class ProtocolError(ConnectionError):
+    pass
+
+def _set_socket_buffers(sock):
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, _socket_buffer_size)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, _socket_buffer_size)
+
+def _recv_exactly(sock, size, eof_ok=False):
+    # read 'size' bytes in a preallocated buffer; if eof_ok is True and
+    # the peer closes the connection before sending anything, return None
+    buf = bytearray(size)
+    view = memoryview(buf)
+    pos = 0
+    while pos < size:
+        n = sock.recv_into(view[pos:], size - pos)
+        if n == 0:
+            if eof_ok and pos == 0:
+                return None
+            raise ProtocolError("Connection closed by the peer")
+        pos += n
+    return buf
+
+def _decode_header(header, max_size):
+    ver, flags, _, datasize = struct.unpack(_frame_format, header)
+    if ver != 0:
+        raise ProtocolError("Unknown protocol version %d"%(ver))
+    # check the size before allocating the buffer for the payload
+    if datasize < 0 or datasize > max_size:
+        raise ProtocolError("Invalid message size %d"%(datasize))
+    return flags, datasize
+
+def _decode_payload(flags, data, compression, max_size):
+    # a compressed message is accepted only if compression was negotiated;
+    # the decompressed size is limited as the received one
+    if not flags & FLAG_ZLIB:
+        return data
+    if not compression:
+        raise ProtocolError("Compressed message not negotiated")
+    d = zlib.decompressobj()
+    try:
+        ret = d.decompress(data, max_size)
+    except zlib.error as e:
+        raise ProtocolError("Corrupted compressed message: %s"%(e))
+    if d.unconsumed_tail:
+        raise ProtocolError("Compressed message too big")
+    if not d.eof or d.unused_data:
+        raise ProtocolError("Corrupted compressed message")
+    return ret
+
+def _encode_frame(data, flags=0, compress=False):
+    # return the header and the payload to send
+    if compress and len(data) >= compression_min_size:
+        cdata = zlib.compress(data, compression_level)
+        if len(cdata) < len(data):
+            data = cdata
+            flags |= FLAG_ZLIB
+
+    header = struct.pack(_frame_format, 0, # rev
+        flags,
+        0, # unused
+        len(data))
+    return header, data
+
+def _recv_frame(sock, max_size, eof_ok=False, compression=False):
+    # return the flags and the payload (already decompressed)
+    header = _recv_exactly(sock, _frame_header_size, eof_ok)
+    if header is None:
+        return None, None
+    flags, datasize = _decode_header(header, max_size)
+    data = _recv_exactly(sock, datasize)
+    return flags, _decode_payload(flags, data, compression, max_size)
+
+def _send_frame(sock, data, flags=0, compress=False):
+    header, data = _encode_frame(data, flags, compress)
+    if len(data) < _frame_join_size:
+        sock.sendall(header + data)
+    else:
+        sock.sendall(header)
+        sock.sendall(data)
+
 class RemoteSQLClient:
-    def __init__(self, addr='127.0.0.1', port=8765):
+    def __init__(self, addr='127.0.0.1', port=8765, compression=False):
         self._port = port
         self._addr = addr
         self._username = None
         self._password = None
-        self._format = "!bbhl"
-        self._sock = None
+        # each thread has its own connection to the server (e.g. the boms
+        # are loaded in background threads); the threads started after
+        # the authentication re-authenticate with the saved credentials
+        self._local = threading.local()
+        # compression is asked at remote_server_do_auth time; it is used
+        # only if the server accepts it
+        self._compression = compression
+
+    @property
+    def _sock(self):
+        return getattr(self._local, "sock", None)
+
+    @_sock.setter
+    def _sock(self, sock):
+        self._local.sock = sock
+
+    @property
+    def _peer_compression(self):
+        return getattr(self._local, "peer_compression", False)
+
+    @_peer_compression.setter
+    def _peer_compression(self, v):
+        self._local.peer_compression = v
 
     def _remote_call(self, func_name, *args, **kwargs):
         if self._sock is None:
             self._sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            _set_socket_buffers(self._sock)
             self._sock.connect((self._addr, self._port))
+            self._peer_compression = False
 
             if self._username and self._password:
                 self.remote_server_do_auth(self._username, self._password)
 
+        # a progress callback can't be sent to the server
+        kwargs.pop("progress", None)
         data = pickle.dumps((func_name, args, kwargs))
-        header = struct.pack(self._format, 0, # rev
-            0, # unused
-            0, # unused
-            len(data))
+
+        flags = 0
+        if func_name == "remote_server_do_auth" and self._compression:
+            flags = FLAG_ACCEPT_ZLIB
 
         try:
-            self._sock.sendall(header)
+            _send_frame(self._sock, data, flags, self._peer_compression)
+            # the server compresses the replies only if the client asked
+            flags, data = _recv_frame(self._sock, max_reply_size,
+                                      compression=self._compression)
         except BaseException as e:
+            # the stream is out of sync: the next call reconnects
             self._sock.close()
             self._sock = None
             raise e
-        self._sock.sendall(data)
-
-        header = bytes([])
-        while len(header) != struct.calcsize(self._format):
-            d = self._sock.recv(struct.calcsize(self._format) - len(header))
-            if len(d) == 0:
-                time.sleep(0.1)
-                continue
-            header += d
-        ver, _, _, datasize = struct.unpack(self._format, header)
-        assert(ver == 0)
-
-        data = bytes([])
-        while datasize > 0:
-            d = self._sock.recv(4096)
-            if len(d) == 0:
-                time.sleep(0.1)
-                continue
-            datasize -= len(d)
-            data += d
 
         ret, excp = pickle.loads(data)
         if not excp is None:
@@ -87,6 +205,8 @@ class RemoteSQLClient:
         if func_name == "remote_server_do_auth" and ret:
             self._username = args[0]
             self._password = args[1]
+            self._peer_compression = (self._compression and
+                                      bool(flags & FLAG_ACCEPT_ZLIB))
 
         return ret
 
@@ -111,7 +231,8 @@ class _ServerHandler(socketserver.BaseRequestHandler):
     def handle(self):
 
         remote_db_instance = \
-            RemoteSQLServer(self.server._server_data["db_instance"])
+            RemoteSQLServer(self.server._server_data["db_instance"],
+                            self.server._server_data["cache"])
         self.server._server_data["clients_count"] += 1
         self.server._server_data["client_seq"] += 1
         if self.server._server_data["verbose"]:
@@ -119,44 +240,41 @@ class _ServerHandler(socketserver.BaseRequestHandler):
                 "id=", self.server._server_data["client_seq"],
                 "count=", self.server._server_data["clients_count"]
             )
-        format_ = "!bbhl"
+        _set_socket_buffers(self.request)
+        peer_compression = False
         while True:
-            header = self.request.recv(struct.calcsize(format_))
-            if len(header) == 0:
+            try:
+                flags, data = _recv_frame(self.request, max_request_size,
+                                          eof_ok=True,
+                                          compression=peer_compression)
+            except ConnectionError as e:
+                if self.server._server_data["verbose"]:
+                    print("Error on connection:", e)
+                break
+            if data is None:
                 break
-            ver, _, _, datasize = struct.unpack(format_, header)
-            assert(ver == 0)
-            data = bytes([])
-            while datasize > 0:
-                d = self.request.recv(4096)
-                datasize -= len(d)
-                data += d        
-            
+
             name, args, kwargs = pickle.loads(data)
 
             ret = None
             excp = None
 
-            if name == "remote_server_get_info":
-                ret = {
-                    "clients_count": self.server._server_data["clients_count"],
-                    "id": self.server._server_data["client_seq"],
-                }
-            elif name == "remote_server_get_id":
-                ret = self.server._server_data["client_seq"]
+            if name in ["remote_server_get_info", "remote_server_get_id"]:
+                ret = _get_server_info(self.server._server_data, name)
             else:
                 try:
                     ret = remote_db_instance.call(name, *args, **kwargs)
                 except Exception as e:
                      excp = str(e) # sometime you cannot serialize an exception
 
+            reply_flags = 0
+            if name == "remote_server_do_auth" and ret:
+                peer_compression = bool(flags & FLAG_ACCEPT_ZLIB)
+                if peer_compression:
+                    reply_flags = FLAG_ACCEPT_ZLIB
+
             data = pickle.dumps((ret, excp))
-            header = struct.pack(format_, 0, # rev
-                0, # unused
-                0, # unused
-                len(data))
-            self.request.sendall(header)
-            self.request.sendall(data)
+            _send_frame(self.request, data, reply_flags, peer_compression)
 
         self.server._server_data["clients_count"] -= 1
         if self.server._server_data["verbose"]:
@@ -166,16 +284,114 @@ class _ServerHandler(socketserver.BaseRequestHandler):
             )
 
 
+def _check_call_many(calls):
+    # checked before doing any call: the results have to match the calls
+    for (name, args, kwargs) in calls:
+        if name == "call_many":
+            raise Exception("call_many() can't be nested")
+
+def _get_server_info(server_data, name):
+    if name == "remote_server_get_id":
+        return server_data["client_seq"]
+
+    ret = {
+        "clients_count": server_data["clients_count"],
+        "id": server_data["client_seq"],
+        "cache": server_data["cache"].get_stats(),
+    }
+    if "workers" in server_data:
+        ret["workers"] = server_data["workers"]
+        ret["queue_depth"] = server_data["queue_depth"]
+        ret["pending"] = server_data["pending"]
+    return ret
+
+
+class _ResultsCache:
+    """Results of the read only methods, shared between all the
+    connections. Every call to a read/write method bumps the generation,
+    so a result computed before a write is never returned after it. The
+    size is limited by the total size of the pickled results; the max
+    age limits how much the changes done outside the server (e.g. by the
+    admin tool) are not seen"""
+
+    def __init__(self, max_size, max_age):
+        self._max_size = max_size
+        self._max_age = max_age
+        self._entries = collections.OrderedDict()
+        self._size = 0
+        self._generation = 0
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+
+    def _remove(self, key):
+        (_, size, _) = self._entries.pop(key)
+        self._size -= size
+
+    def get_generation(self):
+        return self._generation
+
+    def bump_generation(self):
+        with self._lock:
+            self._generation += 1
+            self._entries.clear()
+            self._size = 0
+
+    def get(self, key):
+        with self._lock:
+            if not key in self._entries:
+                self._misses += 1
+                return False, None
+            (t, _, value) = self._entries[key]
+            if self._max_age > 0 and time.time() - t > self._max_age:
+                self._remove(key)
+                self._misses += 1
+                return False, None
+            self._entries.move_to_end(key)
+            self._hits += 1
+            return True, value
+
+    def put(self, key, generation, value):
+        if self._max_size <= 0:
+            return
+        size = len(key[-1]) + len(pickle.dumps(value))
+        if size > self._max_size:
+            return
+        with self._lock:
+            if generation != self._generation:
+                return
+            if key in self._entries:
+                self._remove(key)
+            while self._size + size > self._max_size:
+                self._remove(next(iter(self._entries)))
+            self._entries[key] = (time.time(), size, value)
+            self._size += size
+
+    def get_stats(self):
+        with self._lock:
+            return {
+                "generation": self._generation,
+                "hits": self._hits,
+                "misses": self._misses,
+                "entries": len(self._entries),
+                "size": self._size,
+                "max_size": self._max_size,
+                "max_age": self._max_age,
+            }
+
+
 class RemoteSQLServer:
     """This is an 'instance for connection' class"""
-    def __init__(self, db):
+    def __init__(self, db, cache):
         self._read_only_methods = [
             "search_revisions",
             "get_children_by_rid",
             "get_bom_dates_by_code_id",
             "get_drawings_and_urls_by_rid",
+            "get_drawings_by_rids",
             "get_where_used_from_id_code",
             "get_bom_by_code_id3",
+            "get_bom_cache_stats",
             "get_children_dates_range_by_rid",
             "get_parent_dates_range_by_code_id",
             "get_dates_by_code_id3",
@@ -186,6 +402,8 @@ class RemoteSQLServer:
             "dump_tables",
             "list_main_tables",
             "dump_table",
+            "dump_table_changes",
+            "get_backup_watermarks",
         ]
         self._read_write_methods = [
             "delete_code_revision",
@@ -196,8 +414,22 @@ class RemoteSQLServer:
             "copy_code",
             "create_db",
             "create_first_code",
+            "start_change_journal",
+            # it means that the db was changed outside the server: the
+            # cache shared by all the clients is flushed
+            "invalidate_bom_cache",
+        ]
+        # read only methods whose result is not cached
+        self._not_cached_methods = [
+            "get_bom_cache_stats",
+            "dump_tables",
+            "list_main_tables",
+            "dump_table",
+            "dump_table_changes",
+            "get_backup_watermarks",
         ]
         self._db = db
+        self._cache = cache
         self._allow_access = False
         self._read_only = True
 
@@ -217,7 +449,14 @@ class RemoteSQLServer:
 
         if not self._allow_access:
             raise Exception("You have to authenticate")
-            
+
+        # the calls are executed in sequence, stopping at the first error
+        if name == "call_many":
+            (calls,) = args
+            _check_call_many(calls)
+            return [self.call(name_, *args_, **kwargs_)
+                        for (name_, args_, kwargs_) in calls]
+
         if (not name in self._read_write_methods and
             not name in self._read_only_methods):
                 raise Exception("Unknown method '%s'"%(name))
@@ -226,7 +465,32 @@ class RemoteSQLServer:
             raise Exception("Access read only")
 
         try:
-            return getattr(self._db, name)(*args, **kwargs)
+            if name in self._read_write_methods:
+                try:
+                    return getattr(self._db, name)(*args, **kwargs)
+                finally:
+                    self._cache.bump_generation()
+
+            if name in self._not_cached_methods:
+                ret = getattr(self._db, name)(*args, **kwargs)
+                # the rows are returned by generators, which cannot be
+                # sent to the client
+                if name == "dump_table":
+                    ret = (ret[0], list(ret[1]))
+                elif name == "dump_tables":
+                    ret = [(tname, columns, list(rows))
+                        for (tname, columns, rows) in ret]
+                elif name == "dump_table_changes":
+                    ret = (ret[0], list(ret[1]), ret[2])
+                return ret
+
+            generation = self._cache.get_generation()
+            key = (generation, name, pickle.dumps((args, kwargs)))
+            found, ret = self._cache.get(key)
+            if not found:
+                ret = getattr(self._db, name)(*args, **kwargs)
+                self._cache.put(key, generation, ret)
+            return ret
         except:
             import sys, traceback
             e = "Traceback\n"+ \
@@ -237,7 +501,8 @@ class RemoteSQLServer:
 
 
 def _start_server(db_instance, addr='0.0.0.0', port=8765,
-        verbose=False, allow_exit_server=False):
+        verbose=False, allow_exit_server=False, cache_size=64*1024*1024,
+        cache_max_age=60):
     class Server_(socketserver.ThreadingTCPServer):
         allow_reuse_address = True
 
@@ -248,6 +513,7 @@ def _start_server(db_instance, addr='0.0.0.0', port=8765,
                 "clients_count": 0,
                 "db_instance": db_instance,
                 "client_seq": 1000,
+                "cache": _ResultsCache(cache_size, cache_max_age),
             }
 
             if (verbose):
@@ -260,6 +526,185 @@ def _start_server(db_instance, addr='0.0.0.0', port=8765,
         _server_istance = server
         server.serve_forever()
 
+
+_worker_local = threading.local()
+
+class _WorkerDB:
+    """Forward the calls to the db instance of the current worker thread"""
+    def __getattr__(self, name):
+        return getattr(_worker_local.db, name)
+
+
+class _AsyncServer:
+    """The connections are handled by an asyncio loop, so the idle ones
+    are cheap; the db calls are executed by a fixed number of worker
+    threads, each one with its own db connection.
+
+    A client waits the reply before sending the next request, so it has
+    at most one call in the workers queue: serving the queue in order is
+    fair between the clients. The calls of a call_many() are queued one
+    at time for the same reason. When queue_depth calls are pending, the
+    next ones wait before being queued."""
+
+    def __init__(self, db_factory, addr, port, verbose, cache_size,
+                 cache_max_age, workers, queue_depth):
+        self._db_factory = db_factory
+        self._addr = addr
+        self._port = port
+        self._loop = None
+        self._stop = None
+        self._bom_cache = None
+        self._bom_cache_lock = threading.Lock()
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=workers, initializer=self._init_worker)
+        self._server_data = {
+            "verbose": verbose,
+            "clients_count": 0,
+            "client_seq": 1000,
+            "cache": _ResultsCache(cache_size, cache_max_age),
+            "workers": workers,
+            "queue_depth": queue_depth,
+            "pending": 0,
+        }
+
+    def _init_worker(self):
+        d = self._db_factory()
+        # the boms cache has to be invalidated by the writes of all the
+        # workers, so share it
+        with self._bom_cache_lock:
+            if self._bom_cache is None:
+                self._bom_cache = d._bom_cache
+            d._bom_cache = self._bom_cache
+        _worker_local.db = d
+
+    async def _run_in_worker(self, f, *args, **kwargs):
+        async with self._queue_slots:
+            self._server_data["pending"] += 1
+            try:
+                return await self._loop.run_in_executor(self._executor,
+                    lambda: f(*args, **kwargs))
+            finally:
+                self._server_data["pending"] -= 1
+
+    async def _call(self, remote_db_instance, name, args, kwargs):
+        if name in ["remote_server_get_info", "remote_server_get_id"]:
+            return _get_server_info(self._server_data, name)
+        if name == "remote_server_do_auth":
+            return remote_db_instance.call(name, *args, **kwargs)
+
+        if name == "call_many" and remote_db_instance._allow_access:
+            (calls,) = args
+            _check_call_many(calls)
+            ret = []
+            for (name_, args_, kwargs_) in calls:
+                ret.append(await self._run_in_worker(
+                    remote_db_instance.call, name_, *args_, **kwargs_))
+            return ret
+
+        return await self._run_in_worker(
+            remote_db_instance.call, name, *args, **kwargs)
+
+    async def _handle_client(self, reader, writer):
+        remote_db_instance = RemoteSQLServer(_WorkerDB(),
+                                             self._server_data["cache"])
+        server_data = self._server_data
+        server_data["clients_count"] += 1
+        server_data["client_seq"] += 1
+        if server_data["verbose"]:
+            print("Got connection:",
+                "id=", server_data["client_seq"],
+                "count=", server_data["clients_count"]
+            )
+
+        _set_socket_buffers(writer.get_extra_info("socket"))
+        peer_compression = False
+        try:
+            while True:
+                try:
+                    header = await reader.readexactly(_frame_header_size)
+                    flags, datasize = _decode_header(header,
+                                                     max_request_size)
+                    data = await reader.readexactly(datasize)
+                except asyncio.IncompleteReadError as e:
+                    if len(e.partial) > 0 and server_data["verbose"]:
+                        print("Error on connection: truncated message")
+                    break
+                except ConnectionError as e:
+                    if server_data["verbose"]:
+                        print("Error on connection:", e)
+                    break
+
+                try:
+                    data = _decode_payload(flags, data, peer_compression,
+                                           max_request_size)
+                except ProtocolError as e:
+                    if server_data["verbose"]:
+                        print("Error on connection:", e)
+                    break
+
+                name, args, kwargs = pickle.loads(data)
+
+                ret = None
+                excp = None
+                try:
+                    ret = await self._call(remote_db_instance, name,
+                                           args, kwargs)
+                except Exception as e:
+                    excp = str(e) # sometime you cannot serialize an exception
+
+                reply_flags = 0
+                if name == "remote_server_do_auth" and ret:
+                    peer_compression = bool(flags & FLAG_ACCEPT_ZLIB)
+                    if peer_compression:
+                        reply_flags = FLAG_ACCEPT_ZLIB
+
+                header, data = _encode_frame(pickle.dumps((ret, excp)),
+                    reply_flags, peer_compression)
+                writer.write(header)
+                writer.write(data)
+                await writer.drain()
+        finally:
+            writer.close()
+            server_data["clients_count"] -= 1
+            if server_data["verbose"]:
+                print("End connection:",
+                    "id=", server_data["client_seq"],
+                    "count=", server_data["clients_count"]
+                )
+
+    async def _serve(self):
+        self._loop = asyncio.get_running_loop()
+        self._stop = asyncio.Event()
+        self._queue_slots = asyncio.Semaphore(
+            self._server_data["queue_depth"])
+        server = await asyncio.start_server(self._handle_client,
+            self._addr, self._port, reuse_address=True, backlog=1024)
+        if self._server_data["verbose"]:
+            print("Start async server: %s@%d"%(self._addr, self._port))
+        async with server:
+            await self._stop.wait()
+
+    def serve_forever(self):
+        try:
+            asyncio.run(self._serve())
+        finally:
+            self._executor.shutdown()
+
+    def shutdown(self):
+        # may be called by another thread
+        if self._loop:
+            self._loop.call_soon_threadsafe(self._stop.set)
+
+
+def _start_async_server(db_factory, addr='0.0.0.0', port=8765,
+        verbose=False, cache_size=64*1024*1024, cache_max_age=60,
+        workers=4, queue_depth=64):
+    server = _AsyncServer(db_factory, addr, port, verbose, cache_size,
+                          cache_max_age, workers, queue_depth)
+    global _server_istance
+    _server_istance = server
+    server.serve_forever()
+
 # These tests are for checking that all the function may
 # called by the client. It is not checked the functionality of
 # the methods
@@ -503,6 +948,10 @@ def test_060_get_drawings_and_urls_by_rid():
     res = r.get_drawings_and_urls_by_rid(rid)
     assert(len(res) == 2)
 
+    res = r.get_drawings_by_rids([rid])
+    assert(list(res.keys()) == [rid])
+    assert(res[rid] == [("a", "b"), ("a", "b")])
+
 def test_050_get_code():
     r = _test_get_conn()
     r.create_db()
@@ -617,6 +1066,33 @@ def test_070_get_bom_by_code_id3():
     res = r.get_bom_by_code_id3(pcode_id, pdate_from_days)
     assert(len(res[1]) == 2)
 
+    # the progress callback is not sent to the server
+    res2 = r.get_bom_by_code_id3(pcode_id, pdate_from_days,
+                                 progress=lambda nodes, depth: None)
+    assert(res2[1] == res[1])
+
+def test_070_threads():
+    r = _test_make_assembly()
+
+    res = r.get_codes_by_like_code_and_descr('%', '')
+    expected = [r.get_code(code_id, db.end_of_the_world)
+                    for (code_id, *_) in res]
+    ret = dict()
+
+    def worker(n):
+        ret[n] = [r.get_code(code_id, db.end_of_the_world)
+                    for i in range(20) for (code_id, *_) in res]
+
+    # each thread has its own connection
+    threads = [threading.Thread(target=worker, args=(n,)) for n in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    for n in range(4):
+        assert(ret[n] == expected * 20)
+
 def test_070_get_bom_dates_by_code_id():
     r = _test_make_assembly()
 
@@ -672,21 +1148,227 @@ def test_020_dump_tables():
 
     assert(len(res) == len(l))
 
-def _run_server():
+def test_020_incremental_dump():
+    import tempfile
+    import zipfile
+    import os
+
+    r = _test_make_assembly()
+    base = tempfile.NamedTemporaryFile(delete=False).name+".zip"
+    inc = tempfile.NamedTemporaryFile(delete=False).name+".zip"
+    try:
+        db.dump_tables(base, r, quiet=True, start_journal=True)
+        code_id = r.get_codes_by_code('1')[0][0]
+        rid = r.get_dates_by_code_id3(code_id)[0][4]
+        r.copy_code('2', rid, "new-descr", 0)
+        db.dump_tables(inc, r, quiet=True, base=base)
+        with zipfile.ZipFile(inc) as z:
+            lines = z.open("items.csv").readlines()
+            assert(len(lines) == 2) # header + the new code
+    finally:
+        for fn in [base, inc]:
+            if os.path.exists(fn):
+                os.unlink(fn)
+
+def test_000_compression():
+    r = RemoteSQLClient(compression=True)
+    r.remote_server_do_auth("foo", "bar")
+    assert(r._peer_compression)
+
+    r.create_db()
+    r.create_first_code()
+    res = r.get_codes_by_like_code_and_descr('%', '')
+    assert(len(res) == 1)
+    res = r.dump_tables()
+    assert(len(res) == len(r.list_main_tables()))
+
+    r = _test_get_conn()
+    assert(not r._peer_compression)
+
+def test_070_call_many():
+    r = _test_make_assembly()
+
+    res = r.get_codes_by_like_code_and_descr('%', '')
+    calls = [("get_code", (code_id, db.end_of_the_world), {})
+                for (code_id, *_) in res]
+    calls.append(("get_codes_by_code", (), {"code": res[0][1]}))
+
+    ret = r.call_many(calls)
+    assert(len(ret) == len(calls))
+    for i, (code_id, *_) in enumerate(res):
+        assert(ret[i] == r.get_code(code_id, db.end_of_the_world))
+    assert(ret[-1] == r.get_codes_by_code(res[0][1]))
+
+    assert(r.call_many([]) == [])
+
+    excepted = False
+    try:
+        r.call_many([("get_code", (res[0][0], db.end_of_the_world), {}),
+                     ("call_many", ([],), {})])
+    except Exception as e:
+        excepted = "can't be nested" in str(e)
+    assert(excepted)
+
+def test_080_results_cache():
+    r = _test_get_conn()
+    r.create_db()
+    r.create_first_code()
+
+    res = r.get_codes_by_like_code_and_descr('%', '')
+    code = res[0][1]
+
+    stats0 = r.remote_server_get_info()["cache"]
+    res1 = r.get_codes_by_code(code)
+    res2 = r.get_codes_by_code(code)
+    stats1 = r.remote_server_get_info()["cache"]
+
+    assert(res1 == res2)
+    assert(stats1["hits"] == stats0["hits"] + 1)
+    assert(stats1["misses"] == stats0["misses"] + 1)
+
+    # a write drops all the results computed before
+    r.create_db()
+    stats2 = r.remote_server_get_info()["cache"]
+    assert(stats2["generation"] > stats1["generation"])
+    assert(stats2["entries"] == 0)
+    assert(stats2["size"] == 0)
+    assert(r.get_codes_by_code(code) is None)
+    stats3 = r.remote_server_get_info()["cache"]
+    assert(stats3["size"] > 0)
+
+    # invalidate_bom_cache flushes the cache shared by all the clients
+    r.invalidate_bom_cache(0)
+    stats4 = r.remote_server_get_info()["cache"]
+    assert(stats4["generation"] > stats3["generation"])
+    assert(stats4["entries"] == 0)
+
+def test_000_results_cache_limits():
+    # the size is bounded by the size of the pickled results
+    value = bytes(1000)
+    size = len(pickle.dumps(value)) + len(b"k")
+    cache = _ResultsCache(size * 3, 0)
+    for i in range(5):
+        cache.put((0, "f", b"%d"%(i)), 0, value)
+    stats = cache.get_stats()
+    assert(stats["entries"] == 3)
+    assert(stats["size"] == size * 3)
+    assert(cache.get((0, "f", b"1")) == (False, None))
+    assert(cache.get((0, "f", b"4")) == (True, value))
+
+    # a result bigger than the cache is not stored
+    cache.put((0, "f", b"x"), 0, bytes(size * 3))
+    assert(cache.get((0, "f", b"x")) == (False, None))
+
+    # the entries older than max age are dropped
+    cache = _ResultsCache(size * 3, 0.1)
+    cache.put((0, "f", b"1"), 0, value)
+    assert(cache.get((0, "f", b"1")) == (True, value))
+    time.sleep(0.2)
+    assert(cache.get((0, "f", b"1")) == (False, None))
+    assert(cache.get_stats()["size"] == 0)
+
+def test_000_read_only_invalidate_bom_cache():
+    remote = RemoteSQLServer(None, _ResultsCache(1000, 0))
+    remote._allow_access = True
+    excepted = False
+    try:
+        remote.call("invalidate_bom_cache", 0)
+    except Exception as e:
+        excepted = "read only" in str(e)
+    assert(excepted)
+
+def test_000_framing():
+    s1, s2 = socket.socketpair()
+    for size in [0, 10, _frame_join_size, 3*1024*1024]:
+        data = bytes([i % 251 for i in range(size)])
+        for compress in [False, True]:
+            t = threading.Thread(target=_send_frame,
+                                 args=(s1, data, 0, compress))
+            t.start()
+            flags, data2 = _recv_frame(s2, max_reply_size,
+                                       compression=True)
+            assert(data2 == data)
+            assert(bool(flags & FLAG_ZLIB) ==
+                   (compress and size >= compression_min_size))
+            t.join()
+
+    # a clean EOF between two frames is allowed only if requested
+    s1.close()
+    assert(_recv_frame(s2, max_reply_size, eof_ok=True) == (None, None))
+
+    s1, s2 = socket.socketpair()
+    s1.sendall(struct.pack(_frame_format, 0, 0, 0, 100) + bytes(10))
+    s1.close()
+    excepted = False
+    try:
+        _recv_frame(s2, max_reply_size, eof_ok=True)
+    except ProtocolError:
+        excepted = True
+    assert(excepted)
+
+    # the size is checked before receiving the payload
+    for size in [-1, 101]:
+        s1, s2 = socket.socketpair()
+        s1.sendall(struct.pack(_frame_format, 0, 0, 0, size))
+        excepted = False
+        try:
+            _recv_frame(s2, 100)
+        except ProtocolError:
+            excepted = True
+        assert(excepted)
+        s1.close()
+        s2.close()
+
+    # a compressed message is refused if compression was not negotiated,
+    # or if it is too big once decompressed
+    data = zlib.compress(bytes(1000))
+    for compression, max_size in [(False, 1000), (True, 999)]:
+        excepted = False
+        try:
+            _decode_payload(FLAG_ZLIB, data, compression, max_size)
+        except ProtocolError:
+            excepted = True
+        assert(excepted)
+    assert(_decode_payload(FLAG_ZLIB, data, True, 1000) == bytes(1000))
+
+def _run_server(mode=None):
     import cfg
     cfg.init()
 
-    dbtype = cfg.config().get("LOCALBBSERVER", "db")
-    host = cfg.config().get("LOCALBBSERVER", "host")
-    port = int(cfg.config().get("LOCALBBSERVER", "port"))
-    verbose = int(cfg.config().get("LOCALBBSERVER", "verbose"))
-    connection,instance = db._create_db(dbtype, cfg.config()[dbtype.upper()])
-    _start_server(instance, host, port, verbose)
-
-def start_tests(args):
+    lcfg = cfg.config()["LOCALBBSERVER"]
+    dbtype = lcfg.get("db")
+    host = lcfg.get("host")
+    port = int(lcfg.get("port"))
+    verbose = int(lcfg.get("verbose"))
+    db.bom_cache_max_nodes = int(cfg.config()["BOMBROWSER"].get(
+        "bom_cache_size", str(db.bom_cache_max_nodes)))
+    db.bom_cache_max_age = int(cfg.config()["BOMBROWSER"].get(
+        "bom_cache_max_age", str(db.bom_cache_max_age)))
+    cache_size = int(lcfg.get("cache_size_mb", "64")) * 1024 * 1024
+    cache_max_age = int(lcfg.get("cache_max_age", "60"))
+    if mode is None:
+        mode = lcfg.get("mode", "threaded")
+
+    dbcfg = dict(cfg.config()[dbtype.upper()])
+    if mode == "asyncio":
+        def db_factory():
+            connection, instance = db._create_db(dbtype, dict(dbcfg))
+            return instance
+        _start_async_server(db_factory, host, port, verbose,
+            cache_size=cache_size, cache_max_age=cache_max_age,
+            workers=int(lcfg.get("workers", "4")),
+            queue_depth=int(lcfg.get("queue_depth", "64")))
+    elif mode == "threaded":
+        connection,instance = db._create_db(dbtype, dbcfg)
+        _start_server(instance, host, port, verbose, cache_size=cache_size,
+            cache_max_age=cache_max_age)
+    else:
+        raise Exception("Unknown server mode '%s'"%(mode))
+
+def start_tests(args, mode=None):
     import test_db
     import threading
-    server = threading.Thread(target=_run_server, args=())
+    server = threading.Thread(target=_run_server, args=(mode,))
     server.start()
     try:
         time.sleep(0.5)
@@ -696,11 +1378,136 @@ def start_tests(args):
             _server_istance.shutdown()
         server.join()
 
+def _bench_recv_frame_old(sock):
+    # the framing used before the recv_into() one, kept for comparison
+    header = bytes([])
+    while len(header) != _frame_header_size:
+        d = sock.recv(_frame_header_size - len(header))
+        if len(d) == 0:
+            time.sleep(0.1)
+            continue
+        header += d
+    ver, _, _, datasize = struct.unpack(_frame_format, header)
+
+    data = bytes([])
+    while datasize > 0:
+        d = sock.recv(4096)
+        if len(d) == 0:
+            time.sleep(0.1)
+            continue
+        datasize -= len(d)
+        data += d
+    return data
+
+def bench_framing(sizes=[1024, 64*1024, 1024*1024, 10*1024*1024]):
+    # the old framing is quadratic: keep the total size low
+    for size in sizes:
+        payload = bytes(size)
+        loops = max(1, min(100, 50*1024*1024 // size))
+        new_recv_frame = lambda s: _recv_frame(s, max_reply_size)[1]
+        for name, recv_frame in [("old", _bench_recv_frame_old),
+                                 ("new", new_recv_frame)]:
+            s1, s2 = socket.socketpair()
+            _set_socket_buffers(s1)
+            _set_socket_buffers(s2)
+
+            # the old framing may read past the end of a message, so wait
+            # an ack before sending the next one (as a request/reply does)
+            def sender():
+                for i in range(loops):
+                    _send_frame(s1, payload)
+                    s1.recv(1)
+
+            t = threading.Thread(target=sender)
+            time0 = time.time()
+            t.start()
+            for i in range(loops):
+                data = recv_frame(s2)
+                assert(len(data) == size)
+                s2.sendall(b"k")
+            dt = time.time() - time0
+            t.join()
+            s1.close()
+            s2.close()
+
+            print("%s: size=%9d loops=%3d %8.3f sec %8.1f MB/s"%(
+                name, size, loops, dt, size * loops / dt / 1024 / 1024))
+
+def _load_test_client(host, port, seconds, code_ids, counts, idx):
+    import random
+    r = RemoteSQLClient(host, port)
+    r.remote_server_do_auth("foo", "bar")
+    rnd = random.Random(idx)
+    cnt = 0
+    time_end = time.time() + seconds
+    while time.time() < time_end:
+        code_id = rnd.choice(code_ids)
+        dates = r.get_dates_by_code_id3(code_id)
+        r.get_code_by_rid(dates[0][4])
+        cnt += 2
+    counts[idx] = cnt
+
+def load_test(clients=20, seconds=10, idle=200, modes=["threaded", "asyncio"]):
+    # start the server (as configured in the LOCALBBSERVER section of
+    # bombrowser.ini, in the current directory) in a child process for
+    # each mode, and measure the requests/s done by 'clients' busy clients
+    # while 'idle' other clients are connected
+    import cfg, subprocess
+    cfg.init()
+    host = cfg.config()["LOCALBBSERVER"]["host"]
+    port = int(cfg.config()["LOCALBBSERVER"]["port"])
+
+    for mode in modes:
+        server = subprocess.Popen([sys.executable, __file__,
+                                   "--server", mode])
+        try:
+            for i in range(100):
+                try:
+                    r = RemoteSQLClient(host, port)
+                    r.remote_server_do_auth("foo", "bar")
+                    break
+                except ConnectionError:
+                    time.sleep(0.1)
+
+            code_ids = [x[0] for x in
+                r.get_codes_by_like_code_and_descr('%', '')]
+            assert(len(code_ids) > 0)
+
+            idles = []
+            for i in range(idle):
+                c = RemoteSQLClient(host, port)
+                c.remote_server_do_auth("foo", "bar")
+                idles.append(c)
+
+            counts = [0] * clients
+            threads = [threading.Thread(target=_load_test_client,
+                    args=(host, port, seconds, code_ids, counts, i))
+                for i in range(clients)]
+            time0 = time.time()
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            dt = time.time() - time0
+
+            print("%-8s: clients=%d idle=%d requests=%d %.1f req/s"%(
+                mode, clients, idle, sum(counts), sum(counts) / dt))
+            print("          ", r.remote_server_get_info())
+        finally:
+            server.terminate()
+            server.wait()
+
 def main():
     if len(sys.argv) > 1 and sys.argv[1] == "--client-test":
         start_tests(sys.argv[2:])
+    elif len(sys.argv) > 1 and sys.argv[1] == "--client-test-asyncio":
+        start_tests(sys.argv[2:], "asyncio")
+    elif len(sys.argv) > 1 and sys.argv[1] == "--bench-framing":
+        bench_framing()
+    elif len(sys.argv) > 1 and sys.argv[1] == "--load-test":
+        load_test(*[int(x) for x in sys.argv[2:5]])
     elif len(sys.argv) > 1 and sys.argv[1] == "--server":
-        _run_server()
+        _run_server(*sys.argv[2:3])
 
 if __name__ == "__main__":
     main()
@@ -33,12 +33,20 @@ def main(args):
         import importer
         import test_db
         import bbserver
+        import bomdiff
 
-        for m in ["exporter", "importer", "test_db", "utils", "db"]:
+        for m in ["exporter", "importer", "test_db", "utils", "db",
+                  "bomdiff"]:
             test_db.run_test(sys.argv[2:], sys.modules[m], m)
         bbserver.start_tests(sys.argv[2:])
         return
 
+    if len(args) > 1 and args[1] == "--diff":
+        # headless: no QApplication is needed
+        import bomdiff
+
+        bomdiff.main("bombrowser --diff", args[2:])
+        return
 
     app = QApplication(sys.argv)
 
@@ -70,6 +78,11 @@ def main(args):
     f.setPointSize(f.pointSize() * fontscale)
     app.setFont(f)
 
+    db.bom_cache_max_nodes = int(cfg.config()["BOMBROWSER"].get(
+        "bom_cache_size", str(db.bom_cache_max_nodes)))
+    db.bom_cache_max_age = int(cfg.config()["BOMBROWSER"].get(
+        "bom_cache_max_age", str(db.bom_cache_max_age)))
+
     try:
         dbtype = cfg.config()["BOMBROWSER"]["db"]
         c = cfg.config()[dbtype.upper()]
@@ -119,6 +132,7 @@ def main(args):
             print("bombrowser --showassembly <code>")
             print("bombrowser --editcode <code>")
             print("bombrowser --manage-db <...>")
+            print("bombrowser --diff <...>")
             print("bombrowser --self-test")
             sys.exit(0)
 
@@ -140,4 +154,6 @@ def main(args):
 
     sys.exit(app.exec_())
 
-main(sys.argv)
+# the worker processes of '--diff' may import this module
+if __name__ == "__main__":
+    main(sys.argv)
@@ -0,0 +1,704 @@
+"""
+BOM Browser - tool to browse a bom
+Copyright (C) 2020,2021,2022,2023,2024 Goffredo Baroncelli <kreijack@inwind.it>
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation; either version 2
+of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; if not, write to the Free Software
+Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+"""
+
+import sys, json
+
+import db
+
+# the keys of a code which are not compared
+item_props_blacklist = set(["id", "rid", "deps",
+    "date_from_days", "date_to_days"])
+
+# the keys compared in the 'minimal' mode
+minimal_keys = ["qty", "descr", "code", "ver"]
+
+children_keys = ["qty", "each", "unit", "ref"]
+
+def _code_info(node):
+    ret = {"code": node["code"]}
+    for k in ["ver", "descr"]:
+        if k in node:
+            ret[k] = node[k]
+    return ret
+
+def _child_info(child_dep, child_data):
+    ret = _code_info(child_data)
+    for k in children_keys:
+        ret[k] = child_dep[k]
+    return ret
+
+def _subtree_hashes(data, allowed_keys):
+    # the hash of a code covers its properties, the links to its children
+    # and the hashes of the children: two codes with the same hash have
+    # the same sub-tree. The codes involved in a loop (and their parents)
+    # don't have a hash.
+    # The hashes are compared only between the same key of the two boms,
+    # so a 64 bit hash is enough
+    hashes = dict()
+    ekeys = [k for k in children_keys
+                if not allowed_keys or k in allowed_keys]
+
+    def node_hash(n):
+        node = data[n]
+        props = tuple((k, node[k]) for k in sorted(node)
+            if not k in item_props_blacklist and
+                (not allowed_keys or k in allowed_keys))
+
+        deps = node["deps"]
+        children = []
+        for c in sorted(deps):
+            hc = hashes.get(c)
+            if hc is None:
+                return None
+            dep = deps[c]
+            children.append((c, tuple(dep[k] for k in ekeys), hc))
+
+        try:
+            return hash((props, tuple(children)))
+        except TypeError:
+            # an unhashable property value
+            return hash(repr((props, children)))
+
+    for root in data:
+        if root in hashes:
+            continue
+        onstack = set([root])
+        stack = [(root, iter(data[root]["deps"]))]
+        while len(stack):
+            n, it = stack[-1]
+            for c in it:
+                if c in hashes or c in onstack or not c in data:
+                    continue
+                onstack.add(c)
+                stack.append((c, iter(data[c]["deps"])))
+                break
+            else:
+                stack.pop()
+                onstack.remove(n)
+                hashes[n] = node_hash(n)
+
+    return hashes
+
+def _same_head(code1, data1, code2, data2):
+    # put the head of boms to the same key to ensure to compare the
+    # "same" head; the boms passed are not changed
+    if code1 == code2:
+        return code1, data1, data2
+
+    data1 = data1.copy()
+    data2 = data2.copy()
+
+    # check that both the bom have the same key (str/str or int/int)
+    assert( isinstance(list(data1.keys())[0], str) ==
+           isinstance(list(data2.keys())[0], str))
+
+    # create a code that is not shared between the two bom
+    if isinstance(list(data1.keys())[0], str):
+        code3 = "private-code-"
+        while code3 in data1.keys() or code3 in data2.keys():
+            code3 += "x"
+    else:
+        code3 = 9999999999
+        while code3 in data1.keys() or code3 in data2.keys():
+            code3 *= 9999
+
+    for (code, data) in [(code1, data1), (code2, data2)]:
+        node = dict(data.pop(code))
+        node["id"] = code3
+        data[code3] = node
+
+        # unlikely, but check that the boms don't have any reference
+        # to the removed code1/code2
+        for k in [k for (k, v) in data.items() if code in v["deps"]]:
+            v = dict(data[k])
+            deps = dict(v["deps"])
+            deps[code3] = deps.pop(code)
+            v["deps"] = deps
+            data[k] = v
+
+    return code3, data1, data2
+
+def _get_hashes(data, allowed_keys, hashes_cache):
+    if hashes_cache is None:
+        return _subtree_hashes(data, allowed_keys)
+
+    # keep a reference to data, so its id() cannot be reused
+    k = (id(data), allowed_keys is None)
+    if not k in hashes_cache or not hashes_cache[k][0] is data:
+        hashes_cache[k] = (data, _subtree_hashes(data, allowed_keys))
+    return hashes_cache[k][1]
+
+def diff_boms(code1, data1, code2, data2, only_top_code=False,
+                minimal=False, only_shared=False, gvalnames=[],
+                hashes_cache=None):
+    """
+        Compare the bom (code1, data1) with (code2, data2); return the list
+        of the changes sorted by code key. Each change is a dict:
+
+        {"type": "removed", "key": .., "code": .., "ver": .., "descr": ..}
+        {"type": "added", ..., "props": [{"name": .., "value": ..}],
+                "children": [{"type": "added", "key": .., "to": child}]}
+        {"type": "changed", ..., "props": [{"name": .., "from": .., "to": ..}],
+                "children": [{"type": .., "key": .., "from": .., "to": ..}]}
+
+        where the type of a changed child is "added", "removed",
+        "qty_changed" or "changed", and 'child' is a dict with the code,
+        ver, descr of the child and the qty, each, unit, ref of the link.
+        "from"/"to" are missing when the value is not in the bom.
+        The "ver"/"descr" of a code are present only if they are in the bom.
+
+        The sub-trees with the same hash in both the boms are skipped.
+        'gvalnames' is the list of the gval names in the display order.
+        'hashes_cache' is a dict where the hashes of the last boms compared
+        are kept between the calls; the boms must not be changed in the
+        meantime.
+    """
+    if minimal:
+        allowed_keys = minimal_keys
+    else:
+        allowed_keys = None
+
+    if not hashes_cache is None:
+        # drop the hashes of the boms no more compared
+        for k in [k for (k, v) in hashes_cache.items()
+                    if not v[0] is data1 and not v[0] is data2]:
+            hashes_cache.pop(k)
+
+    if not only_top_code:
+        hashes1 = _get_hashes(data1, allowed_keys, hashes_cache)
+        hashes2 = _get_hashes(data2, allowed_keys, hashes_cache)
+
+    code3, data1, data2 = _same_head(code1, data1, code2, data2)
+    if code3 != code1 and not only_top_code:
+        # the codes which refer to the head are in a loop, so only the
+        # head hash has to be moved
+        hashes1 = hashes1.copy()
+        hashes1[code3] = hashes1.pop(code1)
+        hashes2 = hashes2.copy()
+        hashes2[code3] = hashes2.pop(code2)
+
+    def is_children_equal(c1, c2):
+        for k in children_keys:
+            if allowed_keys and not k in allowed_keys:
+                continue
+            if c1[k] != c2[k]:
+                return False
+
+        return True
+
+    def is_codes_equal(c1, c2):
+        k1 = set(c1.keys())
+        k2 = set(c2.keys())
+        if only_shared:
+            k3 = k1.intersection(k2)
+            k1 = k3
+            k2 = k3
+        if allowed_keys:
+            k1 = k1.intersection(allowed_keys)
+            k2 = k2.intersection(allowed_keys)
+        if k1 != k2:
+            return False
+
+        k1.difference_update(item_props_blacklist)
+        for k in k1:
+            if c1[k] != c2[k]:
+                return False
+
+        if c1["deps"].keys() != c2["deps"].keys():
+            return False
+
+        for k in c1["deps"].keys():
+            if not is_children_equal(c1["deps"][k], c2["deps"][k]):
+                return False
+
+        return True
+
+    def sorted_props(keys, gvals_order=True):
+        keys = set(keys)
+        keys.difference_update(item_props_blacklist)
+        keys = sorted(keys)
+        if gvals_order:
+            keys = [x for x in keys if not x.startswith("gval")]
+            keys = keys + list(gvalnames)
+        if allowed_keys:
+            keys = [ x for x in keys if x in allowed_keys]
+        return keys
+
+    def changed(key, n1, n2):
+        ret = {"type": "changed", "key": key, "props": [], "children": []}
+        ret.update(_code_info(n1))
+
+        if only_shared:
+            keys = set(n1.keys()).intersection(n2.keys())
+        else:
+            keys = set(n1.keys()).union(n2.keys())
+        for key2 in sorted_props(keys, not only_shared):
+            if key2 in n1 and key2 in n2 and n1[key2] == n2[key2]:
+                continue
+            p = {"name": key2}
+            if key2 in n1:
+                p["from"] = n1[key2]
+            if key2 in n2:
+                p["to"] = n2[key2]
+            if len(p) > 1:
+                ret["props"].append(p)
+
+        deps1 = n1["deps"]
+        deps2 = n2["deps"]
+        for child_id in sorted(set(deps1.keys()).union(deps2.keys())):
+            c = {"key": child_id}
+            if child_id in deps1:
+                c["from"] = _child_info(deps1[child_id], data1[child_id])
+            if child_id in deps2:
+                c["to"] = _child_info(deps2[child_id], data2[child_id])
+
+            if not "from" in c:
+                c["type"] = "added"
+            elif not "to" in c:
+                c["type"] = "removed"
+            elif is_children_equal(deps1[child_id], deps2[child_id]):
+                continue
+            elif (c["from"]["unit"] == c["to"]["unit"] and
+                    c["from"]["ref"] == c["to"]["ref"]):
+                c["type"] = "qty_changed"
+            else:
+                c["type"] = "changed"
+            ret["children"].append(c)
+
+        return ret
+
+    def added(key, n2):
+        ret = {"type": "added", "key": key, "props": [], "children": []}
+        ret.update(_code_info(n2))
+        for key2 in sorted_props(n2.keys()):
+            if key2 in n2:
+                ret["props"].append({"name": key2, "value": n2[key2]})
+        deps = n2["deps"]
+        for child_id in sorted(deps.keys()):
+            ret["children"].append({"type": "added", "key": child_id,
+                "to": _child_info(deps[child_id], data2[child_id])})
+        return ret
+
+    def removed(key, n1):
+        ret = {"type": "removed", "key": key}
+        ret.update(_code_info(n1))
+        return ret
+
+    def reachable(data):
+        ret = set([code3])
+        todo = [code3]
+        while len(todo):
+            for c in data[todo.pop()]["deps"]:
+                if not c in ret:
+                    ret.add(c)
+                    todo.append(c)
+        return ret
+
+    if only_top_code:
+        todo = [code3]
+    else:
+        # the codes not reachable from the head (e.g. an imported bom)
+        # are visited after the head ones
+        todo = list(set(data1.keys()).union(data2.keys()).difference(
+            reachable(data1), reachable(data2)))
+        todo.append(code3)
+
+    ret = []
+    done = set()
+    while len(todo):
+        key = todo.pop()
+        if key in done:
+            continue
+        done.add(key)
+
+        if key in data1 and key in data2:
+            n1 = data1[key]
+            n2 = data2[key]
+            if not only_top_code:
+                h = hashes1[key]
+                if not h is None and h == hashes2[key]:
+                    # the same sub-tree: skip it
+                    continue
+            if not is_codes_equal(n1, n2):
+                ret.append(changed(key, n1, n2))
+            children = set(n1["deps"].keys()).union(n2["deps"].keys())
+        elif key in data1:
+            ret.append(removed(key, data1[key]))
+            children = data1[key]["deps"].keys()
+        else:
+            ret.append(added(key, data2[key]))
+            children = data2[key]["deps"].keys()
+
+        if not only_top_code:
+            todo.extend(c for c in children if not c in done)
+
+    ret.sort(key=lambda x : x["key"])
+    return ret
+
+def parse_code_date(spec):
+    """
+        Split "<code>[@<date>]" in (code, date); date is "LATEST" (the
+        default), "PROTOTYPE" or "YYYY-MM-DD"
+    """
+    if not "@" in spec:
+        return spec, "LATEST"
+    code, date = spec.rsplit("@", 1)
+    date = date.upper()
+    if date == "":
+        date = "LATEST"
+    return code, date
+
+def _get_date_days(d, code_id, date):
+    if date == "LATEST":
+        # like asmgui.show_latest_assembly(): get the prototype date
+        # ONLY if there is the only option
+        dates = d.get_dates_by_code_id3(code_id)
+        if dates[0][2] >= db.prototype_date:
+            if len(dates) > 1:
+                return min(db.prototype_date - 1, dates[1][3])
+            return db.prototype_date
+        return min(db.prototype_date - 1, dates[0][3])
+    elif date == "PROTOTYPE":
+        dates = d.get_dates_by_code_id3(code_id)
+        return dates[0][3]
+    else:
+        return db.iso_to_days(date)
+
+def _load_bom(d, code, date):
+    import utils
+
+    codes = d.get_codes_by_code(code)
+    if not codes:
+        raise Exception("Cannot find the code '%s'"%(code))
+    code_id = codes[0][0]
+    top, data = d.get_bom_by_code_id3(code_id,
+        _get_date_days(d, code_id, date))
+    utils.add_drawings_to_bom(data)
+    return top, data
+
+def diff_pair(spec1, spec2, options):
+    """
+        Compare the boms of spec1 and spec2 ("<code>[@<date>]"); options
+        is a dict with the diff_boms() arguments. Return the report:
+
+        {"from": {"code": .., "date": ..}, "to": {..}, "changes": [..]}
+
+        or {"from": .., "to": .., "error": "<message>"} in case of error
+    """
+    code1, date1 = parse_code_date(spec1)
+    code2, date2 = parse_code_date(spec2)
+    ret = {"from": {"code": code1, "date": date1},
+           "to": {"code": code2, "date": date2}}
+    try:
+        d = db.get_db_instance()
+        code1, data1 = _load_bom(d, code1, date1)
+        code2, data2 = _load_bom(d, code2, date2)
+        ret["changes"] = diff_boms(code1, data1, code2, data2, **options)
+    except Exception as e:
+        ret["error"] = str(e)
+    return ret
+
+def _init_db():
+    import cfg
+
+    cfg.init()
+    dbtype = cfg.config()["BOMBROWSER"]["db"]
+    conf = cfg.config()[dbtype.upper()]
+    db.init(dbtype, dict(conf))
+    db.get_db_instance().update_gavals_gvals_count_by_db()
+
+def _diff_pair_job(args):
+    return diff_pair(*args)
+
+def _read_pairs(fn):
+    ret = []
+    with open(fn) as f:
+        for line in f:
+            line = line.strip()
+            if line == "" or line.startswith("#"):
+                continue
+            l = line.split()
+            if len(l) != 2:
+                raise Exception("Invalid line '%s' in '%s'"%(line, fn))
+            ret.append(tuple(l))
+    return ret
+
+def run_diffs(pairs, options, out, jobs=1):
+    """
+        Compare each pair of specs and write a json report per line in
+        'out', in the order of 'pairs'. Up to 'jobs' pairs are compared
+        in parallel by different processes. Return the list of
+        (nr. of changes or None in case of error)
+    """
+    args_list = [(spec1, spec2, options) for (spec1, spec2) in pairs]
+    if jobs <= 1 or len(args_list) <= 1:
+        _init_db()
+        reports = map(_diff_pair_job, args_list)
+        ex = None
+    else:
+        import concurrent.futures
+        ex = concurrent.futures.ProcessPoolExecutor(
+            max_workers=min(jobs, len(args_list)), initializer=_init_db)
+        reports = ex.map(_diff_pair_job, args_list)
+
+    ret = []
+    try:
+        for report in reports:
+            out.write(json.dumps(report, default=str) + "\n")
+            out.flush()
+            if "error" in report:
+                ret.append(None)
+            else:
+                ret.append(len(report["changes"]))
+    finally:
+        if not ex is None:
+            ex.shutdown()
+
+    return ret
+
+def main(prgname, args):
+    """
+        Headless diff; the exit code is 0 if the boms are equal, 1 if
+        there are differences and 2 in case of errors
+    """
+    import cfg
+
+    options = {"only_top_code": False, "minimal": False,
+                "only_shared": False}
+    jobs = 1
+    output = None
+    pairs = []
+    specs = []
+
+    i = 0
+    while i < len(args):
+        if args[i] == "--only-top-code":
+            options["only_top_code"] = True
+        elif args[i] == "--minimal":
+            options["minimal"] = True
+        elif args[i] == "--only-shared":
+            options["only_shared"] = True
+        elif args[i] == "--jobs" and i + 1 < len(args):
+            i += 1
+            jobs = int(args[i])
+        elif args[i] == "--output" and i + 1 < len(args):
+            i += 1
+            output = args[i]
+        elif args[i] == "--pairs" and i + 1 < len(args):
+            i += 1
+            pairs += _read_pairs(args[i])
+        elif args[i].startswith("-"):
+            specs = None
+            break
+        else:
+            specs.append(args[i])
+        i += 1
+
+    if specs is None or len(specs) % 2 != 0 or len(specs) + len(pairs) == 0:
+        print("usage: %s [--only-top-code] [--minimal] [--only-shared] [--jobs N] [--output <file>] <code>[@<date>] <code>[@<date>] [...]"%(prgname))
+        print("usage: %s [--only-top-code] [--minimal] [--only-shared] [--jobs N] [--output <file>] --pairs <file>"%(prgname))
+        print("    <date> may be YYYY-MM-DD, LATEST (the default) or PROTOTYPE")
+        print("    each line of the '--pairs' file contains two <code>[@<date>]")
+        sys.exit(2)
+
+    pairs = [(specs[i], specs[i+1]) for i in range(0, len(specs), 2)] + pairs
+
+    cfg.init()
+    options["gvalnames"] = [gvalname
+        for (seq, idx, gvalname, caption, type_) in cfg.get_gvalnames2()]
+
+    if output is None:
+        ret = run_diffs(pairs, options, sys.stdout, jobs)
+    else:
+        with open(output, "w") as f:
+            ret = run_diffs(pairs, options, f, jobs)
+
+    errors = len([x for x in ret if x is None])
+    changed = len([x for x in ret if x])
+    print("%d pair(s) compared, %d with differences, %d error(s)"%(
+        len(ret), changed, errors), file=sys.stderr)
+
+    if errors:
+        sys.exit(2)
+    elif changed:
+        sys.exit(1)
+    sys.exit(0)
+
+def _test_bom(edges, props={}):
+    data = dict()
+    for (parent, child, qty) in edges:
+        for k in [parent, child]:
+            if not k in data:
+                data[k] = {"id": k, "code": k, "descr": "descr " + k,
+                    "ver": "0", "deps": dict()}
+        data[parent]["deps"][child] = {"code_id": child, "qty": qty,
+            "each": 1, "unit": "NR", "ref": ""}
+    for k, v in props.items():
+        data[k].update(v)
+    return data
+
+def test_diff_boms_equal():
+    data1 = _test_bom([("A", "B", 1), ("B", "C", 2), ("A", "D", 3)])
+    data2 = _test_bom([("A", "B", 1), ("B", "C", 2), ("A", "D", 3)])
+    assert(diff_boms("A", data1, "A", data2) == [])
+
+    hashes1 = _subtree_hashes(data1, None)
+    hashes2 = _subtree_hashes(data2, None)
+    assert(hashes1 == hashes2)
+
+def test_diff_boms_changes():
+    data1 = _test_bom([("A", "B", 1), ("B", "C", 2), ("A", "D", 3)])
+    data2 = _test_bom([("A", "B", 1), ("B", "C", 4), ("A", "E", 3)],
+                      {"B": {"descr": "new descr"}})
+    ret = diff_boms("A", data1, "A", data2)
+    assert([(x["type"], x["key"]) for x in ret] ==
+        [("changed", "A"), ("changed", "B"), ("removed", "D"),
+         ("added", "E")])
+
+    a = ret[0]
+    assert(a["props"] == [])
+    assert([(x["type"], x["key"]) for x in a["children"]] ==
+        [("removed", "D"), ("added", "E")])
+
+    b = ret[1]
+    assert(b["props"] == [{"name": "descr", "from": "descr B",
+        "to": "new descr"}])
+    assert(len(b["children"]) == 1)
+    c = b["children"][0]
+    assert(c["type"] == "qty_changed")
+    assert(c["from"]["qty"] == 2 and c["to"]["qty"] == 4)
+    assert(c["to"]["code"] == "C")
+
+    e = ret[3]
+    assert({"name": "descr", "value": "descr E"} in e["props"])
+    assert(e["children"] == [])
+
+def test_diff_boms_options():
+    data1 = _test_bom([("A", "B", 1)], {"B": {"gval1": "x", "foo": 1}})
+    data2 = _test_bom([("A", "B", 1)], {"B": {"gval1": "y"}})
+
+    ret = diff_boms("A", data1, "A", data2, gvalnames=["gval1"])
+    assert(ret[0]["props"] == [{"name": "foo", "from": 1},
+        {"name": "gval1", "from": "x", "to": "y"}])
+
+    ret = diff_boms("A", data1, "A", data2, only_shared=True)
+    assert(ret[0]["props"] == [{"name": "gval1", "from": "x", "to": "y"}])
+
+    assert(diff_boms("A", data1, "A", data2, minimal=True) == [])
+    assert(diff_boms("A", data1, "A", data2, only_top_code=True) == [])
+
+def test_diff_boms_different_heads():
+    data1 = _test_bom([("A", "B", 1)])
+    data2 = _test_bom([("X", "B", 2)])
+    ret = diff_boms("A", data1, "X", data2)
+    assert(len(ret) == 1)
+    assert(ret[0]["type"] == "changed")
+    assert(ret[0]["props"][0]["name"] == "code")
+    assert(ret[0]["children"][0]["type"] == "qty_changed")
+
+    # the boms passed are not changed
+    assert("A" in data1 and data1["A"]["id"] == "A")
+    assert("X" in data2 and data2["X"]["id"] == "X")
+
+def test_diff_boms_skip_subtree():
+    class Value:
+        count = 0
+        def __eq__(self, other):
+            Value.count += 1
+            return True
+        def __repr__(self):
+            return "value"
+
+    edges = [("A", "B", 1)] + [("B", "C%d"%(i), 1) for i in range(100)]
+    props = dict(("C%d"%(i), {"foo": Value()}) for i in range(100))
+    data1 = _test_bom(edges + [("A", "D", 1)], props)
+    data2 = _test_bom(edges + [("A", "D", 2)], props)
+
+    hashes1 = _subtree_hashes(data1, None)
+    hashes2 = _subtree_hashes(data2, None)
+    assert(hashes1["B"] == hashes2["B"])
+    assert(hashes1["A"] != hashes2["A"])
+
+    # the codes under B are never compared
+    ret = diff_boms("A", data1, "A", data2)
+    assert(Value.count == 0)
+    assert(len(ret) == 1 and ret[0]["key"] == "A")
+
+def test_diff_boms_hashes_cache():
+    data1 = _test_bom([("A", "B", 1), ("B", "C", 2)])
+    data2 = _test_bom([("X", "B", 1), ("B", "C", 3)])
+    cache = dict()
+    ret = diff_boms("A", data1, "X", data2, hashes_cache=cache)
+    assert(len(cache) == 2)
+    assert(diff_boms("A", data1, "X", data2, hashes_cache=cache) == ret)
+    ret2 = diff_boms("X", data2, "A", data1, hashes_cache=cache)
+    assert([x["key"] for x in ret2] == [x["key"] for x in ret])
+    b = [x for x in ret2 if x["key"] == "B"][0]
+    assert(b["children"][0]["from"]["qty"] == 3)
+    assert(diff_boms("A", data1, "X", data2, minimal=True,
+        hashes_cache=cache) == diff_boms("A", data1, "X", data2, minimal=True))
+    assert(len(cache) == 4)
+
+    # a new bom replaces the old one
+    data3 = _test_bom([("A", "B", 1), ("B", "C", 2)])
+    assert(diff_boms("A", data1, "A", data3, hashes_cache=cache) == [])
+    assert(len(cache) == 3)
+    assert(all(not v[0] is data2 for v in cache.values()))
+
+def test_diff_boms_loop():
+    data1 = _test_bom([("A", "B", 1), ("B", "C", 1), ("C", "B", 1)])
+    data2 = _test_bom([("A", "B", 1), ("B", "C", 1), ("C", "B", 2)])
+    hashes1 = _subtree_hashes(data1, None)
+    assert(hashes1["A"] is None and hashes1["B"] is None)
+    ret = diff_boms("A", data1, "A", data2)
+    assert([x["key"] for x in ret] == ["C"])
+
+def test_parse_code_date():
+    assert(parse_code_date("A") == ("A", "LATEST"))
+    assert(parse_code_date("A@") == ("A", "LATEST"))
+    assert(parse_code_date("A@prototype") == ("A", "PROTOTYPE"))
+    assert(parse_code_date("A@2020-01-10") == ("A", "2020-01-10"))
+    assert(parse_code_date("A@B@2020-01-10") == ("A@B", "2020-01-10"))
+
+def test_diff_pair():
+    import test_db
+
+    d = test_db._init_db()
+    with db.Transaction(d) as c:
+        test_db._test_insert_assembly(c)
+
+    ret = diff_pair("O@2020-01-15", "O@2020-01-25", dict())
+    assert(ret["from"] == {"code": "O", "date": "2020-01-15"})
+    assert(ret["to"] == {"code": "O", "date": "2020-01-25"})
+    assert(dict((x["code"], x["type"]) for x in ret["changes"]) == {
+        "A": "changed", "B": "changed", "C": "changed",
+        "E": "removed", "G": "removed", "H": "removed",
+        "D": "added", "L": "added", "M": "added"})
+    json.dumps(ret)
+
+    ret = diff_pair("O@2020-01-25", "O", dict(minimal=True))
+    assert(ret["changes"] == [])
+
+    ret = diff_pair("O@2020-01-25", "O@2020-01-25", dict(only_top_code=True))
+    assert(ret["changes"] == [])
+
+    ret = diff_pair("O", "NOT-EXISTENT-CODE", dict())
+    assert(not "changes" in ret)
+    assert("NOT-EXISTENT-CODE" in ret["error"])
+
@@ -204,6 +204,8 @@ def _check_cfg(cfg):
                 ('list_code_default_mode', True),
                 ('after_copy_set_values_to', False),
                 ('after_revise_set_values_to', False),
+                ('bom_cache_size', False),
+                ('bom_cache_max_age', False),
         )),
         ('FILES_UPLOAD', (
                 ('method', True),
@@ -236,12 +238,18 @@ def _check_cfg(cfg):
                 ('port', True),
                 ('username', True),
                 ('password', True),
+                ('compression', False),
         )),
         ('LOCALBBSERVER', (
                 ('db', True),
                 ('host', True),
                 ('port', True),
                 ('verbose', True),
+                ('cache_size_mb', False),
+                ('cache_max_age', False),
+                ('mode', False),
+                ('workers', False),
+                ('queue_depth', False),
         )),
         ('LOGGER', (
             ("filename", True),
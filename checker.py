@@ -52,27 +52,14 @@ class ShowResult(bbwindow.BBMainWindow):
 
 def loop_check(root, data):
 
-    local = { "path": [],
-             "res": "" }
-
-    def iterate(n):
-
-        if n in local["path"]:
-            local["res"] += "<font color=red>ERROR</font color=red>"
-            local["res"] += "&nbsp;Loop detect:&nbsp;"
-
-            i = local["path"].index(n)
-            local["res"] += ",&nbsp;".join([data[k]["code"] for k in local["path"][i:] + [n]])
-            local["res"] += "<br>\n"
-            return
-        local["path"].append(n)
-        for child in data[n]["deps"]:
-            iterate(child)
-        local["path"] = local["path"][:-1]
-
-    iterate(root)
-
-    return local["res"]
+    res = ""
+    for loop in utils.find_loops(root, data):
+        res += "<font color=red>ERROR</font color=red>"
+        res += "&nbsp;Loop detect:&nbsp;"
+        res += ",&nbsp;".join([data[k]["code"] for k in loop])
+        res += "<br>\n"
+
+    return res
 
 
 def run_bom_tests(root, data, bom_descr):
@@ -86,10 +86,14 @@ class CodeWidget(QWidget):
                 self._is_a_path.add(gavalname)
 
         self._drawings_and_urls = [(x[0], utils.find_filename(x[1]))
-                for x in d.get_drawings_and_urls_by_rid(self._data["rid"])]
+                for x in self._get_drawings(self._data["rid"])]
 
         self._update_widget()
 
+    def _get_drawings(self, rid):
+        d = db.get_db_instance()
+        return d.get_drawings_by_rids([rid])[rid]
+
     def _init_gui(self):
         self._grid = QGridLayout()
         self.setLayout(self._grid)
@@ -308,6 +312,7 @@ class CodesWidget(CodeWidget):
         self._code_id = None
         self._list.currentIndexChanged.connect(self._list_change_index)
         self._ignore = True
+        self._drawings = dict()
 
     def populate(self, code_id):
         self._code_id = code_id
@@ -323,6 +328,8 @@ class CodesWidget(CodeWidget):
         self._ignore = True
         self._list.clear()
         self._dates = dates
+        # the drawings of all the revisions, shown when a date is selected
+        self._drawings = d.get_drawings_by_rids([x[4] for x in dates])
 
         for data2 in self._dates:
             (icode, idescr, idate_from_days, idate_to_days, rid) = data2[:5]
@@ -340,6 +347,11 @@ class CodesWidget(CodeWidget):
 
         self._list_change_index(0)
 
+    def _get_drawings(self, rid):
+        if rid in self._drawings:
+            return self._drawings[rid]
+        return CodeWidget._get_drawings(self, rid)
+
     def _list_change_index(self, i):
         if self._code_id is None:
             return
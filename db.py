@@ -38,6 +38,12 @@ import sys
 import datetime
 import time
 import traceback
+import threading
+import collections
+import collections.abc
+import array
+import itertools
+import uuid
 
 import jdutil
 from utils import xescape, xunescape
@@ -74,9 +80,34 @@ prototype_date = 999900
 prototype_iter = 999999
 gvals_count = 20
 gavals_count = 3
+# max number of items in a 'IN (...)' clause: SQLServer accepts up to
+# 2100 parameters, ORACLE up to 1000 items in a list
+in_clause_max_items = 500
+# bom cache: max number of nodes stored (0 disables the cache) and max age
+# of an entry in seconds (0 means no limit); the changes made by the other
+# users are detected by the 'bom_version' in database_props, the age
+# covers the ones which don't update it (e.g. older clients)
+bom_cache_max_nodes = 50000
+bom_cache_max_age = 300
+# each thread uses its own connection; these are the max number of
+# connections opened by a db instance, how much (in seconds) a thread
+# waits for a free one, and after how much idle time a connection is
+# checked before being used
+connection_pool_max_size = 16
+connection_pool_timeout = 30
+connection_check_interval = 60
+# max number of translated queries cached for each backend class
+sql_translate_cache_size = 2048
+_sql_translate_caches = dict()
+# number of rows inserted by each executemany() during a restore
+restore_batch_size = 5000
+# number of rows fetched at time by dump_table()
+dump_fetch_size = 1000
+_cursor_names = itertools.count()
 connection="Server: <UNDEF>"
 _globaDBInstance = None
-_nested_transaction = 0
+# number of Transaction opened by the current thread
+_nested_transaction = threading.local()
 
 class DBException(RuntimeError):
     pass
@@ -92,6 +123,12 @@ class Transaction:
         self._db = d
         self._cursor = None
         self._inside_context = False
+        self._at_end = []
+
+    def call_at_end(self, fn):
+        # fn() is called at the end of the transaction, after the commit
+        # or the rollback
+        self._at_end.append(fn)
 
     def begin(self):
         if not self._inside_context:
@@ -133,6 +170,14 @@ class Transaction:
             self._cursor,
             self._cursor.fetchall())
 
+    def fetchmany(self, size):
+        if not self._inside_context:
+            raise DBException("NOTINCONTEXT")
+
+        return self._db._translate_fetchall_(
+            self._cursor,
+            self._cursor.fetchmany(size))
+
     def commit(self):
         if not self._inside_context:
             raise DBException("NOTINCONTEXT")
@@ -153,35 +198,44 @@ class Transaction:
         return r
 
     def __enter__(self):
-        global _nested_transaction
-        if _nested_transaction != 0:
+        if getattr(_nested_transaction, "count", 0) != 0:
             raise DBException("ENESTEDTRANSACTION")
-        _nested_transaction += 1
 
+        # if no connection is available, the transaction is not started
+        self._db._acquire_conn()
+        _nested_transaction.count = 1
         self._inside_context = True
         return self
 
     def __exit__(self, type_, value, traceback):
-        if self._cursor:
-            if value is None:
-                self.commit()
-            else:
-                self.rollback()
+        try:
+            if self._cursor:
+                if value is None:
+                    self.commit()
+                else:
+                    self.rollback()
+        finally:
+            self._db._release_conn()
+            for fn in self._at_end:
+                fn()
+        self._at_end = []
         self._cursor = None
         self._inside_context = False
         self._db = None
 
-        global _nested_transaction
-        if _nested_transaction != 1:
+        if getattr(_nested_transaction, "count", 0) != 1:
             raise DBException("ENESTEDTRANSACTION")
-        _nested_transaction -= 1
+        _nested_transaction.count = 0
 
 
 class ROCursor:
-    def __init__(self, d):
+    def __init__(self, d, server_side=False):
+        # server_side=True asks for a cursor which doesn't transfer all
+        # the rows at execute() time (where the backend supports it)
         self._db = d
         self._cursor = None
         self._inside_context = False
+        self._server_side = server_side
 
     def _check_query(self, query):
         for w in ["INSERT", "UPDATE", "DELETE", "DROP", "CREATE"]:
@@ -193,7 +247,7 @@ class ROCursor:
             raise DBException("NOTINCONTEXT")
 
         if not self._cursor:
-            self._cursor = self._db._get_cursor()
+            self._cursor = self._db._get_cursor(self._server_side)
 
         self._check_query(query)
         r = self._db._execute(self._cursor, query, *args)
@@ -216,25 +270,541 @@ class ROCursor:
             self._cursor,
             self._cursor.fetchall())
 
+    def fetchmany(self, size):
+        if not self._inside_context:
+            raise DBException("NOTINCONTEXT")
+
+        return self._db._translate_fetchall_(
+            self._cursor,
+            self._cursor.fetchmany(size))
+
     def __enter__(self):
+        self._db._acquire_conn()
         self._inside_context = True
         return self
 
     def __exit__(self, type_, value, traceback):
         # do a rollback otherwise postgresql screws
-        if isinstance(self._db, DBPG):
-            self._db._rollback()
+        try:
+            if isinstance(self._db, DBPG) and self._db._conn:
+                self._db._rollback()
+        finally:
+            self._db._release_conn()
         self._db = None
         self._cursor = None
         self._inside_context = False
 
 
+def _copy_bom(data):
+    # the callers are free to change the returned bom, so return a copy;
+    # the nodes contain only scalar values and the 'deps' dict
+    if isinstance(data, BomData):
+        return data.copy()
+    ret = dict()
+    for k, v in data.items():
+        n = dict(v)
+        n["deps"] = {k2: dict(v2) for k2, v2 in v["deps"].items()}
+        ret[k] = n
+    return ret
+
+
+_DELETED = object()
+
+class BomData(collections.abc.MutableMapping):
+    """Compact container of the bom returned by get_bom_by_code_id3().
+
+    It behaves like the dict code_id -> node, where each node is a dict
+    and node["deps"] is a dict child code_id -> edge. Internally the
+    nodes and the edges are stored by columns (arrays for the numbers,
+    lists of interned strings for the others), and the edges of a node
+    are a contiguous range. The nodes and the edges returned are views
+    created on access; the changes made through them are stored aside,
+    so the columns are never modified.
+    """
+
+    _int_keys = ["iter", "date_from_days", "date_to_days", "id", "rid"]
+    _float_keys = ["qty", "each"]
+
+    def __init__(self, gvals_count, gavals_count):
+        self._gvals = ["gval%d"%(i+1) for i in range(gvals_count)]
+        self._gavals = ["gaval%d"%(i+1) for i in range(gavals_count)]
+        self._node_keys = (["code", "descr", "ver", "iter", "unit",
+            "date_from", "date_from_days", "date_to", "date_to_days", "id"] +
+            self._gvals + ["rid", "deps"])
+        self._edge_keys = (["code_id", "unit", "qty", "each", "iter", "ref"] +
+            self._gavals)
+
+        self._nodes = dict()
+        for k in self._node_keys:
+            if k in ["date_from", "date_to", "deps"]:
+                continue
+            self._nodes[k] = self._new_column(k)
+        self._edges = dict([(k, self._new_column(k)) for k in self._edge_keys])
+        self._first_edge = array.array("q")
+        self._edges_count = array.array("q")
+        # for each node the edges indexes sorted by child code_id
+        self._sorted_edges = array.array("q")
+
+        self._index = dict()        # code_id -> row
+        self._properties = dict()   # row -> item properties
+        self._strings = dict()      # used only during the build
+
+        # the changes made by the user of the bom
+        self._nodes_changes = dict()    # row -> { key -> value }
+        self._edges_changes = dict()    # edge -> { key -> value }
+        self._set_items = dict()        # code_id -> value
+        self._deleted = set()
+
+    def _new_column(self, k):
+        if k in self._int_keys:
+            return array.array("q")
+        if k in self._float_keys:
+            return array.array("d")
+        return []
+
+    def _append(self, columns, k, v):
+        if isinstance(v, str):
+            v = self._strings.setdefault(v, v)
+        col = columns[k]
+        if (k in self._float_keys and isinstance(col, array.array) and
+                type(v) is not float):
+            # an array("d") would return an int or a Decimal as a float:
+            # keep the value as returned by the driver
+            columns[k] = col = list(col)
+        try:
+            col.append(v)
+        except TypeError:
+            # a NULL value: fall back to a list
+            columns[k] = list(col)
+            columns[k].append(v)
+
+    def _add_node(self, values, properties):
+        row = len(self._first_edge)
+        for k, col in self._nodes.items():
+            self._append(self._nodes, k, values[k])
+        if len(properties):
+            self._properties[row] = properties
+        self._index[values["id"]] = row
+        self._first_edge.append(0)
+        self._edges_count.append(0)
+        return row
+
+    def _add_edges(self, edges):
+        # edges = [(parent_row, { key -> value }), ...]; the edges of a
+        # parent have to be added all together
+        edges = sorted(edges, key=lambda x: x[0])
+        for (parent_row, values) in edges:
+            e = len(self._sorted_edges)
+            if self._edges_count[parent_row] == 0:
+                self._first_edge[parent_row] = e
+            self._edges_count[parent_row] += 1
+            for k in self._edge_keys:
+                self._append(self._edges, k, values[k])
+            self._sorted_edges.append(e)
+
+        done = set()
+        for (parent_row, values) in edges:
+            if parent_row in done:
+                continue
+            done.add(parent_row)
+            first = self._first_edge[parent_row]
+            last = first + self._edges_count[parent_row]
+            code_ids = self._edges["code_id"]
+            self._sorted_edges[first:last] = array.array("q",
+                sorted(range(first, last), key=lambda e: code_ids[e]))
+
+    def _end_build(self):
+        self._strings = None
+
+    def _find_edge(self, row, code_id):
+        # binary search of the child code_id between the edges of row
+        lo = self._first_edge[row]
+        hi = lo + self._edges_count[row]
+        code_ids = self._edges["code_id"]
+        while lo < hi:
+            mid = (lo + hi) // 2
+            e = self._sorted_edges[mid]
+            if code_ids[e] < code_id:
+                lo = mid + 1
+            elif code_ids[e] > code_id:
+                hi = mid
+            else:
+                return e
+        return -1
+
+    def _get_node_value(self, row, k):
+        changes = self._nodes_changes.get(row)
+        if not changes is None and k in changes:
+            v = changes[k]
+            if v is _DELETED:
+                raise KeyError(k)
+            return v
+        col = self._nodes.get(k)
+        if not col is None:
+            return col[row]
+        if k == "date_from":
+            return days_to_txt(self._nodes["date_from_days"][row])
+        if k == "date_to":
+            return days_to_txt(self._nodes["date_to_days"][row])
+        if k == "deps":
+            return _BomDeps(self, row)
+        props = self._properties.get(row)
+        if not props is None and k in props:
+            return props[k]
+        raise KeyError(k)
+
+    def _get_node_keys(self, row):
+        keys = dict()
+        props = self._properties.get(row)
+        if not props is None:
+            keys.update(props)
+        keys.update(dict.fromkeys(self._node_keys))
+        changes = self._nodes_changes.get(row)
+        if not changes is None:
+            for k, v in changes.items():
+                if v is _DELETED:
+                    keys.pop(k, None)
+                else:
+                    keys[k] = None
+        return keys.keys()
+
+    def _get_changes(self, changes, idx):
+        if not idx in changes:
+            changes[idx] = dict()
+        return changes[idx]
+
+    def __getitem__(self, code_id):
+        if code_id in self._set_items:
+            return self._set_items[code_id]
+        if code_id in self._deleted:
+            raise KeyError(code_id)
+        return _BomNode(self, self._index[code_id])
+
+    def __setitem__(self, code_id, v):
+        self._set_items[code_id] = v
+        self._deleted.discard(code_id)
+
+    def __delitem__(self, code_id):
+        if not code_id in self:
+            raise KeyError(code_id)
+        self._set_items.pop(code_id, None)
+        if code_id in self._index:
+            self._deleted.add(code_id)
+
+    def __contains__(self, code_id):
+        if code_id in self._set_items:
+            return True
+        return code_id in self._index and not code_id in self._deleted
+
+    def __iter__(self):
+        for row, code_id in enumerate(self._nodes["id"]):
+            # a code_id added twice: the last one wins
+            if self._index[code_id] != row:
+                continue
+            if code_id in self._set_items or not code_id in self._deleted:
+                yield code_id
+        for code_id in self._set_items:
+            if not code_id in self._index:
+                yield code_id
+
+    def __len__(self):
+        return (len(self._index) - len(self._deleted) +
+            len([k for k in self._set_items if not k in self._index]))
+
+    def __repr__(self):
+        return repr(dict(self.items()))
+
+    def copy(self):
+        # the columns are shared, the changes are copied
+        ret = object.__new__(BomData)
+        ret.__dict__.update(self.__dict__)
+        ret._nodes_changes = dict([(k, dict(v))
+            for k, v in self._nodes_changes.items()])
+        ret._edges_changes = dict([(k, dict(v))
+            for k, v in self._edges_changes.items()])
+        ret._set_items = dict(self._set_items)
+        ret._deleted = set(self._deleted)
+        return ret
+
+    def __deepcopy__(self, memo):
+        import copy
+
+        ret = self.copy()
+        memo[id(self)] = ret
+        ret._nodes_changes = copy.deepcopy(self._nodes_changes, memo)
+        ret._edges_changes = copy.deepcopy(self._edges_changes, memo)
+        ret._set_items = copy.deepcopy(self._set_items, memo)
+        return ret
+
+
+class _BomNode(collections.abc.MutableMapping):
+    __slots__ = ("_bom", "_row")
+
+    def __init__(self, bom, row):
+        self._bom = bom
+        self._row = row
+
+    def __getitem__(self, k):
+        return self._bom._get_node_value(self._row, k)
+
+    def __setitem__(self, k, v):
+        self._bom._get_changes(self._bom._nodes_changes, self._row)[k] = v
+
+    def __delitem__(self, k):
+        self[k]
+        self[k] = _DELETED
+
+    def __iter__(self):
+        return iter(self._bom._get_node_keys(self._row))
+
+    def __len__(self):
+        return len(self._bom._get_node_keys(self._row))
+
+    def __repr__(self):
+        return repr(dict(self.items()))
+
+    def copy(self):
+        return dict(self.items())
+
+
+class _BomDeps(collections.abc.MutableMapping):
+    # the first change replaces the view with a dict stored in the node;
+    # from then on every method of the view uses that dict
+    __slots__ = ("_bom", "_row")
+
+    def __init__(self, bom, row):
+        self._bom = bom
+        self._row = row
+
+    def _get_dict(self):
+        changes = self._bom._nodes_changes.get(self._row)
+        if changes is None:
+            return None
+        d = changes.get("deps")
+        if d is _DELETED:
+            return None
+        return d
+
+    def _to_dict(self):
+        d = self._get_dict()
+        if d is None:
+            d = dict(self.items())
+            _BomNode(self._bom, self._row)["deps"] = d
+        return d
+
+    def __getitem__(self, code_id):
+        d = self._get_dict()
+        if not d is None:
+            return d[code_id]
+        e = self._bom._find_edge(self._row, code_id)
+        if e < 0:
+            raise KeyError(code_id)
+        return _BomEdge(self._bom, e)
+
+    def __setitem__(self, code_id, v):
+        self._to_dict()[code_id] = v
+
+    def __delitem__(self, code_id):
+        del self._to_dict()[code_id]
+
+    def __contains__(self, code_id):
+        d = self._get_dict()
+        if not d is None:
+            return code_id in d
+        return self._bom._find_edge(self._row, code_id) >= 0
+
+    def __iter__(self):
+        d = self._get_dict()
+        if not d is None:
+            yield from d
+            return
+        first = self._bom._first_edge[self._row]
+        code_ids = self._bom._edges["code_id"]
+        for e in range(first, first + self._bom._edges_count[self._row]):
+            yield code_ids[e]
+
+    def __len__(self):
+        d = self._get_dict()
+        if not d is None:
+            return len(d)
+        return self._bom._edges_count[self._row]
+
+    def __repr__(self):
+        return repr(dict(self.items()))
+
+    def copy(self):
+        return dict(self.items())
+
+
+class _BomEdge(collections.abc.MutableMapping):
+    __slots__ = ("_bom", "_edge")
+
+    def __init__(self, bom, edge):
+        self._bom = bom
+        self._edge = edge
+
+    def __getitem__(self, k):
+        changes = self._bom._edges_changes.get(self._edge)
+        if not changes is None and k in changes:
+            v = changes[k]
+            if v is _DELETED:
+                raise KeyError(k)
+            return v
+        return self._bom._edges[k][self._edge]
+
+    def __setitem__(self, k, v):
+        self._bom._get_changes(self._bom._edges_changes, self._edge)[k] = v
+
+    def __delitem__(self, k):
+        self[k]
+        self[k] = _DELETED
+
+    def __iter__(self):
+        keys = dict.fromkeys(self._bom._edge_keys)
+        changes = self._bom._edges_changes.get(self._edge)
+        if not changes is None:
+            for k, v in changes.items():
+                if v is _DELETED:
+                    keys.pop(k, None)
+                else:
+                    keys[k] = None
+        return iter(keys)
+
+    def __len__(self):
+        return len(list(iter(self)))
+
+    def __repr__(self):
+        return repr(dict(self.items()))
+
+    def copy(self):
+        return dict(self.items())
+
+
+class BomCache:
+    """LRU cache of the boms returned by get_bom_by_code_id3(); the size
+    is limited by the total number of nodes stored"""
+
+    def __init__(self, max_nodes, max_age):
+        self._max_nodes = max_nodes
+        self._max_age = max_age
+        self._entries = collections.OrderedDict()
+        self._nodes = 0
+        self._generation = 0
+        # the bom version of the db when the entries were stored
+        self._version = None
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+
+    def _remove(self, key):
+        (_, nodes, _, _) = self._entries.pop(key)
+        self._nodes -= nodes
+
+    def is_enabled(self):
+        return self._max_nodes > 0
+
+    def check_version(self, version):
+        # the db was changed by another process: drop everything
+        with self._lock:
+            if version != self._version:
+                self._version = version
+                self._generation += 1
+                self._entries.clear()
+                self._nodes = 0
+
+    def advance_version(self, old, new):
+        # the version was changed from 'old' to 'new' by this process,
+        # which already invalidated the boms affected
+        with self._lock:
+            if self._version == old:
+                self._version = new
+
+    def get_generation(self):
+        return self._generation
+
+    def get(self, key):
+        with self._lock:
+            if not key in self._entries:
+                self._misses += 1
+                return None
+
+            (t, _, top, data) = self._entries[key]
+            if self._max_age > 0 and time.time() - t > self._max_age:
+                self._remove(key)
+                self._misses += 1
+                return None
+
+            self._entries.move_to_end(key)
+            self._hits += 1
+
+        return (top, _copy_bom(data))
+
+    def put(self, key, top, data, generation):
+        nodes = len(data)
+        if nodes > self._max_nodes:
+            return
+        data = _copy_bom(data)
+
+        with self._lock:
+            # an invalidation happened during the bom loading
+            if generation != self._generation:
+                return
+            if key in self._entries:
+                self._remove(key)
+            while self._nodes + nodes > self._max_nodes:
+                self._remove(next(iter(self._entries)))
+            self._entries[key] = (time.time(), nodes, top, data)
+            self._nodes += nodes
+
+    def invalidate(self, code_ids):
+        with self._lock:
+            self._generation += 1
+            for key in [k for k in self._entries if k[0] in code_ids]:
+                self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._entries.clear()
+            self._nodes = 0
+
+    def is_empty(self):
+        return len(self._entries) == 0
+
+    def get_stats(self):
+        with self._lock:
+            return {
+                "hits": self._hits,
+                "misses": self._misses,
+                "entries": len(self._entries),
+                "nodes": self._nodes,
+                "max_nodes": self._max_nodes,
+            }
+
+
 class _BaseServer:
+    # the tables can be loaded concurrently by different connections
+    _parallel_load = True
+
+    # set to False for the backends which don't support
+    # 'WITH RECURSIVE ... UNION ...'
+    _has_recursive_cte = True
+
+    # query used to check that a connection is still alive
+    _ping_query = "SELECT 1"
 
     def __init__(self, path):
         self._path = path
-        self._conn = None
+        self._local = threading.local()
+        self._conn_per_thread = True
+        self._shared_conn = None
+        self._pool_cond = threading.Condition()
+        self._pool = dict()
+        self._pool_idle = []
+        self._pool_count = 0
         self._read_only = None
+        self._bom_cache = BomCache(bom_cache_max_nodes, bom_cache_max_age)
+        self._has_journal = False
 
         self._ver = "empty"
 
@@ -288,25 +858,171 @@ class _BaseServer:
     def _translate_fetchall_(self, c, x):
         return x
 
-    def _get_cursor(self):
-        if self._conn is None:
-            self._open(self._path)
-        try:
-            c = self._conn.cursor()
-        except:
+    # self._conn is the connection bound to the current thread: the
+    # backends open it in _open() and reset it to None when it is broken
+    @property
+    def _conn(self):
+        if self._conn_per_thread:
+            return getattr(self._local, "conn", None)
+        return self._shared_conn
+
+    @_conn.setter
+    def _conn(self, conn):
+        if not self._conn_per_thread:
+            self._shared_conn = conn
+            return
+
+        old = self._conn
+        self._local.conn = conn
+        with self._pool_cond:
+            if not old is None and id(old) in self._pool:
+                del self._pool[id(old)]
+                self._pool_count -= 1
+                self._pool_cond.notify()
+            if not conn is None:
+                self._pool[id(conn)] = (threading.current_thread(), conn)
+
+    def _pool_reclaim(self):
+        # close the connections bound to the threads already ended
+        dead = [k for k, (t, conn) in self._pool.items() if not t.is_alive()]
+        for k in dead:
+            t, conn = self._pool.pop(k)
             try:
-                if self._conn:
-                    self._conn.close()
+                conn.close()
             except:
                 pass
-            finally:
-                self._conn = None
-            raise
+            self._pool_count -= 1
 
-        return c
+    def _check_conn(self, conn):
+        try:
+            c = conn.cursor()
+            c.execute(self._ping_query)
+            c.fetchall()
+            conn.rollback()
+            return True
+        except:
+            return False
+
+    def _checkout(self):
+        # bind to the current thread an idle connection, or a new one
+        time_end = time.time() + connection_pool_timeout
+        while True:
+            conn = None
+            with self._pool_cond:
+                while True:
+                    self._pool_reclaim()
+                    if len(self._pool_idle) > 0:
+                        # still counted in _pool_count while it is checked
+                        conn, last_used = self._pool_idle.pop()
+                        break
+                    if self._pool_count < connection_pool_max_size:
+                        self._pool_count += 1
+                        break
+                    if time.time() >= time_end:
+                        raise DBException(
+                            "ECONNECTIONPOOLFULL: no free connections")
+                    self._pool_cond.wait(min(1, time_end - time.time()))
+
+            if conn is None:
+                try:
+                    self._open(self._path)
+                except:
+                    with self._pool_cond:
+                        self._pool_count -= 1
+                        self._pool_cond.notify()
+                    raise
+                return
+
+            # the check is a round trip to the server: don't hold the lock
+            if (time.time() - last_used > connection_check_interval
+                    and not self._check_conn(conn)):
+                # the connection is broken (timeout, db restarted...)
+                try:
+                    conn.close()
+                except:
+                    pass
+                with self._pool_cond:
+                    self._pool_count -= 1
+                    self._pool_cond.notify()
+                continue
+
+            with self._pool_cond:
+                self._local.conn = conn
+                self._pool[id(conn)] = (threading.current_thread(), conn)
+            return
+
+    def _acquire_conn(self):
+        # Transaction and ROCursor hold a connection for their lifetime
+        if not self._conn_per_thread:
+            return
+        if self._conn is None:
+            self._checkout()
+        self._local.depth = getattr(self._local, "depth", 0) + 1
+
+    def _release_conn(self):
+        if not self._conn_per_thread:
+            return
+        self._local.depth -= 1
+        conn = self._conn
+        if self._local.depth > 0 or conn is None:
+            return
+        self._local.conn = None
+        with self._pool_cond:
+            del self._pool[id(conn)]
+            self._pool_idle.append((conn, time.time()))
+            self._pool_cond.notify()
+
+    def _close_conn(self):
+        try:
+            if self._conn:
+                self._conn.close()
+        except:
+            pass
+        finally:
+            self._conn = None
+
+    def _bind_conn(self):
+        # outside a Transaction/ROCursor the connection stays bound to the
+        # thread
+        if self._conn is None:
+            if self._conn_per_thread:
+                self._checkout()
+            else:
+                self._open(self._path)
+
+    def _get_cursor(self, server_side=False):
+        self._bind_conn()
+        try:
+            return self._new_cursor(server_side)
+        except self._mod.Error:
+            # retry once with a new connection; a second error is raised
+            self._close_conn()
+            self._bind_conn()
+            return self._new_cursor(server_side)
+
+    def _new_cursor(self, server_side):
+        # the drivers of sqlite, sqlserver and oracle already fetch the
+        # rows on demand
+        return self._conn.cursor()
+
+    def _sql_translate_cached(self, query):
+        # the translation depends only by the backend class
+        if sql_translate_cache_size <= 0:
+            return self._sql_translate(query)
+
+        cache = _sql_translate_caches.setdefault(type(self), dict())
+        tquery = cache.get(query)
+        if tquery is None:
+            tquery = self._sql_translate(query)
+            # the queries are mostly constant strings: when the cache is
+            # full, it is likely filled by one shot queries
+            if len(cache) >= sql_translate_cache_size:
+                cache.clear()
+            cache[query] = tquery
+        return tquery
 
     def _execute_gen(self, method, query, *args, **kwargs):
-        query = self._sql_translate(query)
+        query = self._sql_translate_cached(query)
         try:
             method(query, *args, **kwargs)
         except Exception as e:
@@ -514,27 +1230,57 @@ class _BaseServer:
 
         return self._read_only
 
-    def create_db(self):
+    def create_db(self, indexes=True):
+        # indexes=False skips the 'CREATE INDEX' statements; these are
+        # executed later by create_indexes() (i.e. after a restore)
+        self._bom_cache.clear()
         stms = self._get_db_v0_4()
         with Transaction(self) as c:
             for s in stms.split(";"):
                 s = s.strip()
                 if len(s) == 0:
                     continue
+                if not indexes and _is_create_index(s):
+                    continue
                 c.execute(s)
 
-    def dump_table(self, tname):
-        with ROCursor(self) as c:
-            c.execute("SELECT * FROM "+ tname)
-            colnames = [desc[0] for desc in c.description]
-            return (colnames, c.fetchall())
+    def create_indexes(self):
+        stms = self._get_db_v0_4()
+        with Transaction(self) as c:
+            for s in stms.split(";"):
+                s = s.strip()
+                if _is_create_index(s):
+                    c.execute(s)
 
-    def _insert_table(self, tname, columns, data):
+    def dump_table(self, tname):
+        # return the column names and a generator of the rows; the rows are
+        # fetched dump_fetch_size at time, so the memory used doesn't depend
+        # by the table size. The generator holds a cursor until it is
+        # exhausted or closed.
+        rows = self._dump_table_rows(tname)
+        colnames = next(rows)
+        return (colnames, rows)
+
+    def _dump_table_rows(self, tname, where="", args=()):
+        with ROCursor(self, server_side=True) as c:
+            c.execute("SELECT * FROM "+ tname + where, args)
+            # a postgresql named cursor knows the columns only after
+            # the first fetch
+            rows = c.fetchmany(dump_fetch_size)
+            yield [desc[0] for desc in c.description]
+            while len(rows) > 0:
+                yield from rows
+                rows = c.fetchmany(dump_fetch_size)
+
+    def _insert_table(self, tname, columns, data, upsert=False):
         with Transaction(self) as c:
-            self._insert_table_(c, tname, columns, data)
+            self._insert_table_(c, tname, columns, data, upsert)
 
-    def _insert_table_(self, c, tname, columns, data):
-        c.execute("DELETE FROM " + tname)
+    def _insert_table_(self, c, tname, columns, data, upsert=False):
+        # upsert=True keeps the rows already present, updating the ones
+        # with the same id
+        if not upsert:
+            c.execute("DELETE FROM " + tname)
         c.execute("SELECT * FROM "+ tname)
         real_colnames = [desc[0].upper() for desc in c.description]
         columns = [x.upper() for x in columns]
@@ -551,14 +1297,43 @@ class _BaseServer:
             final_colnames.append(col)
             final_colnames_idx.append(i)
 
+        # data may be a generator: insert it a batch at time
+        batch = []
         for row in data:
-            row2 = []
-            for idx in  final_colnames_idx:
-                row2.append(row[idx])
-            c.execute(("INSERT INTO " + tname +
-                " (" + ",".join(final_colnames) + ") VALUES " +
-                " (" + ",".join(["?" for i in final_colnames]) + ")"),
-                row2)
+            batch.append([row[idx] for idx in final_colnames_idx])
+            if len(batch) >= restore_batch_size:
+                self._insert_batch(c, tname, final_colnames, batch, upsert)
+                batch = []
+        if len(batch) > 0:
+            self._insert_batch(c, tname, final_colnames, batch, upsert)
+
+    def _insert_batch(self, c, tname, colnames, rows, upsert):
+        if not upsert:
+            self._insert_rows(c, tname, colnames, rows)
+            return
+
+        idx = colnames.index("ID")
+        existing = set([x[0] for x in self._fetchall_by_ids(c,
+            "SELECT id FROM " + tname + " WHERE id IN ({ids})",
+            [int(row[idx]) for row in rows])])
+
+        new_rows = [row for row in rows if not int(row[idx]) in existing]
+        if len(new_rows) > 0:
+            self._insert_rows(c, tname, colnames, new_rows)
+
+        upd_rows = [[v for (i, v) in enumerate(row) if i != idx] + [row[idx]]
+            for row in rows if int(row[idx]) in existing]
+        if len(upd_rows) > 0:
+            c.executemany("UPDATE " + tname + " SET " +
+                ", ".join([col + " = ?" for col in colnames if col != "ID"]) +
+                " WHERE id = ?", upd_rows)
+
+    def _insert_rows(self, c, tname, colnames, rows):
+        # the backends can override this method to use a faster bulk path
+        c.executemany(("INSERT INTO " + tname +
+            " (" + ",".join(colnames) + ") VALUES " +
+            " (" + ",".join(["?" for i in colnames]) + ")"),
+            rows)
 
     def list_main_tables(self):
         # maintain in the correct order by dependecies/foreign keys
@@ -566,9 +1341,16 @@ class _BaseServer:
             "item_properties", "drawings",
             "database_props"]
 
+    def list_main_tables_levels(self):
+        # the tables of list_main_tables() grouped so that the ones of
+        # a group depend only by the previous groups
+        return [["items", "database_props"], ["item_revisions"],
+            ["assemblies", "item_properties", "drawings"]]
+
     def dump_tables(self):
-        return [(i, *self.dump_table(i))
-            for i in self.list_main_tables()]
+        # the rows of a table have to be read before the next table
+        for i in self.list_main_tables():
+            yield (i, *self.dump_table(i))
 
     def get_code(self, id_code, date_from_days):
         with ROCursor(self) as c:
@@ -867,9 +1649,320 @@ class _BaseServer:
 
         return list(c.fetchall())
 
-    def get_bom_by_code_id3(self, code_id0, date_from_days_ref):
+    def _fetchall_by_ids(self, c, query, ids, args=()):
+        # execute 'query' for each chunk of 'ids' and return all the rows;
+        # 'query' must contain a '{ids}' placeholder which is replaced by
+        # the list of '?'. The ids are passed before 'args'
+        ids = list(ids)
+        ret = []
+        for i in range(0, len(ids), in_clause_max_items):
+            chunk = ids[i:i+in_clause_max_items]
+            c.execute(query.replace("{ids}", ",".join(["?"] * len(chunk))),
+                (*chunk, *args))
+            ret += c.fetchall()
+        return ret
 
-        data = dict()
+    def _get_codes_by_rids(self, c, rids):
+        # the bulk version of _get_code_by_rid(); return a dict rid -> data
+
+        gval_query = ", ".join(["r.gval%d"%(i+1) for i in range(gvals_count)])
+
+        rows = self._fetchall_by_ids(c, """
+            SELECT i.code, r.descr, r.ver, r.iter, r.default_unit,
+                r.date_from_days, r.date_to_days, i.id,
+                """ + gval_query + """, r.id
+            FROM item_revisions AS r
+            LEFT JOIN items AS i
+                 ON r.code_id = i.id
+            WHERE r.id IN ({ids})
+            """, rids)
+
+        ret = dict()
+        for res in rows:
+            data = dict()
+            data["code"] = res[0]
+            data["descr"] = res[1]
+            data["ver"] = res[2]
+            data["iter"] = res[3]
+            data["unit"] = res[4]
+
+            data["date_from"] = days_to_txt(res[5])
+            data["date_from_days"] = res[5]
+            data["date_to"] = days_to_txt(res[6])
+            data["date_to_days"] = res[6]
+
+            data["id"] = res[7]
+
+            for i in range(gvals_count):
+                data["gval%d"%(i+1)] = res[8+i]
+
+            rid = res[8+gvals_count]
+            data["rid"] = rid
+
+            data["properties"] = dict()
+
+            ret[rid] = data
+
+        rows = self._fetchall_by_ids(c, """
+            SELECT revision_id, descr, value
+            FROM item_properties
+            WHERE revision_id IN ({ids})
+            ORDER BY id
+            """, rids)
+
+        for rid, k, v in rows:
+            ret[rid]["properties"][k] = v
+
+        return ret
+
+    def get_bom_by_code_id3(self, code_id0, date_from_days_ref,
+                            progress=None):
+        # progress(nodes, depth) is called after each level; it may raise
+        # an exception to stop the explosion of the bom
+        key = (code_id0, date_from_days_ref)
+        if self._bom_cache.is_enabled():
+            self._bom_cache.check_version(self._get_bom_version())
+        ret = self._bom_cache.get(key)
+        if not ret is None:
+            return ret
+
+        generation = self._bom_cache.get_generation()
+        top, data = self._get_bom_by_code_id3(code_id0, date_from_days_ref,
+                                                progress)
+        self._bom_cache.put(key, top, data, generation)
+
+        return (top, data)
+
+    def call_many(self, calls):
+        # calls[] = [(method_name, args, kwargs), ...]; return the list of
+        # the results. The remote client sends all the calls in one message
+        return [getattr(self, name)(*args, **kwargs)
+                    for (name, args, kwargs) in calls]
+
+    def get_bom_cache_stats(self):
+        return self._bom_cache.get_stats()
+
+    def invalidate_bom_cache(self, code_id):
+        # drop the cached boms of 'code_id' (e.g. before a user refresh)
+        self._bom_cache.invalidate(set([code_id]))
+
+    def _get_bom_version(self):
+        # the bom version is changed by every write which affects the
+        # boms, also by the other processes: the cached boms are used only
+        # while it is unchanged
+        with ROCursor(self) as c:
+            c.execute("""
+                SELECT value
+                FROM database_props
+                WHERE name = 'bom_version'
+            """)
+            row = c.fetchone()
+        if row is None:
+            return None
+        return row[0]
+
+    def _bump_bom_version(self, c):
+        # lock the row before reading it, so the value read is the
+        # latest one; return the old and the new value
+        c.execute("""
+            UPDATE database_props
+            SET value = value
+            WHERE name = 'bom_version'
+        """)
+        c.execute("""
+            SELECT value
+            FROM database_props
+            WHERE name = 'bom_version'
+        """)
+        row = c.fetchone()
+        new_version = uuid.uuid4().hex
+        if row is None:
+            c.execute("""
+                INSERT INTO database_props (name, value)
+                VALUES ('bom_version', ?)
+            """, (new_version, ))
+            return (None, new_version)
+        c.execute("""
+            UPDATE database_props
+            SET value = ?
+            WHERE name = 'bom_version'
+        """, (new_version, ))
+        return (row[0], new_version)
+
+    def _bom_cache_invalidate(self, c, code_id):
+        # a change of a code affects all the boms where it is used. The
+        # generation is bumped even when the cache is empty, so a bom
+        # loaded concurrently is not stored; a bom loaded before the commit
+        # still sees the old data, so invalidate again at the end of the
+        # transaction. The bom version tells the other processes to drop
+        # their caches
+        (old_version, new_version) = self._bump_bom_version(c)
+        if code_id is None or self._bom_cache.is_empty():
+            self._bom_cache.clear()
+            c.call_at_end(self._bom_cache.clear)
+        else:
+            code_ids = self._get_ancestors_code_ids(c, code_id)
+            self._bom_cache.invalidate(code_ids)
+            c.call_at_end(lambda: self._bom_cache.invalidate(code_ids))
+        c.call_at_end(lambda: self._bom_cache.advance_version(
+            old_version, new_version))
+
+    def _bom_cache_invalidate_by_rid(self, c, rid):
+        code_id = None
+        if not self._bom_cache.is_empty():
+            c.execute("""
+                SELECT code_id
+                FROM item_revisions
+                WHERE id = ?
+            """, (rid,))
+            row = c.fetchone()
+            if row is None:
+                return
+            code_id = row[0]
+        self._bom_cache_invalidate(c, code_id)
+
+    # the change journal records the ids of the rows updated or deleted,
+    # the inserted ones are found by their id; these are used by the
+    # incremental backups
+    def _has_change_journal(self, c):
+        # the journal may be started by another process
+        if not self._has_journal:
+            self._has_journal = "change_journal" in [
+                x.lower() for x in self._get_tables_list(c)]
+        return self._has_journal
+
+    def _journal_changes(self, c, tname, where, args):
+        # record the rows which are going to be updated or deleted
+        if not self._has_change_journal(c):
+            return
+        c.execute("""
+            INSERT INTO change_journal (tname, row_id)
+            SELECT '""" + tname + """', id
+            FROM """ + tname + """
+            WHERE """ + where, args)
+
+    def start_change_journal(self):
+        # (re)start the journal; the backups made before cannot be used
+        # anymore as base of an incremental one
+        with Transaction(self) as c:
+            if not self._has_change_journal(c):
+                c.execute("""
+                    CREATE TABLE change_journal (
+                        id          INTEGER NOT NULL IDENTITY PRIMARY KEY,
+                        tname       VARCHAR(255) NOT NULL,
+                        row_id      INTEGER NOT NULL
+                    )
+                """)
+            else:
+                c.execute("DELETE FROM change_journal")
+            c.execute("""
+                DELETE FROM database_props
+                WHERE name = 'change_journal'
+            """)
+            c.execute("""
+                INSERT INTO database_props (name, value)
+                VALUES ('change_journal', ?)
+            """, (uuid.uuid4().hex, ))
+        self._has_journal = True
+
+    def get_backup_watermarks(self):
+        # return the last id of each table and of the journal; the
+        # 'journal_id' identifies the journal, it is None if it is
+        # not started
+        ret = {"journal_id": None, "journal": 0, "tables": dict()}
+        with ROCursor(self) as c:
+            for tname in self.list_main_tables():
+                c.execute("SELECT MAX(id) FROM " + tname)
+                ret["tables"][tname] = c.fetchone()[0] or 0
+
+            if not self._has_change_journal(c):
+                return ret
+
+            c.execute("""
+                SELECT value
+                FROM database_props
+                WHERE name = 'change_journal'
+            """)
+            row = c.fetchone()
+            if row is None:
+                return ret
+            ret["journal_id"] = row[0]
+            c.execute("SELECT MAX(id) FROM change_journal")
+            ret["journal"] = c.fetchone()[0] or 0
+
+        return ret
+
+    def dump_table_changes(self, tname, last_id, last_journal):
+        # like dump_table(), but return only the rows inserted or changed
+        # after the watermarks; return also the ids of the deleted rows
+        with ROCursor(self) as c:
+            c.execute("""
+                SELECT DISTINCT row_id
+                FROM change_journal
+                WHERE tname = ?
+                  AND id > ?
+                  AND row_id <= ?
+                  AND NOT row_id IN (SELECT id FROM """ + tname + """)
+                ORDER BY row_id
+            """, (tname, last_journal, last_id))
+            deleted = [x[0] for x in c.fetchall()]
+
+        rows = self._dump_table_rows(tname, """
+            WHERE id > ?
+               OR id IN (
+                    SELECT row_id
+                    FROM change_journal
+                    WHERE tname = ?
+                      AND id > ?
+               )
+        """, (last_id, tname, last_journal))
+        colnames = next(rows)
+        return (colnames, rows, deleted)
+
+    def _delete_table_rows(self, tname, ids):
+        with Transaction(self) as c:
+            c.executemany("DELETE FROM " + tname + " WHERE id = ?",
+                [(int(id_), ) for id_ in ids])
+
+    def _get_ancestors_code_ids(self, c, code_id):
+        # return the code_id and the code_ids of all its parents,
+        # grand parents..., regardless of the dates
+        if self._has_recursive_cte:
+            c.execute("""
+                WITH RECURSIVE parent_of(code_id) AS (
+                    SELECT  ?
+                    UNION
+                    SELECT r.code_id
+                    FROM parent_of AS po
+                    INNER JOIN assemblies AS a
+                       ON a.child_id = po.code_id
+                    INNER JOIN item_revisions AS r
+                       ON a.revision_id = r.id
+                )
+                SELECT code_id
+                FROM parent_of
+                """, (code_id,))
+            return set([x[0] for x in c.fetchall()])
+
+        done = set()
+        todo = set([code_id])
+        while len(todo):
+            done.update(todo)
+            rows = self._fetchall_by_ids(c, """
+                    SELECT DISTINCT r.code_id
+                    FROM assemblies AS a
+                    INNER JOIN item_revisions AS r
+                       ON a.revision_id = r.id
+                    WHERE a.child_id IN ({ids})
+                """, todo)
+            todo = set([x[0] for x in rows]).difference(done)
+
+        return done
+
+    def _get_bom_by_code_id3(self, code_id0, date_from_days_ref,
+                             progress=None):
+
+        data = BomData(gvals_count, gavals_count)
 
         with ROCursor(self) as c:
             c.execute("""SELECT i.code, r.date_from_days, r.date_to_days, r.id
@@ -887,47 +1980,55 @@ class _BaseServer:
 
             (code0, date_from_days, date_to_days, rid) = data2[0]
             date_from_days0 = date_from_days
+
+            gavals = ""
+            for i in range(gavals_count):
+                gavals += ", a.gaval%d"%(i+1)
+
+            # explode the bom one level at time: for each level fetch
+            # all the revisions, properties and children in bulk
             todo = [rid]
-            done = []
+            done = set()
+            depth = 0
 
             while len(todo):
-                rid = todo.pop()
+                level = []
+                for rid in todo:
+                    if not rid in done:
+                        done.add(rid)
+                        level.append(rid)
+                todo = []
 
-                done.append(rid)
-                d2 = self._get_code_by_rid(c, rid)
-                d = d2["properties"]
-                d2.pop("properties")
-                d.update(d2)
-                d["deps"] = dict()
+                if len(level) == 0:
+                    break
 
-                gavals = ""
-                for i in range(gavals_count):
-                    gavals += ", a.gaval%d"%(i+1)
-                c.execute("""
-                    SELECT a.unit, a.qty, a.each,
+                codes = self._get_codes_by_rids(c, level)
+
+                children = self._fetchall_by_ids(c, """
+                    SELECT a.revision_id, a.unit, a.qty, a.each,
                             rc.iter, a.child_id, rc.code_id, rc.date_from_days,
                             rc.date_to_days, a.ref,
                             rc.id %s
                     FROM assemblies AS a
                     LEFT JOIN item_revisions AS rc
                       ON a.child_id = rc.code_id
-                    WHERE   a.revision_id = ?
+                    WHERE   a.revision_id IN ({ids})
                       AND   rc.date_from_days <= ?
                       AND   ? <= rc.date_to_days
                     ORDER BY a.id
-                    """%(gavals), (rid, date_from_days_ref, date_from_days_ref))
+                    """%(gavals), level, (date_from_days_ref, date_from_days_ref))
 
-                children = c.fetchall()
-
-                if children is None or len(children) == 0:
-                    data[d["id"]] = d
-                    continue
+                rows = dict()
+                for rid in level:
+                    d = codes[rid]
+                    rows[rid] = data._add_node(d, d["properties"])
 
+                edges = []
                 for line in children:
-                    (unit, qty, each, it, child_id,parent_id,
-                     date_from_days_, date_to_days_, ref, crid) = line[:10]
-                    gavalues = line[10:]
-                    d["deps"][child_id] = {
+                    (prid, unit, qty, each, it, child_id,parent_id,
+                     date_from_days_, date_to_days_, ref, crid) = line[:11]
+                    gavalues = line[11:]
+                    edge = {
                         "code_id": child_id,
                         "unit": unit,
                         "qty": qty,
@@ -936,67 +2037,151 @@ class _BaseServer:
                         "ref": ref,
                     }
                     for i in range(gavals_count):
-                        d["deps"][child_id]["gaval%d"%(i+1)] = gavalues[i]
+                        edge["gaval%d"%(i+1)] = gavalues[i]
+                    edges.append((rows[prid], edge))
 
                     if not crid in done:
                         todo.append(crid)
 
-                data[d["id"]] = d
+                data._add_edges(edges)
 
-            #mindt = "N/A"
-            #for k in data[code_id0]["deps"]:
-            #    cid = data[code_id0]["deps"][k]["code_id"]
-            #    if mindt == "N/A" or mindt > data[cid]["date_to"]:
-            #        mindt = data[cid]["date_to"]
-            #data[code_id0]["date_to"] = mindt
+                depth += 1
+                if not progress is None:
+                    progress(len(done), depth)
 
+            data._end_build()
             return (code_id0, data)
 
-    def _get_parents(self, c, id_code, date_from_days, date_to_days):
+    def _get_where_used_graph_cte(self, c, root, valid):
+        # collect the whole ancestor graph of 'root' with a single
+        # recursive query; the query returns a row for each
+        # (node, parent) pair; the parent is NULL when the node doesn't
+        # have parents or when the parent revision doesn't match the dates
+        if valid:
+            cond = """r.date_to_days >= ?
+                 AND r.date_from_days < ?"""
+            cond_args = (prototype_date - 1, prototype_date)
+        else:
+            cond = """NOT (
+                       r.date_from_days > wu.date_to_days
+                    OR r.date_to_days < wu.date_from_days
+                 )"""
+            cond_args = ()
+
         c.execute("""
-            SELECT a.unit, c.code, r.default_unit, a.qty, a.each,
-                    r.iter, r.code_id, r.date_from_days, r.date_to_days
-            FROM assemblies AS a
+            WITH RECURSIVE where_used(rid, code_id,
+                    date_from_days, date_to_days) AS (
+                SELECT ?, ?, ?, ?
+                UNION
+                SELECT r.id, r.code_id, r.date_from_days, r.date_to_days
+                FROM where_used AS wu
+                INNER JOIN assemblies AS a
+                    ON a.child_id = wu.code_id
+                INNER JOIN item_revisions AS r
+                    ON a.revision_id = r.id
+                WHERE """ + cond + """
+            )
+            SELECT wu.rid, wu.code_id, wu.date_from_days, wu.date_to_days,
+                   a.unit, c.code, r.default_unit, a.qty, a.each,
+                   r.iter, r.code_id, r.date_from_days, r.date_to_days
+            FROM where_used AS wu
+            LEFT JOIN assemblies AS a
+                ON a.child_id = wu.code_id
             LEFT JOIN item_revisions AS r
                 ON a.revision_id = r.id
+               AND """ + cond + """
             LEFT JOIN items AS c
                 ON r.code_id = c.id
-
-            WHERE a.child_id = ?
-              AND NOT (
-                   r.date_from_days > ?
-                OR r.date_to_days < ?
-              )
             ORDER BY c.code, r.date_from_days DESC
-            """, (id_code, date_to_days, date_from_days))
+            """, (*root, *cond_args, *cond_args))
+
+        # a node is identified by (code_id, date_from_days); the root node
+        # has a date range wider than its revision, so it wins in case
+        # of loop
+        nodes = [root]
+        parents = {(root[1], root[2]): []}
+        node_ranges = {(root[1], root[2]): root[3]}
+        for row in c.fetchall():
+            (rid, code_id, date_from_days, date_to_days) = row[:4]
+            key = (code_id, date_from_days)
+            if not key in node_ranges:
+                node_ranges[key] = date_to_days
+                nodes.append((rid, code_id, date_from_days, date_to_days))
+                parents[key] = []
+            elif node_ranges[key] != date_to_days:
+                continue
 
-        res = c.fetchall()
-        if not res:
-            return None
-        else:
-            return res
+            if row[10] is None:
+                continue
 
-    def _get_valid_parents(self, c, id_code):
-        c.execute("""
-            SELECT a.unit, c.code, r.default_unit, a.qty, a.each,
-                    r.iter, r.code_id, r.date_from_days, r.date_to_days
-            FROM assemblies AS a
-            LEFT JOIN item_revisions AS r
-                ON a.revision_id = r.id
-            LEFT JOIN items AS c
-                ON r.code_id = c.id
+            parents[key].append(row[4:])
 
-            WHERE a.child_id = ?
-              AND r.date_to_days >= ?
-              AND r.date_from_days < ?
-            ORDER BY c.code, r.date_from_days DESC
-            """, (id_code, prototype_date - 1, prototype_date))
+        return nodes, parents
 
-        res = c.fetchall()
-        if not res:
-            return None
+    def _get_where_used_graph(self, c, root, valid):
+        # like _get_where_used_graph_cte(), but for the backends without
+        # recursive query: walk the graph one level at time, fetching the
+        # parents of a whole level in bulk
+        if valid:
+            cond = """
+              AND r.date_to_days >= ?
+              AND r.date_from_days < ?"""
+            cond_args = (prototype_date - 1, prototype_date)
         else:
-            return res
+            cond = ""
+            cond_args = ()
+
+        nodes = []
+        parents = dict()
+        done = set()
+        todo = [root]
+
+        while len(todo):
+            level = []
+            for node in todo:
+                key = (node[1], node[2])
+                if not key in done:
+                    done.add(key)
+                    level.append(node)
+            todo = []
+
+            if len(level) == 0:
+                break
+
+            rows = self._fetchall_by_ids(c, """
+                SELECT a.child_id,
+                        a.unit, c.code, r.default_unit, a.qty, a.each,
+                        r.iter, r.code_id, r.date_from_days, r.date_to_days,
+                        r.id
+                FROM assemblies AS a
+                LEFT JOIN item_revisions AS r
+                    ON a.revision_id = r.id
+                LEFT JOIN items AS c
+                    ON r.code_id = c.id
+                WHERE a.child_id IN ({ids})
+                """ + cond + """
+                ORDER BY c.code, r.date_from_days DESC
+                """, set([x[1] for x in level]), cond_args)
+
+            parents_by_child = dict()
+            for row in rows:
+                parents_by_child.setdefault(row[0], []).append(row[1:])
+
+            for (rid, code_id, date_from_days, date_to_days) in level:
+                nodes.append((rid, code_id, date_from_days, date_to_days))
+                l = []
+                for row in parents_by_child.get(code_id, []):
+                    (parent_id, pdate_from_days, pdate_to_days, prid) = row[6:]
+                    if not valid and (pdate_from_days > date_to_days or
+                                      pdate_to_days < date_from_days):
+                        continue
+                    l.append(row[:9])
+                    if not (parent_id, pdate_from_days) in done:
+                        todo.append((prid, parent_id,
+                                     pdate_from_days, pdate_to_days))
+                parents[(code_id, date_from_days)] = l
+
+        return nodes, parents
 
     def get_where_used_from_id_code(self, id_code, valid=False):
         with ROCursor(self) as c:
@@ -1019,30 +2204,33 @@ class _BaseServer:
             """, (id_code,))
             (xdate_to_days0, ) = c.fetchone()
 
-            todo = [(id_code, xdate_from_days0, xdate_to_days0 )]
-            data = dict()
-            done = set()
+            c.execute("""
+                SELECT id
+                FROM item_revisions
+                WHERE code_id = ?
+                  AND date_from_days = ?
+            """, (id_code, xdate_from_days0))
+            (rid0, ) = c.fetchone()
 
-            while len(todo):
-                (id_, xdate_from_days, xdate_to_days) = todo.pop()
-                done.add((id_, xdate_from_days))
+            root = (rid0, id_code, xdate_from_days0, xdate_to_days0)
+            if self._has_recursive_cte:
+                nodes, parents = self._get_where_used_graph_cte(c, root, valid)
+            else:
+                nodes, parents = self._get_where_used_graph(c, root, valid)
 
-                d2 = self._get_code(c, id_, xdate_from_days)
+            codes = self._get_codes_by_rids(c, [x[0] for x in nodes])
+
+            data = dict()
+            for (rid, id_, xdate_from_days, xdate_to_days) in nodes:
+                d2 = codes[rid]
                 d = d2["properties"]
                 d2.pop("properties")
                 d.update(d2)
                 d["deps"] = dict()
 
-                if valid:
-                    parents = self._get_valid_parents(c, id_)
-                else:
-                    parents = self._get_parents(c, id_, xdate_from_days, xdate_to_days)
-                if parents is None or len(parents) == 0:
-                    data[(d["code"], xdate_from_days)] = d
-                    continue
-
                 for (unit, cc, def_unit, qty, each, it,
-                        parent_id, date_from_days_, date_to_days_) in parents:
+                        parent_id, date_from_days_, date_to_days_) in parents[
+                            (id_, xdate_from_days)]:
                     if unit is None:
                        unit = def_unit
                     d["deps"][(cc, date_from_days_)] = {
@@ -1054,9 +2242,6 @@ class _BaseServer:
                         "ref": "",
                     }
 
-                    if not (parent_id, date_from_days_) in done:
-                        todo.append((parent_id, date_from_days_, date_to_days_))
-
                 data[(d["code"], xdate_from_days)] = d
 
             top = (code0, xdate_from_days0)
@@ -1081,11 +2266,28 @@ class _BaseServer:
         else:
             return res
 
-    def get_bom_dates_by_code_id(self, code_id):
-        sdates = set()
-        done = set()
-        todo = [code_id]
+    def get_drawings_by_rids(self, rids):
+        # the bulk version of get_drawings_and_urls_by_rid(); return a dict
+        # rid -> [(filename, fullpath), ...] with an entry for each rid
+        with ROCursor(self) as c:
+            return self._get_drawings_by_rids(c, rids)
+
+    def _get_drawings_by_rids(self, c, rids):
+        ret = dict([(rid, []) for rid in rids])
+
+        rows = self._fetchall_by_ids(c, """
+            SELECT revision_id, filename, fullpath
+            FROM drawings
+            WHERE revision_id IN ({ids})
+            ORDER BY id
+            """, ret.keys())
+
+        for rid, filename, fullpath in rows:
+            ret[rid].append((filename, fullpath))
 
+        return ret
+
+    def get_bom_dates_by_code_id(self, code_id):
         with ROCursor(self) as c:
             c.execute("""
                 SELECT MIN(date_from_days)
@@ -1094,38 +2296,65 @@ class _BaseServer:
                 """, (code_id,))
 
             date_from_min = c.fetchone()[0]
-            while len(todo):
 
-                cid = todo.pop()
-                done.add(cid)
+            if self._has_recursive_cte:
                 c.execute("""
-                        SELECT r.date_from_days
-                        FROM item_revisions AS r
-                        WHERE r.code_id = ?
-                          AND date_from_days >= ?
-                    """, (cid, date_from_min))
+                    WITH RECURSIVE child_of(child_id) AS (
+                        SELECT  ?
+                        UNION
+                        SELECT a.child_id
+                        FROM child_of AS co
+                        INNER JOIN item_revisions AS r
+                           ON r.code_id = co.child_id
+                        INNER JOIN assemblies AS a
+                           ON a.revision_id = r.id
+                    )
+                    SELECT DISTINCT r.date_from_days
+                    FROM item_revisions AS r
+                    WHERE r.code_id IN (
+                        SELECT  child_id
+                        FROM child_of
+                    )  AND r.date_from_days >= ?
+                    """, (code_id, date_from_min))
 
-                for (date_from_days,) in c.fetchall():
-                    if not date_from_days in sdates:
-                        sdates.add(date_from_days)
+                sdates = set([x[0] for x in c.fetchall()])
+            else:
+                sdates = self._get_bom_dates_by_code_id(c, code_id,
+                                                        date_from_min)
 
-                c.execute("""
-                        SELECT DISTINCT child_id
-                        FROM assemblies
-                        WHERE revision_id IN (
-                            SELECT id
-                            FROM item_revisions
-                            WHERE code_id = ?
-                        )
-                    """, (cid,))
+        dates = list(sdates)
+        dates.sort(reverse=True)
+        return dates
 
-                l = set([x[0] for x in c.fetchall()])
-                l = l.difference(done)
-                todo += list(l)
+    def _get_bom_dates_by_code_id(self, c, code_id, date_from_min):
+        # fallback for the backends without recursive query: walk the bom
+        # one level at time
+        sdates = set()
+        done = set()
+        todo = set([code_id])
 
-            dates = list(sdates)
-            dates.sort(reverse=True)
-            return dates
+        while len(todo):
+            done.update(todo)
+
+            rows = self._fetchall_by_ids(c, """
+                    SELECT DISTINCT r.date_from_days
+                    FROM item_revisions AS r
+                    WHERE r.code_id IN ({ids})
+                      AND r.date_from_days >= ?
+                """, todo, (date_from_min,))
+            sdates.update([x[0] for x in rows])
+
+            rows = self._fetchall_by_ids(c, """
+                    SELECT DISTINCT a.child_id
+                    FROM assemblies AS a
+                    INNER JOIN item_revisions AS r
+                       ON a.revision_id = r.id
+                    WHERE r.code_id IN ({ids})
+                """, todo)
+
+            todo = set([x[0] for x in rows]).difference(done)
+
+        return sdates
 
     def copy_code(self, new_code, rid, descr, rev, copy_props=True,
                   copy_docs=True, new_date_from_days=None,
@@ -1237,8 +2466,12 @@ class _BaseServer:
                 new_date_from_days, new_date_to_days,
                 rev, new_iter, descr, rid, copy_docs, copy_props)
 
+            self._bom_cache_invalidate(c, code_id)
+
             if latest_rid >= 0:
                 old_date_to_days = new_date_from_days - 1
+                self._journal_changes(c, "item_revisions", "id = ?",
+                    (latest_rid, ))
                 c.execute("""
                     UPDATE item_revisions
                     SET date_to = ?, date_to_days = ?
@@ -1390,6 +2623,12 @@ class _BaseServer:
                 if drawings_ != self._get_drawings_by_rid(c, rid):
                     return "DATACHANGED"
 
+            self._bom_cache_invalidate_by_rid(c, rid)
+
+            self._journal_changes(c, "item_revisions", "id = ?", (rid, ))
+            self._journal_changes(c, "drawings", "revision_id = ?", (rid, ))
+            self._journal_changes(c, "assemblies", "revision_id = ?", (rid, ))
+
             gval_query = ", ".join(["gval%d = ?"%(i+1) for i in range(gvals_count)])
             c.execute("""
                 UPDATE item_revisions SET
@@ -1521,6 +2760,10 @@ class _BaseServer:
                     raise DBException("DATEERROR: parent date_from < min children date_from")
                 assert(pdate_to_days <= max_date_to_days)
 
+            self._bom_cache_invalidate(c, code_id)
+            self._journal_changes(c, "item_revisions", "code_id = ?",
+                (code_id, ))
+
             # ok insert the data
             for (rid, date_from, date_from_days, date_to, date_to_days) in dates:
                 c.execute("""
@@ -1577,6 +2820,16 @@ class _BaseServer:
                 c.rollback()
                 return "HASPARENTS"
 
+            self._bom_cache_invalidate(c, code_id)
+
+            for tname in ["drawings", "assemblies", "item_properties"]:
+                self._journal_changes(c, tname, """revision_id IN
+                    (SELECT id FROM item_revisions WHERE code_id = ?)""",
+                    (code_id, ))
+            self._journal_changes(c, "item_revisions", "code_id = ?",
+                (code_id, ))
+            self._journal_changes(c, "items", "id = ?", (code_id, ))
+
             c.execute("""
                 DELETE FROM drawings
                 WHERE revision_id IN
@@ -1649,6 +2902,9 @@ class _BaseServer:
 
             cnt = c.fetchone()[0]
 
+            self._journal_changes(c, "item_revisions", "code_id = ?",
+                (code_id, ))
+
             # adjust the date of the adiajenct item_revision
             if cnt > 0:
                 c.execute("""
@@ -1699,6 +2955,11 @@ class _BaseServer:
                       AND iter = ?
                 """, (date_from, date_from_days, code_id, next_iter))
 
+            self._bom_cache_invalidate(c, code_id)
+
+            for tname in ["drawings", "assemblies", "item_properties"]:
+                self._journal_changes(c, tname, "revision_id = ?", (rid, ))
+
             # drop all the children
 
             c.execute("""
@@ -1815,10 +3076,12 @@ class _BaseServer:
 
 
 class DBSQLServer(_BaseServer):
+    _has_recursive_cte = False
+
     def __init__(self, path=None):
         _BaseServer.__init__(self, path)
 
-    def _insert_table(self, tname, columns, data):
+    def _insert_table(self, tname, columns, data, upsert=False):
         cs = columns[:]
         while "key" in cs:
             i = cs.index("key")
@@ -1826,9 +3089,15 @@ class DBSQLServer(_BaseServer):
 
         with Transaction(self) as c:
             c.execute("SET IDENTITY_INSERT " + tname +" ON" )
-            self._insert_table_(c, tname, cs, data)
+            self._insert_table_(c, tname, cs, data, upsert)
             c.execute("SET IDENTITY_INSERT " + tname +" OFF" )
 
+    def _insert_rows(self, c, tname, colnames, rows):
+        # pyodbc sends all the rows in one round trip
+        c.begin()
+        c._cursor.fast_executemany = True
+        _BaseServer._insert_rows(self, c, tname, colnames, rows)
+
     # SQLServer doesn't like BEGIN; it is 'autobegin'
     def _begin(self, c):
         pass
@@ -1866,6 +3135,9 @@ class DBSQLServer(_BaseServer):
 
 
 class DBOracleServer(_BaseServer):
+    _has_recursive_cte = False
+    _ping_query = "SELECT 1 FROM DUAL"
+
     def __init__(self, path=None):
         _BaseServer.__init__(self, path)
 
@@ -1941,7 +3213,8 @@ class DBOracleServer(_BaseServer):
 
         return s
 
-    def create_db(self):
+    def create_db(self, indexes=True):
+        self._bom_cache.clear()
 
         stms = self._get_db_v0_4()
 
@@ -1969,6 +3242,8 @@ class DBOracleServer(_BaseServer):
                     else:
                         s = stms
                         stms = ""
+                    if not indexes and _is_create_index(s):
+                        continue
                     c.execute(s)
 
     def _open(self, connection_string):
@@ -1991,6 +3266,9 @@ class DBOracleServer(_BaseServer):
                     connection_string))
 
         self._conn = cx_Oracle.connect(user, pwd, host)
+        # the translated queries are the same strings: reuse the
+        # prepared statements
+        self._conn.stmtcachesize = 100
 
     def _get_tables_list(self, c):
         c.execute("""
@@ -2019,20 +3297,53 @@ class DBOracleServer(_BaseServer):
 
 
 class DBSQLite(_BaseServer):
+    _parallel_load = False
+
     def __init__(self, path=None, ignore_case_during_search=True):
         if path == "" or path is None:
             path = _db_path
         self._ignore_case_during_search = ignore_case_during_search
         _BaseServer.__init__(self, path)
+        # every connection to ':memory:' is a different db
+        if path == ":memory:":
+            self._conn_per_thread = False
 
     def _open(self, path):
         import sqlite3
-        self._conn = sqlite3.connect(path)
+        # the connection may be closed by another thread, and an in memory
+        # db shares the connection between the threads
+        self._conn = sqlite3.connect(path, check_same_thread=False,
+                                     cached_statements=256)
         self._conn.execute("PRAGMA foreign_keys = ON")
         if not self._ignore_case_during_search:
             self._conn.execute("PRAGMA case_sensitive_like = 1")
         self._mod = sqlite3
 
+    def _insert_table(self, tname, columns, data, upsert=False):
+        # the pragmas cannot be changed inside a transaction, and are
+        # bound to the connection: hold it until they are restored
+        self._acquire_conn()
+        try:
+            c = self._get_cursor()
+
+            def pragma(s):
+                # fetch the result, otherwise the statement is in progress
+                c.execute("PRAGMA " + s)
+                return c.fetchall()
+
+            synchronous = pragma("synchronous")[0][0]
+            journal_mode = pragma("journal_mode")[0][0]
+            pragma("synchronous=OFF")
+            pragma("journal_mode=MEMORY")
+            try:
+                with Transaction(self) as c2:
+                    self._insert_table_(c2, tname, columns, data, upsert)
+            finally:
+                pragma("synchronous=%d"%(synchronous))
+                pragma("journal_mode=%s"%(journal_mode))
+        finally:
+            self._release_conn()
+
     def _sql_translate(self, stms):
         stms = stms.replace(" IDENTITY", "")
         #stms = stms.replace(" ON items;", ";")
@@ -2051,9 +3362,9 @@ class DBPG(_BaseServer):
         import psycopg2
         _BaseServer.__init__(self, path)
 
-    def _insert_table(self, tname, columns, data):
+    def _insert_table(self, tname, columns, data, upsert=False):
         with Transaction(self) as c:
-            self._insert_table_(c, tname, columns, data)
+            self._insert_table_(c, tname, columns, data, upsert)
 
             c.execute("SELECT COUNT(*) FROM " + tname)
             n = c.fetchone()[0]
@@ -2064,6 +3375,21 @@ class DBPG(_BaseServer):
                 n = 100
             c.execute("ALTER SEQUENCE " + tname + "_id_seq RESTART WITH %d"%(n) )
 
+    def _insert_rows(self, c, tname, colnames, rows):
+        import io
+
+        def escape(v):
+            if v is None:
+                return "\\N"
+            return (str(v).replace("\\", "\\\\").replace("\t", "\\t")
+                .replace("\n", "\\n").replace("\r", "\\r"))
+
+        f = io.StringIO("".join(["\t".join(map(escape, row)) + "\n"
+            for row in rows]))
+        c.begin()
+        c._cursor.copy_expert("COPY " + tname + " (" + ",".join(colnames) +
+            ") FROM STDIN", f)
+
     def _sql_translate(self, s):
         def process(l):
             if "?" in l:
@@ -2075,6 +3401,13 @@ class DBPG(_BaseServer):
         s = '\n'.join([process(line) for line in s.split("\n")])
         return s
 
+    def _new_cursor(self, server_side):
+        if not server_side:
+            return self._conn.cursor()
+        # a named cursor keeps the rows on the server
+        return self._conn.cursor(name="bombrowser_cursor_%d"%(
+            next(_cursor_names)))
+
     def _open(self, path):
         import psycopg2
         self._mod = psycopg2
@@ -2091,55 +3424,14 @@ class DBPG(_BaseServer):
 
         return [x[0] for x in c.fetchall()]
 
-    def get_bom_dates_by_code_id(self, code_id):
-        sdates = set()
-        done = set()
-        todo = [code_id]
-
-        with ROCursor(self) as c:
-
-            c.execute("""
-                SELECT MIN(date_from_days)
-                FROM item_revisions
-                WHERE code_id = ?
-                """, (code_id,))
-
-            date_from_min = c.fetchone()[0]
-
-            c.execute("""
-
-                SELECT DISTINCT r.date_from_days
-                FROM item_revisions AS r
-                WHERE r.code_id IN (
-
-                    WITH RECURSIVE child_of(child_id) AS (
-                        SELECT  ?
-                        UNION
-                        SELECT a.child_id
-                        FROM child_of AS co
-                        LEFT JOIN item_revisions AS r
-                           ON r.code_id = co.child_id
-                        LEFT JOIN assemblies AS a
-                           ON a.revision_id = r.id
-                    )
-                    SELECT  child_id
-                    FROM child_of
-                )  AND date_from_days >= ?
-
-            """,(code_id, date_from_min))
-
-            dates = [x[0] for x in c.fetchall()]
-
-            return dates
-
 
 class DBMySQL(_BaseServer):
     def __init__(self, path=None):
         _BaseServer.__init__(self, path)
 
-    def _insert_table(self, tname, columns, data):
+    def _insert_table(self, tname, columns, data, upsert=False):
         with Transaction(self) as c:
-            self._insert_table_(c, tname, columns, data)
+            self._insert_table_(c, tname, columns, data, upsert)
 
     def _sql_translate(self, s):
         def process(l):
@@ -2177,47 +3469,6 @@ class DBMySQL(_BaseServer):
         c.execute("""SHOW TABLES""")
         return [x[0] for x in c.fetchall()]
 
-    def get_bom_dates_by_code_id(self, code_id):
-        sdates = set()
-        done = set()
-        todo = [code_id]
-
-        with ROCursor(self) as c:
-
-            c.execute("""
-                SELECT MIN(date_from_days)
-                FROM item_revisions
-                WHERE code_id = ?
-                """, (code_id,))
-
-            date_from_min = c.fetchone()[0]
-
-            c.execute("""
-
-                SELECT DISTINCT r.date_from_days
-                FROM item_revisions AS r
-                WHERE r.code_id IN (
-
-                    WITH RECURSIVE child_of(child_id) AS (
-                        SELECT  ?
-                        UNION
-                        SELECT a.child_id
-                        FROM child_of AS co
-                        LEFT JOIN item_revisions AS r
-                           ON r.code_id = co.child_id
-                        LEFT JOIN assemblies AS a
-                           ON a.revision_id = r.id
-                    )
-                    SELECT  child_id
-                    FROM child_of
-                )  AND date_from_days >= ?
-
-            """,(code_id, date_from_min))
-
-            dates = [x[0] for x in c.fetchall()]
-
-            return dates
-
 
 def get_db_instance():
 
@@ -2275,36 +3526,63 @@ def _create_db(dbtype, cfg):
         password = cfg["password"]
         password = customize.database_password(password)
 
+        compression = cfg.get("compression", "0") != "0"
+
         import bbserver
-        instance = bbserver.RemoteSQLClient(host, port)
+        instance = bbserver.RemoteSQLClient(host, port, compression)
         connection="Server: RemoteBBServer:%s@%d"%(host, port)
         instance.remote_server_do_auth(username, password)
 
     return connection,instance
 
-def restore_tables(nf, d, quiet=False):
+def restore_tables(nf, d, quiet=False, increments=[], jobs=1,
+                   start_journal=False):
+    # nf is a full backup; increments is the chain of the incremental
+    # backups made after it, in order; up to 'jobs' tables are loaded
+    # in parallel, each one by its connection. The change journal is
+    # (re)started if start_journal is True, or if the backed up db or this
+    # one had it. Return the timings of each table
     import zipfile
-    with zipfile.ZipFile(nf) as z:
-        fntables = [i[:-4] for i in z.namelist() if i.endswith(".csv")]
-        fntables.sort()
+    import contextlib
+
+    with contextlib.ExitStack() as stack:
+        zs = [stack.enter_context(zipfile.ZipFile(x))
+            for x in [nf] + list(increments)]
+
         l = d.list_main_tables()
         l.sort()
-        assert(l==fntables)
-
+        base_info = None
         gval = 0
         gaval = 0
-
-        with z.open("item_revisions.csv") as f:
-            line = f.readline().decode('utf-8').rstrip("\n\r")
-            for i in line.split("\t"):
-                if i.lower().startswith("gval"):
-                    gval = int(i[4:])
-
-        with z.open("assemblies.csv") as f:
-            line = f.readline().decode('utf-8').rstrip("\n\r")
-            for i in line.split("\t"):
-                if i.lower().startswith("gaval"):
-                    gaval = int(i[5:])
+        for (z, fn) in zip(zs, [nf] + list(increments)):
+            fntables = [i[:-4] for i in z.namelist() if i.endswith(".csv")]
+            fntables.sort()
+            assert(l==fntables)
+
+            info = _read_backup_info(z)
+            if z is zs[0]:
+                if not info is None and not info["base_backup_id"] is None:
+                    raise DBException(
+                        "EBACKUPCHAIN: '%s' is an incremental backup"%(fn))
+                if not info is None and not info["journal_id"] is None:
+                    start_journal = True
+            elif (info is None or base_info is None or
+                  info["base_backup_id"] != base_info["backup_id"]):
+                raise DBException(
+                    "EBACKUPCHAIN: '%s' is not based on the previous backup"%(fn))
+            base_info = info
+
+            with z.open("item_revisions.csv") as f:
+                line = f.readline().decode('utf-8').rstrip("\n\r")
+                for i in line.split("\t"):
+                    if i.lower().startswith("gval"):
+                        gval = max(gval, int(i[4:]))
+
+            with z.open("assemblies.csv") as f:
+                line = f.readline().decode('utf-8').rstrip("\n\r")
+                for i in line.split("\t"):
+                    if i.lower().startswith("gaval"):
+                        gaval = max(gaval, int(i[5:]))
 
         global gvals_count, gavals_count
 
@@ -2315,52 +3593,327 @@ def restore_tables(nf, d, quiet=False):
         if gval > gvals_count:
             gvals_count = gval
 
-        d.create_db()
+        # create_db() doesn't drop the journal, but it has to be restarted
+        with ROCursor(d) as c:
+            if d._has_change_journal(c):
+                start_journal = True
+
+        # the indexes slow down the inserts: create them at the end
+        d.create_db(indexes=False)
+
+        # sqlite allows only one writer at time
+        if not _can_run_jobs(d) or not d._parallel_load:
+            jobs = 1
+
+        def load_table(z, table, upsert):
+            time0 = time.time()
+            with z.open(table+".csv") as f:
+                columns = f.readline().decode("utf-8").rstrip("\n\r").split("\t")
+                rows = _read_table_rows(f)
+                if not quiet and jobs == 1:
+                    rows = _print_progress(table, rows)
+                cnt = _Counter(rows)
+                d._insert_table(table, columns, cnt, upsert)
+            return (table, cnt.count, time.time() - time0)
+
+        def delete_rows(z, table):
+            time0 = time.time()
+            ids = []
+            if table + ".deleted" in z.namelist():
+                ids = z.read(table + ".deleted").decode("utf-8").split()
+            if len(ids) > 0:
+                d._delete_table_rows(table, ids)
+            return (table, len(ids), time.time() - time0)
 
         if not quiet:
             print()
-        for table in d.list_main_tables():
-            tablefn = table+".csv"
-            with z.open(tablefn) as f:
-                columns = f.readline().decode("utf-8").rstrip("\n\r").split("\t")
-                d._insert_table(table, columns,
-                    [list(map(xunescape,
-                              x[:-1].decode("utf-8").rstrip("\n\r").split("\t")))
-                     for x in f.readlines()]
-                )
-                if not quiet:
-                     print("\r%s                                 "%(table), end="")
+        timings = collections.OrderedDict(
+            [(table, [0, 0.0]) for table in d.list_main_tables()])
+        levels = d.list_main_tables_levels()
+        for (z, upsert) in zip(zs, [False] + [True] * len(increments)):
+            # first insert/update the rows following the dependencies,
+            # then delete the rows in the reverse order; the tables of
+            # the same level don't depend each other
+            res = []
+            for level in levels:
+                res += _run_jobs(jobs, load_table,
+                    [(z, table, upsert) for table in level])
+            for level in reversed(levels):
+                res += _run_jobs(jobs, delete_rows,
+                    [(z, table) for table in level])
+            for (table, cnt, t) in res:
+                timings[table][0] += cnt
+                timings[table][1] += t
+
+        if not quiet:
+            print("\rCreating indexes                                 ", end="")
+        d.create_indexes()
+        # the journal refers to the previous content of the db
+        if start_journal:
+            d.start_change_journal()
         if not quiet:
-            print("\rDone                          ")
+            print("\rDone                                             ")
+
+    return [(table, cnt, t) for (table, (cnt, t)) in timings.items()]
+
+class _Counter:
+    # count the items returned by an iterator
+    def __init__(self, it):
+        self._it = iter(it)
+        self.count = 0
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        ret = next(self._it)
+        self.count += 1
+        return ret
 
-def dump_tables(nf, d, quiet=False):
-        import zipfile
-        import tempfile
-        import os
+def _can_run_jobs(d):
+    # the bbserver client has only one socket, and a sqlite memory db
+    # only one connection
+    return isinstance(d, _BaseServer) and d._conn_per_thread
+
+def _run_jobs(jobs, func, args_list):
+    # call func(*args) for each args of args_list using up to 'jobs'
+    # threads; each thread uses its connection of the db pool
+    if jobs <= 1 or len(args_list) <= 1:
+        return [func(*args) for args in args_list]
+
+    import concurrent.futures
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as ex:
+        futures = [ex.submit(func, *args) for args in args_list]
+        return [f.result() for f in futures]
+
+def print_timings(timings):
+    print("%-20s %12s %10s %12s"%("table", "rows", "seconds", "rows/s"))
+    for (table, cnt, t) in timings:
+        print("%-20s %12d %10.2f %12.0f"%(table, cnt, t, cnt / max(t, 0.001)))
+
+def _read_backup_info(z):
+    # the backups made before the incremental ones don't have this file
+    import json
+
+    if not "backup.json" in z.namelist():
+        return None
+    return json.loads(z.read("backup.json").decode("utf-8"))
+
+def _is_create_index(s):
+    s = "\n".join([l for l in s.split("\n")
+        if not l.strip().startswith("--")])
+    s = " ".join(s.upper().split())
+    return s.startswith("CREATE INDEX ") or s.startswith("CREATE UNIQUE INDEX ")
+
+def _read_table_rows(f):
+    # parse the rows one at time, instead of reading the whole table
+    for line in f:
+        yield list(map(xunescape, line.decode("utf-8").rstrip("\n\r").split("\t")))
+
+def _print_progress(table, rows):
+    time0 = time.time()
+    cnt = 0
+    for row in rows:
+        yield row
+        cnt += 1
+        if cnt % 10000 == 0:
+            print("\r%s: %d rows, %.0f rows/s                 "%(
+                table, cnt, cnt / max(time.time() - time0, 0.001)), end="")
+    print("\r%s: %d rows, %.0f rows/s                 "%(
+        table, cnt, cnt / max(time.time() - time0, 0.001)), end="")
+
+def dump_tables(nf, d, quiet=False, base=None, jobs=1, start_journal=False):
+    # base is a previous backup (full or incremental) of the same db: if
+    # it is passed, only the rows inserted, updated or deleted after it
+    # are dumped; up to 'jobs' tables are read in parallel, each one by
+    # its connection. If start_journal is True and the change journal is
+    # not started, it is started (this writes to the db) so the backup can
+    # be the base of the next incremental ones. Return the timings of each
+    # table
+    import zipfile
+    import io
+    import json
+    import tempfile
+    import os
+
+    base_info = None
+    if not base is None:
+        with zipfile.ZipFile(base) as z:
+            base_info = _read_backup_info(z)
+        if base_info is None or base_info["journal_id"] is None:
+            raise DBException(
+                "EBACKUPCHAIN: '%s' cannot be the base of an incremental backup"%(base))
+
+    watermarks = d.get_backup_watermarks()
+    if start_journal and watermarks["journal_id"] is None:
+        d.start_change_journal()
+        watermarks = d.get_backup_watermarks()
+    if (not base_info is None and
+        base_info["journal_id"] != watermarks["journal_id"]):
+            raise DBException(
+                "EBACKUPCHAIN: the journal was restarted after '%s'"%(base))
+
+    info = dict(watermarks)
+    info["backup_id"] = uuid.uuid4().hex
+    info["base_backup_id"] = None
+    if not base_info is None:
+        info["base_backup_id"] = base_info["backup_id"]
+
+    if not _can_run_jobs(d):
+        jobs = 1
+
+    def get_table(tname):
+        if base_info is None:
+            return (*d.dump_table(tname), None)
+        return d.dump_table_changes(tname,
+            base_info["tables"].get(tname, 0), base_info["journal"])
+
+    def write_table(f, tname):
+        time0 = time.time()
+        (columns, data, deleted) = get_table(tname)
+        f.write("\t".join(columns)+"\n")
+        if not quiet and jobs == 1:
+            data = _print_progress(tname, data)
+        cnt = 0
+        for row in data:
+            f.write("\t".join(map(xescape, row))+"\n")
+            cnt += 1
+        return (deleted, cnt, time.time() - time0)
 
-        z=zipfile.ZipFile(nf, "w", compression=zipfile.ZIP_DEFLATED)
+    def write_table_tmp(tname):
+        # the entries of a zip file cannot be written concurrently
         tmpfilename = tempfile.NamedTemporaryFile(delete=False).name
-        try:
-            for (tname, columns, data) in d.dump_tables():
-
-                with open(tmpfilename, "w", encoding='utf-8') as f:
-                    f.write("\t".join(columns)+"\n")
-                    cnt = 0
-                    for row in data:
-                        f.write("\t".join(map(xescape, row))+"\n")
-                        if not quiet:
-                            print("%s: %d                                 \r"%(tname, cnt), end="")
-                        cnt += 1
-
-                z.write(tmpfilename, arcname="%s.csv"%(tname))
-        finally:
+        tmpfilenames.append(tmpfilename)
+        with open(tmpfilename, "w", encoding="utf-8", newline="") as f:
+            return (tmpfilename, *write_table(f, tname))
+
+    timings = []
+    tmpfilenames = []
+    try:
+        with zipfile.ZipFile(nf, "w", compression=zipfile.ZIP_DEFLATED) as z:
+            tables = d.list_main_tables()
+            if jobs > 1:
+                res = _run_jobs(jobs, write_table_tmp,
+                    [(tname, ) for tname in tables])
+            else:
+                res = [None for tname in tables]
+
+            for (tname, r) in zip(tables, res):
+                if r is None:
+                    # the size is not known in advance: allow the zip64
+                    # extensions
+                    with z.open("%s.csv"%(tname), "w", force_zip64=True) as zf:
+                        f = io.TextIOWrapper(zf, encoding="utf-8", newline="")
+                        (deleted, cnt, t) = write_table(f, tname)
+                        f.flush()
+                        f.detach()
+                else:
+                    (tmpfilename, deleted, cnt, t) = r
+                    z.write(tmpfilename, arcname="%s.csv"%(tname))
+
+                if not deleted is None:
+                    z.writestr("%s.deleted"%(tname),
+                        "".join(["%d\n"%(x) for x in deleted]))
+                timings.append((tname, cnt, t))
+
+            z.writestr("backup.json", json.dumps(info, indent=4))
+    finally:
+        for tmpfilename in tmpfilenames:
             if os.path.exists(tmpfilename):
                 os.unlink(tmpfilename)
 
+    if not quiet:
+        print()
+
+    return timings
+
 def new_db(d):
     d.create_db()
     d.create_first_code()
 
+def bench_sql_translate(d, code, loops=20):
+    # explode the bom of 'code' recording the executed queries, then
+    # measure the time spent to translate them by each backend, with and
+    # without the cache
+    code_id = d.get_codes_by_code(code)[0][0]
+    date_from_days = d.get_dates_by_code_id3(code_id)[0][2]
+
+    queries = []
+    translate = d._sql_translate_cached
+    d._sql_translate_cached = lambda q: (queries.append(q), translate(q))[1]
+    try:
+        top, data = d._get_bom_by_code_id3(code_id, date_from_days)
+    finally:
+        del d._sql_translate_cached
+
+    print("bom of %s: %d nodes, %d queries"%(code, len(data), len(queries)))
+    for cls in [DBSQLite, DBPG, DBMySQL, DBSQLServer, DBOracleServer]:
+        # don't call __init__(): the drivers may be not installed
+        inst = object.__new__(cls)
+
+        time0 = time.time()
+        for i in range(loops):
+            for q in queries:
+                inst._sql_translate(q)
+        time1 = time.time()
+        _sql_translate_caches.pop(cls, None)
+        for i in range(loops):
+            for q in queries:
+                inst._sql_translate_cached(q)
+        time2 = time.time()
+
+        n = loops * len(queries)
+        print("%-15s: %8.2f us/query, cached %8.2f us/query"%(
+            cls.__name__, (time1 - time0) / n * 1e6,
+            (time2 - time1) / n * 1e6))
+
+def bench_bom_colors(d, code, rules=None):
+    # evaluate the colors of all the rows of the bom of 'code' in the
+    # way of the assembly window, re-scanning the path or by BomColors
+    import utils, cfg
+
+    code_id = d.get_codes_by_code(code)[0][0]
+    date_from_days = d.get_dates_by_code_id3(code_id)[0][2]
+    top, data = d.get_bom_by_code_id3(code_id, date_from_days)
+
+    if rules is None:
+        rules = cfg.get_bomcolors()
+    if len(rules) == 0:
+        rules = []
+        for i in range(10):
+            rules.append((["code=%s-%03d"%(code[:-4], i)], ["fg=red"]))
+            rules.append((["*gaval1=G%d"%(i), "unit=NR"], ["bg=yellow"]))
+            rules.append((["*code=!%s"%(code), "iter=%d"%(i)], ["italic"]))
+
+    paths = utils._bom_paths(top, data)
+    print("bom of %s: %d codes, %d rows, %d rules"%(
+        code, len(data), len(paths), len(rules)))
+
+    time0 = time.time()
+    res1 = [utils._bom_colors_by_path(rules, data, path) for path in paths]
+    time1 = time.time()
+
+    colors = utils.BomColors(rules)
+    res2 = []
+    todo = [(top, None, 0, (top,))]
+    while len(todo):
+        (key, parent_key, state, path) = todo.pop()
+        if parent_key is None:
+            state, actions = colors.match(state, key, data[key])
+        else:
+            state, actions = colors.match(state, key, data[key],
+                                parent_key, data[parent_key]["deps"][key])
+        res2.append(actions)
+        # skip the children which are also an ancestor: it is a loop
+        for c in reversed(list(data[key]["deps"])):
+            if not c in path:
+                todo.append((c, key, state, path + (c,)))
+    time2 = time.time()
+
+    assert(res1 == res2)
+    print("path scan: %8.3f s"%(time1 - time0))
+    print("BomColors: %8.3f s"%(time2 - time1))
+
 def main(prgname, args):
     import cfg
 
@@ -2368,12 +3921,32 @@ def main(prgname, args):
     dbtype = cfg.config()["BOMBROWSER"]["db"]
     conf = cfg.config()[dbtype.upper()]
 
+    jobs = 1
+    if (len(args) >= 3 and args[0] in ["--dump-tables", "--restore-tables"]
+            and "--jobs" in args):
+        i = args.index("--jobs")
+        jobs = int(args[i+1])
+        args = args[:i] + args[i+2:]
+
+    start_journal = False
+    if (len(args) >= 3 and args[0] in ["--dump-tables", "--restore-tables"]
+            and "--start-journal" in args):
+        start_journal = True
+        args = [x for x in args if x != "--start-journal"]
+
     if len(args) == 2 and args[0] == "--dump-tables":
         init(dbtype, dict(conf))
         d = get_db_instance()
-        dump_tables(args[1], d)
+        print_timings(dump_tables(args[1], d, jobs=jobs,
+                                  start_journal=start_journal))
         print("DB dumped")
 
+    elif len(args) == 4 and args[0] == "--dump-tables" and args[2] == "--base":
+        init(dbtype, dict(conf))
+        d = get_db_instance()
+        print_timings(dump_tables(args[1], d, base=args[3], jobs=jobs))
+        print("DB dumped (incremental)")
+
     elif len(args) >= 1 and args[0] == "--new-db":
         global gavals_count, gvals_count
 
@@ -2407,6 +3980,16 @@ def main(prgname, args):
         new_db(d)
         print("DB created")
 
+    elif len(args) == 2 and args[0] == "--bench-sql-translate":
+        init(dbtype, dict(conf))
+        d = get_db_instance()
+        bench_sql_translate(d, args[1])
+
+    elif len(args) == 2 and args[0] == "--bench-bom-colors":
+        init(dbtype, dict(conf))
+        d = get_db_instance()
+        bench_bom_colors(d, args[1])
+
     elif len(args) == 1 and args[0] == "--info-db":
         init(dbtype, dict(conf))
         d = get_db_instance()
@@ -2416,10 +3999,9 @@ def main(prgname, args):
         print("number of 'gaval' columns: %d"%(gavals_count))
 
     elif len(args) >= 2 and args[0] == "--restore-tables":
-        if len(args) == 3:
-            if args[1] == "--yes-really-i-know-what-i-want":
-                args=[args[0], args[2]]
-            else:
+        if args[1] == "--yes-really-i-know-what-i-want":
+            args = [args[0]] + args[2:]
+            if len(args) < 2:
                 print("ERROR: exit")
                 return
         else:
@@ -2431,13 +4013,17 @@ def main(prgname, args):
 
         init(dbtype, dict(conf))
         d = get_db_instance()
-        restore_tables(args[1], d)
+        print_timings(restore_tables(args[1], d, increments=args[2:],
+            jobs=jobs, start_journal=start_journal))
         print("DB restored")
 
     else:
-        print("usage: %s --dump-tables <file.zip>"%(prgname))
+        print("usage: %s --dump-tables <file.zip> [--start-journal] [--jobs N]"%(prgname))
+        print("usage: %s --dump-tables <file.zip> --base <prev-backup.zip> [--jobs N]"%(prgname))
         print("usage: %s --new-db [--gval_count=nn][--gaval_count=nn]"%(prgname))
-        print("usage: %s --restore-tables <file.zip>"%(prgname))
+        print("usage: %s --restore-tables <file.zip> [<incremental.zip>...] [--start-journal] [--jobs N]"%(prgname))
         print("usage: %s --info-db"%(prgname))
+        print("usage: %s --bench-sql-translate <code>"%(prgname))
+        print("usage: %s --bench-bom-colors <code>"%(prgname))
         sys.exit(0)
 
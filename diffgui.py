@@ -24,9 +24,10 @@ from PySide2.QtWidgets import QTextEdit, QHBoxLayout, QCheckBox
 from PySide2.QtWidgets import QLabel, QLineEdit
 from PySide2.QtWidgets import QGridLayout, QWidget, QApplication, QPushButton
 from PySide2.QtWidgets import QMessageBox, QAction, QDialog
-from PySide2.QtCore import Qt, Signal
+from PySide2.QtGui import QTextCursor
+from PySide2.QtCore import Qt, Signal, QTimer
 
-import db, utils, selectdategui, bbwindow, cfg, importer, editcode
+import db, utils, selectdategui, bbwindow, cfg, importer, editcode, bomdiff
 import utils
 
 class BomImported(QWidget):
@@ -217,6 +218,11 @@ class DiffWindow(bbwindow.BBMainWindow):
 
         self._bom1 = bom1
         self._bom2 = bom2
+        self._render_iter = None
+        self._hashes_cache = dict()
+        self._render_chunk = 200
+        self._render_timer = QTimer(self)
+        self._render_timer.timeout.connect(self._render_next)
         self._init_gui()
         self._create_menu()
         self._create_statusbar()
@@ -315,6 +321,8 @@ class DiffWindow(bbwindow.BBMainWindow):
             QApplication.restoreOverrideCursor()
 
     def _do_diff(self):
+        self._render_timer.stop()
+
         code1, data1 = self._bom1.getBom()
         code2, data2 = self._bom2.getBom()
 
@@ -322,247 +330,123 @@ class DiffWindow(bbwindow.BBMainWindow):
             self._text.setText("Cannot perform diff")
             return
 
-        # put the head of boms to the same ID to ensure to compare the "same" head
-        if code1 != code2:
-            data1 = data1.copy()
-            data2 = data2.copy()
-
-            # check that both the bom have the same key (str/str or int/int)
-            assert( isinstance(list(data1.keys())[0], str) ==
-                   isinstance(list(data2.keys())[0], str))
-
-            # create a code that is not shared between the two bom
-            if isinstance(list(data1.keys())[0], str):
-                code3 = "private-code-"
-                while code3 in data1.keys() or code3 in data2.keys():
-                    code3 += "x"
-            else:
-                code3 = 9999999999
-                while code3 in data1.keys() or code3 in data2.keys():
-                    code3 *= 9999
-
-            data1[code3] = data1[code1]
-            data1[code3]["id"] = code3
-            data2[code3] = data2[code2]
-            data2[code3]["id"] = code3
-            data1.pop(code1)
-            data2.pop(code2)
-
-            # unlikely, but check that the boms don't have any reference
-            # to the removed code1/code2
-            for code, data in data1.items():
-                if not code1 in data["deps"]:
-                    continue
-                data["deps"][code3] = data["deps"][code1]
-                data["deps"].pop(code1)
-
-            for code, data in data2.items():
-                if not code2 in data["deps"]:
-                    continue
-                data["deps"][code3] = data["deps"][code2]
-                data["deps"].pop(code2)
-        else:
-            code3 = code1
-
         gvals = cfg.get_gvalnames2()
 
-        if self._cb_only_top_code.isChecked():
-            keys = [code3]
-        else:
-            keys = list(set(data1.keys()).union(data2.keys()))
-            keys.sort()
-
-        if self._cb_minimal.isChecked():
-            allowed_keys = [
-                "qty", "descr", "code", "ver"
-            ]
-        else:
-            allowed_keys = None
-
-        only_shared = self._cb_only_shared_prop.isChecked()
+        changes = bomdiff.diff_boms(code1, data1, code2, data2,
+            only_top_code=self._cb_only_top_code.isChecked(),
+            minimal=self._cb_minimal.isChecked(),
+            only_shared=self._cb_only_shared_prop.isChecked(),
+            gvalnames=[gvalname for (seq, idx, gvalname, caption, type_)
+                            in gvals],
+            hashes_cache=self._hashes_cache)
 
         self._text.clear()
+        self._my_statusbar.showMessage("%d code(s) changed"%(len(changes)))
 
-        txt = ""
+        # render the changes a chunk at time, to keep the gui responsive
+        self._render_iter = changes_to_html(changes, gvals)
+        self._render_timer.start(0)
 
-        item_props_blacklist = set(["id", "rid", "deps",
-            "date_from_days", "date_to_days"])
-
-        def is_children_equal(c1, c2):
-            for k in ["qty", "each", "unit", "ref"]:
-                if allowed_keys and not k in allowed_keys:
-                    continue
-                if c1[k] != c2[k]:
-                    return False
-
-            return True
-
-        def is_codes_equal(c1, c2):
-            k1 = set(c1.keys())
-            k2 = set(c2.keys())
-            if only_shared:
-                k3 = k1.intersection(k2)
-                k1 = k3
-                k2 = k3
-            if allowed_keys:
-                k1 = k1.intersection(allowed_keys)
-                k2 = k2.intersection(allowed_keys)
-            if k1 != k2:
-                return False
-
-            k1.difference_update(item_props_blacklist)
-            for k in k1:
-                if c1[k] != c2[k]:
-                    return False
-
-            if c1["deps"].keys() != c2["deps"].keys():
-                return False
-
-            for k in c1["deps"].keys():
-                if not is_children_equal(c1["deps"][k], c2["deps"][k]):
-                    return False
-
-            return True
-
-        def makeRed(s):
-            s = html.escape(s)
-            s = "<font color=red>"+s+"</font><br>"
-            return s
-        def makeGreen(s):
-            s = html.escape(s)
-            s = "<font color=green>"+s+"</font><br>"
-            return s
-        def pretty_float(f):
-            s="%f"%(f)
-            while len(s) > 1 and s[-1] in "0.":
-                s = s[:-1]
-            return s
-        def dump_child(child_dep, child_data):
-            s = "%s / %s %s: %s"%(
-                    pretty_float(child_dep["qty"]),
-                    pretty_float(child_dep["each"]),
-                    child_dep["unit"],
-                    child_data["code"])
-            if ((not allowed_keys or "ver" in allowed_keys) and
-                    "ver" in child_data):
-                s += " rev %s"%(child_data["ver"])
-            if ((not allowed_keys or "descr" in allowed_keys) and
-                    "descr" in child_data):
-                s += " - %s"%(child_data["descr"])
-            if ((not allowed_keys or "ref" in allowed_keys) and
-                    "ref" in child_data):
-                s += ";- %s"%(child_dep["ref"])
-            return s
-        def dump_code(c):
-            s = " code: %s"%(c["code"])
-            if ((not allowed_keys or "ver" in allowed_keys) and
-                    "ver" in c):
-                s += " rev %s"%(c["ver"])
-            if ((not allowed_keys or "descr" in allowed_keys) and
-                    "descr" in c):
-                s += " - %s"%(c["descr"])
-            return s
-
-        for key in keys:
-            if key in data1.keys() and key in data2.keys():
-                if is_codes_equal(data1[key], data2[key]):
-                        continue
-
-                txt += "<br>\n"
-                # diff between the same code
-                txt += html.escape(dump_code(data1[key])) + "<br>"
-
-                if only_shared:
-                    keys = set(data1[key].keys()).intersection(data2[key].keys())
-                    keys.difference_update(item_props_blacklist)
-                    keys = list(keys)
-                    keys.sort()
-                else:
-                    keys = set(data1[key].keys()).union(data2[key].keys())
-                    keys.difference_update(item_props_blacklist)
-                    keys = list(keys)
-                    keys.sort()
-                    keys = [x for x in keys if not x.startswith("gval")]
-                    keys = keys + [gvalname for (seq, idx, gvalname, caption, type_) in gvals]
-
-                if allowed_keys:
-                    keys = [ x for x in keys if x in allowed_keys]
-
-                for key2 in keys:
-                    if (key2 in data1[key] and key2 in data2[key] and
-                            data1[key][key2] == data2[key][key2]):
-                        continue
-                    name = key2
-                    if name.startswith("gval"):
-                        for (seq, idx, gvalname, caption, type_) in gvals:
-                            if gvalname == name:
-                                name = caption
-                                break
-                    # exchange ver -> rev
-                    if name == 'ver':
-                        name = 'rev'
-                    if key2 in data1[key]:
-                        txt += "&nbsp;" * 5 + makeRed(
-                                "-%s: %s\n"%(name, data1[key][key2]))
-                    if key2 in data2[key]:
-                        txt += "&nbsp;" * 5 + makeGreen(
-                            "+%s: %s\n"%(name, data2[key][key2]))
-
-                child_ids = list(set(data1[key]["deps"].keys()).union(
-                                     data2[key]["deps"].keys()))
-                child_ids.sort()
-
-                for child_id in child_ids:
-                    if child_id in data1[key]["deps"].keys() and child_id in data2[key]["deps"].keys():
-                        if is_children_equal(data1[key]["deps"][child_id], data2[key]["deps"][child_id]):
-                            continue
-
-                    if child_id in data1[key]["deps"].keys():
-                        child =data1[key]["deps"][child_id]
-                        txt += "&nbsp;" * 9 + makeRed("-" +
-                            dump_child(child, data1[child_id]))
-                    if child_id in data2[key]["deps"].keys():
-                        child =data2[key]["deps"][child_id]
-                        txt += "&nbsp;" * 9 + makeGreen("+" +
-                            dump_child(child, data2[child_id]))
-
-            elif  key in data1.keys():
-                txt += "<br>\n"
-                txt += makeRed("-" + dump_code(data1[key])) + "\n"
-                txt += "&nbsp;" * 5 + "[....]<br>\n"
-            else: # key in data2.keys()
-                txt += "<br>\n"
-                txt += makeGreen("+" + dump_code(data2[key])) + "\n"
-
-                keys = set(data2[key].keys())
-                keys.difference_update(item_props_blacklist)
-                keys = list(keys)
-                keys.sort()
-                keys = [x for x in keys if not x.startswith("gval")]
-                keys = keys + [gvalname for (seq, idx, gvalname, caption, type_) in gvals]
-                if allowed_keys:
-                    keys = [ x for x in keys if x in allowed_keys]
-
-                for key2 in  keys:
-                    name = key2
-                    if name.startswith("gval"):
-                        for (seq, idx, gvalname, caption, type_) in gvals:
-                            if gvalname == name:
-                                name = caption
-                                break
-                    if key2 in data2[key]:
-                        txt += "&nbsp;" * 5 + makeGreen(
-                            "+%s: %s\n"%(name, data2[key][key2]))
-
-                child_ids = list(data2[key]["deps"].keys())
-                child_ids.sort()
-
-                for child_id in child_ids:
-                    child =data2[key]["deps"][child_id]
-                    txt += "&nbsp;" * 9 + makeGreen("+" +
-                        dump_child(child, data2[child_id]))
-
-        self._text.setText(txt)
+    def _render_next(self):
+        txt = ""
+        for i in range(self._render_chunk):
+            s = next(self._render_iter, None)
+            if s is None:
+                self._render_timer.stop()
+                break
+            txt += s
+
+        if txt == "":
+            return
+        cursor = self._text.textCursor()
+        cursor.movePosition(QTextCursor.End)
+        cursor.insertHtml(txt)
+
+def _make_red(s):
+    s = html.escape(s)
+    s = "<font color=red>"+s+"</font><br>"
+    return s
+
+def _make_green(s):
+    s = html.escape(s)
+    s = "<font color=green>"+s+"</font><br>"
+    return s
+
+def _pretty_float(f):
+    s="%f"%(f)
+    while len(s) > 1 and s[-1] in "0.":
+        s = s[:-1]
+    return s
+
+def _dump_child(child):
+    s = "%s / %s %s: %s"%(
+            _pretty_float(child["qty"]),
+            _pretty_float(child["each"]),
+            child["unit"],
+            child["code"])
+    if "ver" in child:
+        s += " rev %s"%(child["ver"])
+    if "descr" in child:
+        s += " - %s"%(child["descr"])
+    return s
+
+def _dump_code(c):
+    s = " code: %s"%(c["code"])
+    if "ver" in c:
+        s += " rev %s"%(c["ver"])
+    if "descr" in c:
+        s += " - %s"%(c["descr"])
+    return s
+
+def changes_to_html(changes, gvals):
+    """
+        Yield the html text of each change returned by bomdiff.diff_boms()
+    """
+    captions = dict((gvalname, caption)
+        for (seq, idx, gvalname, caption, type_) in gvals)
+
+    for change in changes:
+        txt = "<br>\n"
+        if change["type"] == "changed":
+            # diff between the same code
+            txt += html.escape(_dump_code(change)) + "<br>"
+
+            for p in change["props"]:
+                name = captions.get(p["name"], p["name"])
+                # exchange ver -> rev
+                if name == 'ver':
+                    name = 'rev'
+                if "from" in p:
+                    txt += "&nbsp;" * 5 + _make_red(
+                            "-%s: %s\n"%(name, p["from"]))
+                if "to" in p:
+                    txt += "&nbsp;" * 5 + _make_green(
+                        "+%s: %s\n"%(name, p["to"]))
+
+            for child in change["children"]:
+                if "from" in child:
+                    txt += "&nbsp;" * 9 + _make_red("-" +
+                        _dump_child(child["from"]))
+                if "to" in child:
+                    txt += "&nbsp;" * 9 + _make_green("+" +
+                        _dump_child(child["to"]))
+
+        elif change["type"] == "removed":
+            txt += _make_red("-" + _dump_code(change)) + "\n"
+            txt += "&nbsp;" * 5 + "[....]<br>\n"
+        else: # added
+            txt += _make_green("+" + _dump_code(change)) + "\n"
+
+            for p in change["props"]:
+                name = captions.get(p["name"], p["name"])
+                txt += "&nbsp;" * 5 + _make_green(
+                    "+%s: %s\n"%(name, p["value"]))
+
+            for child in change["children"]:
+                txt += "&nbsp;" * 9 + _make_green("+" +
+                    _dump_child(child["to"]))
+
+        yield txt
 
 class DiffDialog(QDialog):
     def __init__(self):
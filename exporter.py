@@ -21,6 +21,10 @@ import sys
 import os
 import json
 import io
+import collections.abc
+import tempfile
+import pickle
+import heapq
 
 import csv
 import xlwt
@@ -29,6 +33,10 @@ import cfg
 import utils
 import db
 
+# the sorted exports keep in memory at most this number of rows; the
+# others are sorted in temporary files
+export_sort_chunk_rows = 100000
+
 def get_template_list():
     ret = []
     template_list = utils.split_with_escape(
@@ -49,11 +57,17 @@ class Exporter:
         self._drawings_and_urls = dict()
 
     def export_as_json(self, nf):
+        # the bom nodes are mappings, but not dicts
+        def default(v):
+            if isinstance(v, collections.abc.Mapping):
+                return dict(v)
+            return str(v)
+
         f = open(nf, "w")
         json.dump({
             "root": self._rootnode,
             "data": self._data
-        }, f, sort_keys=True, indent=4, default=str)
+        }, f, sort_keys=True, indent=4, default=default)
         f.close()
 
 
@@ -75,78 +89,121 @@ class Exporter:
 # date_from -> from date
 # date_to -> date_to
 
-    def _export_as_table_by_template_it(self, unique, table, columns,
-                key, level=0, qty="", each="", unit="", ref="", parent="",
-                parent_descr="", maxlevel=-1):
-
-        if maxlevel != -1 and level >= maxlevel:
-            return
-
-        if unique:
-            if key in self._did:
-                return
-            self._did.add(key)
-
-        if key in self._path:
-            table.append(["loop" for x in columns])
-            self._seq += 1
-            return
-
-        self._path = self._path[:level] + [key]
-
-        row = []
-        item = self._data[key]
-        for col in columns:
+    # the values of the link to the parent passed to the row columns
+    _edge_columns = ["qty", "each", "unit", "ref", "parent", "parent_descr"]
+
+    def _compile_columns(self, columns):
+        # return (code_columns, row_columns); both are list of (index, func).
+        # The code columns depend only by the code: func(item) is called
+        # once per code. The row columns depend by the position of the
+        # code in the bom: func(seq, level, edge, code) is called for
+        # each row, where edge are the values of self._edge_columns
+        code_columns = []
+        row_columns = []
+        for i, col in enumerate(columns):
             if col=="seq":
-                row += [self._seq]
+                row_columns.append((i,
+                    lambda seq, level, edge, code: seq))
             elif col=="level":
-                row += [level]
-            elif col=="qty":
-                row += [qty]
-            elif col=="each":
-                row += [each]
-            elif col=="ref":
-                row += [ref]
-            elif col=="parent_descr":
-                row += [parent_descr]
-            elif col=="unit":
-                row += [unit]
-            elif col=="parent":
-                row += [parent]
+                row_columns.append((i,
+                    lambda seq, level, edge, code: level))
+            elif col in self._edge_columns:
+                j = self._edge_columns.index(col)
+                row_columns.append((i,
+                    lambda seq, level, edge, code, j=j: edge[j]))
             elif col=="rev":
-                row += [item["ver"]]
+                code_columns.append((i, lambda item: item["ver"]))
             elif col=="drawings":
-                rid = item["rid"]
-                if rid in self._drawings_and_urls:
-                    l = self._drawings_and_urls[rid]
-                else:
-                    l = []
-                row += [", ".join(l)]
+                code_columns.append((i, lambda item: ", ".join(
+                    self._drawings_and_urls.get(item["rid"], []))))
             elif col=="indented_code":
-                row += ["... "*level + item["code"]]
+                row_columns.append((i,
+                    lambda seq, level, edge, code: "... "*level + code))
             elif col in ["code", "descr", "iter", "date_from", "date_to"]:
-                row += [item[col]]
-            elif col.startswith("gval") and col in item:
-                row += [item[col]]
+                code_columns.append((i, lambda item, col=col: item[col]))
+            elif col.startswith("gval"):
+                code_columns.append((i, lambda item, col=col: item[col]
+                    if col in item else "Unknown col '%s'"%(col)))
             elif col.startswith("'"):
-                col = col[1:]
-                row += [col]
+                code_columns.append((i, lambda item, col=col: col[1:]))
             elif col == "":
-                row += [""]
+                code_columns.append((i, lambda item: ""))
             else:
-                row += ["Unknown col '%s'"%(col)]
-
-        table.append([str(x) for x in row])
-        self._seq += 1
-        for child_id in item["deps"]:
-            child = item["deps"][child_id]
-            self._export_as_table_by_template_it(unique, table, columns,
-                child_id, level + 1, child["qty"], child["each"],
-                child["unit"], child["ref"],
-                item["code"], item["descr"],
-                maxlevel=maxlevel)
+                code_columns.append((i,
+                    lambda item, col=col: "Unknown col '%s'"%(col)))
+
+        return code_columns, row_columns
+
+    def _export_as_table_by_template_it(self, unique, columns, rootnode,
+                maxlevel=-1):
+        # walk the bom with an explicit stack, yielding a row for each code
+        code_columns, row_columns = self._compile_columns(columns)
+
+        # key -> (code, partial row, [(child_id, edge), ...])
+        nodes = dict()
+        def get_node(key):
+            item = self._data[key]
+            row = ["" for x in columns]
+            for i, f in code_columns:
+                row[i] = str(f(item))
+            code = item["code"]
+            descr = item["descr"]
+            deps = item["deps"]
+            children = []
+            for child_id in deps:
+                child = deps[child_id]
+                children.append((child_id, (child["qty"], child["each"],
+                    child["unit"], child["ref"], code, descr)))
+            children.reverse()
+            nodes[key] = (code, row, children)
+            return nodes[key]
+
+        loop_row = ["loop" for x in columns]
+        seq = 0
+        # (key, level, edge); level == -1 means: remove key from the path
+        stack = [(rootnode, 0, ("", "", "", "", "", ""))]
+        while len(stack):
+            key, level, edge = stack.pop()
+            if level < 0:
+                self._path.remove(key)
+                continue
+
+            if maxlevel != -1 and level >= maxlevel:
+                continue
+
+            if unique:
+                if key in self._did:
+                    continue
+                self._did.add(key)
+
+            if key in self._path:
+                yield list(loop_row)
+                seq += 1
+                continue
+
+            node = nodes.get(key)
+            if node is None:
+                node = get_node(key)
+            code, row, children = node
+
+            # only the codes involved in a loop can be repeated in a path
+            if key in self._loop_codes:
+                self._path.add(key)
+                stack.append((key, -1, None))
+
+            row = list(row)
+            for i, f in row_columns:
+                row[i] = str(f(seq, level, edge, code))
+            yield row
+            seq += 1
+
+            level += 1
+            for child_id, edge in children:
+                stack.append((child_id, level, edge))
 
     def _export_as_table_by_template(self, template_name):
+        # return (rows, captions); the rows are generated while the bom
+        # is walked, so they can be consumed only once
 
         columns = []
         captions = []
@@ -169,11 +226,11 @@ class Exporter:
 
         if "drawings" in columns and len(self._drawings_and_urls) == 0:
             d = db.get_db_instance()
-            fnl = []
-            for k, v in self._data.items():
-                rid = v["rid"]
+            ret = d.get_drawings_by_rids(
+                [v["rid"] for v in self._data.values()])
+            for rid, drawings in ret.items():
                 self._drawings_and_urls[rid] = []
-                for descr, url in d.get_drawings_and_urls_by_rid(rid):
+                for descr, url in drawings:
                     if utils.is_url(url):
                         self._drawings_and_urls[rid].append(url)
                     else:
@@ -183,18 +240,17 @@ class Exporter:
         sortby=int(cfg.config()[template_name].get("sortby", -1))
         unique=int(cfg.config()[template_name].get("unique", 0))
         maxlevel=int(cfg.config()[template_name].get("maxlevel", -1))
-        table = []
 
-        self._seq = 0
         self._did = set()
-        self._path = []
+        self._path = set()
+        self._loop_codes = utils.get_loop_codes(self._rootnode, self._data)
 
-        self._export_as_table_by_template_it(unique, table, columns,
+        table = self._export_as_table_by_template_it(unique, columns,
             self._rootnode, maxlevel=maxlevel)
 
-
         if sortby >= 0:
-            table.sort(key=lambda x : x[sortby])
+            table = _sort_rows(table, lambda x : x[sortby],
+                export_sort_chunk_rows)
 
         return table, captions
 
@@ -204,8 +260,7 @@ class Exporter:
         f = io.StringIO()
         writer = csv.writer(f, delimiter="\t",  quoting=csv.QUOTE_MINIMAL)
         writer.writerow(captions)
-        for line in table:
-            writer.writerow(line)
+        writer.writerows(table)
         return f.getvalue()
 
     def export_as_file_by_template2(self, nf, template_section):
@@ -239,8 +294,8 @@ class Exporter:
                                     quotechar=quotechar,
                                     quoting=csv.QUOTE_ALL)
             writer.writerow(captions)
-            for line in table:
-                writer.writerow(line)
+            writer.writerows(table)
+            f.close()
         elif mode == "XLS":
             wb = xlwt.Workbook()
             ws = wb.add_sheet('BOMBrowser0')
@@ -251,6 +306,39 @@ class Exporter:
                     ws.write(r+1, c, t)
             wb.save(nf)
 
+def _sort_rows(rows, key, chunk_rows):
+    # like sorted(rows, key=key), but at most 'chunk_rows' rows are kept
+    # in memory: the sorted chunks are saved in temporary files and then
+    # merged. As list.sort(), the sort is stable
+    def read_chunk(f):
+        f.seek(0)
+        while True:
+            try:
+                yield pickle.load(f)
+            except EOFError:
+                return
+
+    files = []
+    try:
+        chunk = []
+        for row in rows:
+            chunk.append(row)
+            if len(chunk) < chunk_rows:
+                continue
+            chunk.sort(key=key)
+            f = tempfile.TemporaryFile()
+            for row in chunk:
+                pickle.dump(row, f, pickle.HIGHEST_PROTOCOL)
+            files.append(f)
+            chunk = []
+
+        chunk.sort(key=key)
+        yield from heapq.merge(*[read_chunk(f) for f in files], chunk,
+            key=key)
+    finally:
+        for f in files:
+            f.close()
+
 def test_get_template_list():
     cfg._cfg = {
         "BOMBROWSER": {
@@ -676,6 +764,81 @@ def test_export_gval1():
     assert("C-descr" in r)
     assert("C-gval1" in r)
 
+def test_sort_rows():
+    rows = [[str(i % 7), str(i)] for i in range(100)]
+    ref = sorted(rows, key=lambda x : x[0])
+    for chunk_rows in [1, 3, 10, 100, 1000]:
+        ret = list(_sort_rows(iter(rows), lambda x : x[0], chunk_rows))
+        # the sort is stable
+        assert(ret == ref)
+
+    assert(list(_sort_rows(iter([]), lambda x : x[0], 10)) == [])
+
+def test_export_sortby():
+    global export_sort_chunk_rows
+
+    cfg._cfg = {
+        "BOMBROWSER": {
+            "templates_list": "template_simple"
+        },
+        "template_simple" :  {
+            "name": "template simple",
+            "columns": """
+                seq:Seq
+                descr:Descr
+                code:Code
+            """,
+            "sortby": "1",
+        },
+    }
+
+    bom = _get_test_bom()
+
+    old_chunk_rows = export_sort_chunk_rows
+    try:
+        export_sort_chunk_rows = 2
+        e = Exporter("0", bom)
+        r = e.export_as_table_by_template2("template_simple")
+    finally:
+        export_sort_chunk_rows = old_chunk_rows
+
+    lines = [line.split("\t") for line in r.splitlines()[1:]]
+    assert([x[2] for x in lines] == ["0", "A", "B", "C", "C"])
+    # the seq is assigned before the sort, and the sort is stable
+    assert([x[0] for x in lines] == ["0", "1", "3", "2", "4"])
+
+def test_export_deep_bom():
+    cfg._cfg = {
+        "BOMBROWSER": {
+            "templates_list": "template_simple"
+        },
+        "template_simple" :  {
+            "name": "template simple",
+            "columns": """
+                level:Level
+                code:Code
+                parent:Parent
+            """
+        },
+    }
+
+    # deeper than the python recursion limit
+    depth = sys.getrecursionlimit() + 100
+    bom = dict()
+    for i in range(depth):
+        bom[str(i)] = { "code": str(i), "descr": "%d-descr"%(i),
+            "ver": "0", "deps": dict() }
+        if i > 0:
+            bom[str(i-1)]["deps"][str(i)] = { "code": str(i), "qty": 1,
+                "each": 1, "unit": "NR", "ref": "" }
+
+    e = Exporter("0", bom)
+    r = e.export_as_table_by_template2("template_simple")
+
+    lines = [line.split("\t") for line in r.splitlines()[1:]]
+    assert(len(lines) == depth)
+    assert(lines[-1] == [str(depth - 1), str(depth - 1), str(depth - 2)])
+
 
 if __name__ == "__main__":
     last = 1
@@ -27,6 +27,9 @@ import cfg
 import traceback
 import threading
 import time
+import sqlite3
+import copy
+import pickle
 
 _use_db="sqlitememory"
 
@@ -434,6 +437,269 @@ def test_get_bom():
     assert(find_in_bom("H"))
     assert(find_in_bom("O"))
 
+def test_get_bom_nodes():
+    d = _init_db()
+
+    with Transaction(d) as c:
+        _test_insert_assembly(c)
+        c.execute("""
+            INSERT INTO item_properties (revision_id, descr, value)
+            SELECT id, 'prop1', descr
+            FROM item_revisions
+        """)
+
+    id_ = d.get_codes_by_code("O")[0][0]
+
+    for dt in ["2020-01-10", "2020-01-15", "2020-01-20", "2020-01-25"]:
+        (root, bom) = d.get_bom_by_code_id3(id_, db.iso_to_days(dt))
+        assert(root == id_)
+
+        for k, v in bom.items():
+            data = d.get_code_by_rid(v["rid"])
+            props = data.pop("properties")
+            assert(props["prop1"] == data["descr"])
+            assert(v["prop1"] == data["descr"])
+            for k2 in data:
+                assert(v[k2] == data[k2])
+            assert(k == data["id"])
+
+            children = d.get_children_by_rid(v["rid"])
+            assert(len(children) == len(v["deps"]))
+            for child in children:
+                assert(child[0] in v["deps"])
+                assert(child[0] in bom)
+                assert(v["deps"][child[0]]["qty"] == child[3])
+                assert(v["deps"][child[0]]["ref"] == child[6])
+
+def test_call_many():
+    d = _init_db()
+
+    with Transaction(d) as c:
+        _test_insert_assembly(c)
+
+    codes = "ABCO"
+    calls = [("get_codes_by_code", (code,), {}) for code in codes]
+    calls.append(("get_codes_by_code", (), {"code": "Z"}))
+    ret = d.call_many(calls)
+
+    assert(len(ret) == len(calls))
+    for code, r in zip(codes, ret):
+        assert(r == d.get_codes_by_code(code))
+    assert(ret[-1] is None)
+
+def test_get_bom_data_as_dict():
+    d = _init_db()
+
+    with Transaction(d) as c:
+        _test_insert_assembly(c)
+
+    id_o = d.get_codes_by_code("O")[0][0]
+    dt = db.iso_to_days("2020-01-20")
+    (top, bom) = d.get_bom_by_code_id3(id_o, dt)
+    assert(isinstance(bom, db.BomData))
+    id_b = list(bom[id_o]["deps"].keys())[0]
+
+    # the same content of a dict of dicts
+    data = dict([(k, dict(v)) for (k, v) in bom.items()])
+    for v in data.values():
+        v["deps"] = dict([(k, dict(v2)) for (k, v2) in v["deps"].items()])
+    assert(bom == data)
+    assert(pickle.loads(pickle.dumps(bom)) == data)
+    node = data[id_o]
+    for k in ["code", "descr", "ver", "iter", "unit", "date_from",
+              "date_from_days", "date_to", "date_to_days", "id", "rid",
+              "gval1"]:
+        assert(k in node)
+    assert(id_b in node["deps"])
+    for k in ["code_id", "unit", "qty", "each", "iter", "ref", "gaval1"]:
+        assert(k in node["deps"][id_b])
+
+    # the changes are kept
+    bom2 = copy.deepcopy(bom)
+    bom[id_o]["doc"] = "doc"
+    bom[id_o]["deps"][id_b]["qty"] = 99
+    del bom[id_o]["deps"][id_b]
+    bom[id_b]["deps"] = dict()
+    bom["new"] = {"code": "new", "deps": {}}
+    assert(bom[id_o]["doc"] == "doc")
+    assert(not id_b in bom[id_o]["deps"])
+    assert(len(bom[id_b]["deps"]) == 0)
+    assert(bom["new"]["code"] == "new")
+    assert(len(bom) == len(data) + 1)
+    bom.pop(id_b)
+    assert(not id_b in bom)
+    assert(len(bom) == len(data))
+
+    # ... but not in the copy
+    assert(bom2 == data)
+
+    # more changes through the same deps view are kept
+    bom3 = copy.deepcopy(bom2)
+    deps = bom3[id_o]["deps"]
+    deps2 = bom3[id_o]["deps"]
+    ids = list(deps)
+    deps["x1"] = {"qty": 1}
+    deps["x2"] = {"qty": 2}
+    del deps[id_b]
+    expected = [k for k in ids if k != id_b] + ["x1", "x2"]
+    for v in [deps, deps2, bom3[id_o]["deps"]]:
+        assert(list(v) == expected)
+        assert(len(v) == len(expected))
+        assert("x1" in v and "x2" in v and not id_b in v)
+        assert(v["x2"]["qty"] == 2)
+
+    # qty and each are returned as the driver returns them
+    bom4 = db.BomData(0, 0)
+    col = {"qty": bom4._new_column("qty")}
+    for v in [1.5, 2, None]:
+        bom4._append(col, "qty", v)
+    assert(col["qty"] == [1.5, 2, None])
+    assert(type(col["qty"][1]) is int)
+
+def test_get_bom_cache():
+    d = _init_db()
+
+    with Transaction(d) as c:
+        _test_insert_assembly(c)
+
+    id_o = d.get_codes_by_code("O")[0][0]
+    id_g = d.get_codes_by_code("G")[0][0]
+    id_l = d.get_codes_by_code("L")[0][0]
+    dt = db.iso_to_days("2020-01-20")
+
+    stats0 = d.get_bom_cache_stats()
+    (_, bom1) = d.get_bom_by_code_id3(id_o, dt)
+    d.get_bom_by_code_id3(id_g, dt)
+    stats1 = d.get_bom_cache_stats()
+    assert(stats1["misses"] == stats0["misses"] + 2)
+
+    # a cached bom is returned as copy: the caller may change it
+    bom1[id_o]["code"] = "XXX"
+    (_, bom2) = d.get_bom_by_code_id3(id_o, dt)
+    stats2 = d.get_bom_cache_stats()
+    assert(stats2["hits"] == stats1["hits"] + 1)
+    assert(bom2[id_o]["code"] == "O")
+
+    # L is a child of C, which is a child of B and A: the bom of O has to
+    # be reloaded, the one of G doesn't
+    rid = d.get_code(id_l, dt)["rid"]
+    gvals = ["new gval %d"%(i) for i in range(db.gvals_count)]
+    d.update_by_rid2(rid, "new descr", "new ver", "new-unit", gvals)
+
+    (_, bom3) = d.get_bom_by_code_id3(id_o, dt)
+    assert(bom3[id_l]["descr"] == "new descr")
+    d.get_bom_by_code_id3(id_g, dt)
+    stats3 = d.get_bom_cache_stats()
+    assert(stats3["misses"] == stats2["misses"] + 1)
+    assert(stats3["hits"] == stats2["hits"] + 1)
+
+    d.invalidate_bom_cache(id_g)
+    d.get_bom_by_code_id3(id_g, dt)
+    assert(d.get_bom_cache_stats()["misses"] == stats3["misses"] + 1)
+
+def test_get_bom_cache_during_transaction():
+    d = _init_db()
+
+    with Transaction(d) as c:
+        _test_insert_assembly(c)
+
+    id_o = d.get_codes_by_code("O")[0][0]
+    id_l = d.get_codes_by_code("L")[0][0]
+    dt = db.iso_to_days("2020-01-20")
+    (top, bom) = d.get_bom_by_code_id3(id_o, dt)
+    d.invalidate_bom_cache(id_o)
+    assert(d.get_bom_cache_stats()["entries"] == 0)
+
+    # a change bumps the generation even if the cache is empty
+    generation = d._bom_cache.get_generation()
+    rid = d.get_code(id_l, dt)["rid"]
+    gvals = ["new gval %d"%(i) for i in range(db.gvals_count)]
+    d.update_by_rid2(rid, "new descr", "new ver", "new-unit", gvals)
+    d._bom_cache.put((id_o, dt), top, bom, generation)
+    assert(d.get_bom_cache_stats()["entries"] == 0)
+
+    # a bom stored before the commit is dropped at the end of the
+    # transaction
+    for empty in [True, False]:
+        if not empty:
+            d.get_bom_by_code_id3(id_o, dt + 1)
+        with Transaction(d) as c:
+            d._bom_cache_invalidate(c, id_l)
+            generation = d._bom_cache.get_generation()
+            d._bom_cache.put((id_o, dt), top, bom, generation)
+            assert(not d._bom_cache.get((id_o, dt)) is None)
+        assert(d._bom_cache.get((id_o, dt)) is None)
+
+def test_get_bom_cache_other_process():
+    # two instances on the same file act as two processes
+    fn = tempfile.NamedTemporaryFile(delete=False).name
+    d1 = db.DBSQLite(fn, False)
+    d1.create_db()
+    with Transaction(d1) as c:
+        _test_insert_assembly(c)
+    d2 = db.DBSQLite(fn, False)
+
+    try:
+        id_o = d1.get_codes_by_code("O")[0][0]
+        id_l = d1.get_codes_by_code("L")[0][0]
+        dt = db.iso_to_days("2020-01-20")
+        d1.get_bom_by_code_id3(id_o, dt)
+        d1.get_bom_by_code_id3(id_o, dt)
+        stats = d1.get_bom_cache_stats()
+        assert(stats["hits"] == 1)
+
+        # a change done by d2 is seen by d1 at the next call
+        rid = d2.get_code(id_l, dt)["rid"]
+        gvals = ["new gval %d"%(i) for i in range(db.gvals_count)]
+        d2.update_by_rid2(rid, "new descr", "new ver", "new-unit", gvals)
+        (_, bom) = d1.get_bom_by_code_id3(id_o, dt)
+        assert(bom[id_l]["descr"] == "new descr")
+        assert(d1.get_bom_cache_stats()["misses"] == stats["misses"] + 1)
+
+        # ... but a change done by d1 doesn't drop its other boms
+        id_g = d1.get_codes_by_code("G")[0][0]
+        d1.get_bom_by_code_id3(id_g, dt)
+        d1.update_by_rid2(rid, "new descr2", "new ver", "new-unit", gvals)
+        stats = d1.get_bom_cache_stats()
+        d1.get_bom_by_code_id3(id_g, dt)
+        assert(d1.get_bom_cache_stats()["hits"] == stats["hits"] + 1)
+    finally:
+        d1._close_conn()
+        d2._close_conn()
+        os.unlink(fn)
+
+def test_get_bom_progress():
+    d = _init_db()
+
+    with Transaction(d) as c:
+        _test_insert_assembly(c)
+
+    id_o = d.get_codes_by_code("O")[0][0]
+    dt = db.iso_to_days("2020-01-20")
+
+    steps = []
+    (_, bom) = d.get_bom_by_code_id3(id_o, dt,
+        progress=lambda nodes, depth: steps.append((nodes, depth)))
+    assert(len(steps) > 1)
+    assert([x[1] for x in steps] == list(range(1, len(steps) + 1)))
+    assert(steps[-1][0] == len(bom))
+
+    # an exception raised by progress() stops the explosion of the bom,
+    # and nothing is cached
+    id_g = d.get_codes_by_code("G")[0][0]
+
+    def cancel(nodes, depth):
+        raise KeyboardInterrupt()
+
+    stats0 = d.get_bom_cache_stats()
+    try:
+        d.get_bom_by_code_id3(id_g, dt, progress=cancel)
+        assert(False)
+    except KeyboardInterrupt:
+        pass
+    stats1 = d.get_bom_cache_stats()
+    assert(stats1["entries"] == stats0["entries"])
+
 def test_get_bom_dates_by_code_id():
     d = _init_db()
 
@@ -465,6 +731,30 @@ def test_get_bom_dates_by_code_id():
     assert("2020-01-10" in [db.days_to_iso(x) for x in dates])
     assert(not "2020-01-25" in [db.days_to_iso(x) for x in dates])
 
+def test_get_bom_dates_by_code_id_recursive_and_batched():
+    d = _init_db()
+
+    with Transaction(d) as c:
+        _test_insert_assembly(c)
+
+    # the backends without recursive query use only the batched version
+    if not d._has_recursive_cte:
+        return
+
+    try:
+        for code in "ABCDEFGHILMO":
+            id_ = d.get_codes_by_code(code)[0][0]
+            d._has_recursive_cte = True
+            dates1 = d.get_bom_dates_by_code_id(id_)
+            d._has_recursive_cte = False
+            dates2 = d.get_bom_dates_by_code_id(id_)
+
+            assert(len(dates1) > 0)
+            assert(dates1 == dates2)
+            assert(dates1 == sorted(dates1, reverse=True))
+    finally:
+        del d._has_recursive_cte
+
 def test_get_children_by_rid():
     d = _init_db()
 
@@ -588,6 +878,32 @@ def test_valid_where_used():
     assert(find_in_bom("H"))
     assert(find_in_bom("O"))
 
+def test_where_used_recursive_and_batched():
+    d = _init_db()
+
+    with Transaction(d) as c:
+        _test_insert_assembly(c)
+
+    # the backends without recursive query use only the batched version
+    if not d._has_recursive_cte:
+        return
+
+    codes = "ABCDEFGHILMO"
+    try:
+        for code in codes:
+            id_ = d.get_codes_by_code(code)[0][0]
+            for valid in [False, True]:
+                d._has_recursive_cte = True
+                r1 = d.get_where_used_from_id_code(id_, valid)
+                d._has_recursive_cte = False
+                r2 = d.get_where_used_from_id_code(id_, valid)
+
+                assert(r1 == r2)
+                for k in r1[1]:
+                    assert(list(r1[1][k]["deps"]) == list(r2[1][k]["deps"]))
+    finally:
+        del d._has_recursive_cte
+
 def _create_code_revision(c, code, nr=10):
 
     c.execute("""INSERT INTO items(code) VALUES (?)""",( code,))
@@ -1607,6 +1923,34 @@ def test_update_by_rid2_with_drawings():
     assert("dira/filea" in dwgs[0][1])
     assert("dirb/fileb" in dwgs[1][1])
 
+def test_get_drawings_by_rids():
+    d = _init_db()
+    with Transaction(d) as c:
+        code_id, dates = _create_code_revision(c, "TEST-CODE", 5)
+
+    rids = [x[4] for x in d.get_dates_by_code_id3(code_id)]
+    assert(len(rids) == 5)
+
+    for i, rid in enumerate(rids):
+        d.update_by_rid2(rid, "descr", "ver", "NR",
+            ["" for i in range(db.gvals_count)],
+            drawings = [("file%d-%d"%(i, j), "dir/file%d-%d"%(i, j))
+                            for j in range(i)])
+
+    old_in_clause_max_items = db.in_clause_max_items
+    try:
+        db.in_clause_max_items = 2
+        ret = d.get_drawings_by_rids(rids + [rids[0], -1])
+    finally:
+        db.in_clause_max_items = old_in_clause_max_items
+
+    assert(sorted(ret.keys()) == sorted(rids + [-1]))
+    assert(ret[-1] == [])
+    for rid in rids:
+        assert(ret[rid] == [tuple(x)
+            for x in d.get_drawings_and_urls_by_rid(rid)])
+    assert(sorted([len(x) for x in ret.values()]) == [0, 0, 1, 2, 3, 4])
+
 def _create_data_for_search_revisions(d):
     with Transaction(d) as c:
         code1 = "test-code-1"
@@ -1913,6 +2257,27 @@ def test_dump_db():
         if os.path.exists(tmpfilename):
             os.unlink(tmpfilename)
 
+def test_dump_table_fetchmany():
+    d = _init_db()
+    with Transaction(d) as c:
+        rids = _create_simple_assy_with_drawings(c)
+
+    with ROCursor(d) as c:
+        c.execute("SELECT COUNT(*) FROM items")
+        ci = c.fetchone()[0]
+
+    old_fetch_size = db.dump_fetch_size
+    try:
+        db.dump_fetch_size = 2
+        (colnames, rows) = d.dump_table("items")
+        assert([x.upper() for x in colnames] == ["ID", "CODE"])
+        assert(not isinstance(rows, list))
+        rows = list(rows)
+        assert(len(rows) == ci)
+        assert(len(set([row[0] for row in rows])) == ci)
+    finally:
+        db.dump_fetch_size = old_fetch_size
+
 def test_restore_db():
     d = _init_db()
     with Transaction(d) as c:
@@ -1955,6 +2320,181 @@ def test_restore_db():
         if os.path.exists(tmpfilename):
             os.unlink(tmpfilename)
 
+def test_restore_db_in_batches():
+    d = _init_db()
+    with Transaction(d) as c:
+        rids = _create_simple_assy_with_drawings(c)
+
+    with ROCursor(d) as c:
+        c.execute("SELECT COUNT(*) FROM items")
+        ci = c.fetchone()[0]
+        c.execute("SELECT COUNT(*) FROM assemblies")
+        ca = c.fetchone()[0]
+
+    # more than a batch, and the last one is not full
+    assert(ci > 2 and ci % 2 != 0)
+
+    old_batch_size = db.restore_batch_size
+    tmpfilename = tempfile.NamedTemporaryFile(delete=False).name+".zip"
+    try:
+        db.dump_tables(tmpfilename, d, quiet=True)
+        d.create_db()
+
+        db.restore_batch_size = 2
+        db.restore_tables(tmpfilename, d, quiet=True)
+        with ROCursor(d) as c:
+            c.execute("SELECT COUNT(*) FROM items")
+            assert(ci == c.fetchone()[0])
+            c.execute("SELECT COUNT(*) FROM assemblies")
+            assert(ca == c.fetchone()[0])
+            c.execute("SELECT code FROM items")
+            code = c.fetchone()[0]
+
+        # the indexes are created after the load
+        got_exception = False
+        try:
+            with Transaction(d) as c:
+                c.execute("INSERT INTO items (code) VALUES (?)", (code,))
+        except:
+            got_exception = True
+        assert(got_exception)
+
+    finally:
+        db.restore_batch_size = old_batch_size
+        if os.path.exists(tmpfilename):
+            os.unlink(tmpfilename)
+
+def _dump_main_tables(d):
+    ret = dict()
+    for tname in ["items", "item_revisions", "assemblies", "drawings"]:
+        (colnames, rows) = d.dump_table(tname)
+        ret[tname] = sorted([tuple(map(db.xescape, row)) for row in rows])
+    return ret
+
+def test_restore_incremental_backups():
+    d = _init_db()
+    with Transaction(d) as c:
+        rids = _create_simple_assy_with_drawings(c)
+
+    tmpfilenames = [tempfile.NamedTemporaryFile(delete=False).name+".zip"
+        for i in range(3)]
+    base, inc1, inc2 = tmpfilenames
+    try:
+        db.dump_tables(base, d, quiet=True, start_journal=True)
+
+        # insert
+        new_rid = d.copy_code("NEW-A", rids["A"], "New-A", 0,
+            new_date_from_days=db.iso_to_days("2021-01-01"))
+        db.dump_tables(inc1, d, quiet=True, base=base)
+
+        # update and delete
+        d.revise_code(rids["A"], "New-A", 0,
+            new_date_from_days=db.iso_to_days("2021-01-01"))
+        code_id = d.get_codes_by_code("NEW-A")[0][0]
+        assert(d.delete_code(code_id) == "")
+        db.dump_tables(inc2, d, quiet=True, base=inc1)
+
+        with zipfile.ZipFile(inc2) as z:
+            assert(len(z.read("items.deleted").split()) == 1)
+            lines = z.open("items.csv").readlines()
+            assert(len(lines) == 1) # only the header
+
+        expected = _dump_main_tables(d)
+
+        d.create_db()
+        got_exception = False
+        try:
+            db.restore_tables(base, d, quiet=True, increments=[inc2])
+        except db.DBException:
+            got_exception = True
+        assert(got_exception)
+
+        d.create_db()
+        db.restore_tables(base, d, quiet=True, increments=[inc1, inc2])
+        assert(_dump_main_tables(d) == expected)
+
+        # the restore restarts the journal
+        got_exception = False
+        try:
+            db.dump_tables(inc1, d, quiet=True, base=inc2)
+        except db.DBException:
+            got_exception = True
+        assert(got_exception)
+
+    finally:
+        for fn in tmpfilenames:
+            if os.path.exists(fn):
+                os.unlink(fn)
+
+def test_dump_tables_start_journal():
+    # a db in memory has to use a single connection: use a file
+    fn = tempfile.NamedTemporaryFile(delete=False).name
+    d = db.DBSQLite(fn, False)
+    d.create_db()
+    d.create_first_code()
+
+    base = tempfile.NamedTemporaryFile(delete=False).name+".zip"
+    inc = tempfile.NamedTemporaryFile(delete=False).name+".zip"
+    try:
+        # a backup doesn't start the journal, unless it is asked
+        db.dump_tables(base, d, quiet=True)
+        assert(d.get_backup_watermarks()["journal_id"] is None)
+        got_exception = False
+        try:
+            db.dump_tables(inc, d, quiet=True, base=base)
+        except db.DBException:
+            got_exception = True
+        assert(got_exception)
+
+        db.dump_tables(base, d, quiet=True, start_journal=True)
+        assert(not d.get_backup_watermarks()["journal_id"] is None)
+        db.dump_tables(inc, d, quiet=True, base=base)
+    finally:
+        d._close_conn()
+        for fn_ in [fn, base, inc]:
+            if os.path.exists(fn_):
+                os.unlink(fn_)
+
+def test_restore_tables_start_journal():
+    fn = tempfile.NamedTemporaryFile(delete=False).name
+    d = db.DBSQLite(fn, False)
+    d.create_db()
+    d.create_first_code()
+
+    plain = tempfile.NamedTemporaryFile(delete=False).name+".zip"
+    with_journal = tempfile.NamedTemporaryFile(delete=False).name+".zip"
+    try:
+        # a restore starts the journal only if asked, or if the backed up
+        # db had it
+        db.dump_tables(plain, d, quiet=True)
+        db.restore_tables(plain, d, quiet=True)
+        assert(d.get_backup_watermarks()["journal_id"] is None)
+        with ROCursor(d) as c:
+            assert(not d._has_change_journal(c))
+
+        db.restore_tables(plain, d, quiet=True, start_journal=True)
+        journal_id = d.get_backup_watermarks()["journal_id"]
+        assert(not journal_id is None)
+
+        db.dump_tables(with_journal, d, quiet=True)
+        d._close_conn()
+        os.unlink(fn)
+        d = db.DBSQLite(fn, False)
+        db.restore_tables(with_journal, d, quiet=True)
+        assert(not d.get_backup_watermarks()["journal_id"] in
+            [None, journal_id])
+
+        # the journal of the db restored is restarted
+        journal_id = d.get_backup_watermarks()["journal_id"]
+        db.restore_tables(plain, d, quiet=True)
+        assert(not d.get_backup_watermarks()["journal_id"] in
+            [None, journal_id])
+    finally:
+        d._close_conn()
+        for fn_ in [fn, plain, with_journal]:
+            if os.path.exists(fn_):
+                os.unlink(fn_)
+
 def test_new_db():
     d = _init_db()
     with Transaction(d) as c:
@@ -2536,6 +3076,233 @@ def test_context_manager_transaction_nested_transaction():
         raise Exception("Nested trasaction shold Except")
 
 
+def test_sql_translate_cache():
+    d = _init_db()
+
+    old_size = db.sql_translate_cache_size
+    try:
+        db.sql_translate_cache_size = 2
+        db._sql_translate_caches.pop(type(d), None)
+
+        queries = ["SELECT id FROM items WHERE id = %d"%(i) for i in range(5)]
+        for q in queries:
+            assert(d._sql_translate_cached(q) == d._sql_translate(q))
+            assert(d._sql_translate_cached(q) == d._sql_translate(q))
+            cache = db._sql_translate_caches[type(d)]
+            assert(q in cache)
+            assert(len(cache) <= 2)
+    finally:
+        db.sql_translate_cache_size = old_size
+
+def test_dump_restore_jobs():
+    # a db in memory has to use a single connection: use a file
+    fn = tempfile.NamedTemporaryFile(delete=False).name
+    d = db.DBSQLite(fn, False)
+    d.create_db()
+    with Transaction(d) as c:
+        rids = _create_simple_assy_with_drawings(c)
+    expected = _dump_main_tables(d)
+
+    tmpfilenames = [tempfile.NamedTemporaryFile(delete=False).name+".zip"
+        for i in range(2)]
+    try:
+        timings1 = db.dump_tables(tmpfilenames[0], d, quiet=True)
+        timings3 = db.dump_tables(tmpfilenames[1], d, quiet=True, jobs=3)
+        assert([x[:2] for x in timings1] == [x[:2] for x in timings3])
+        assert(dict([x[:2] for x in timings1])["drawings"] == 6)
+
+        z1 = zipfile.ZipFile(tmpfilenames[0])
+        z3 = zipfile.ZipFile(tmpfilenames[1])
+        for tname in d.list_main_tables():
+            assert(z1.read(tname + ".csv") == z3.read(tname + ".csv"))
+
+        # sqlite doesn't allow concurrent writers, but they wait
+        d.create_db()
+        d._parallel_load = True
+        timings = db.restore_tables(tmpfilenames[1], d, quiet=True, jobs=3)
+        assert([x[:2] for x in timings] == [x[:2] for x in timings1])
+        assert(_dump_main_tables(d) == expected)
+
+    finally:
+        d._close_conn()
+        for fn_ in tmpfilenames + [fn]:
+            if os.path.exists(fn_):
+                os.unlink(fn_)
+
+def test_connection_pool():
+    # a db in memory has to use a single connection: use a file
+    fn = tempfile.NamedTemporaryFile(delete=False).name
+    d = db.DBSQLite(fn, False)
+    d.create_db()
+
+    old_values = (db.connection_pool_max_size, db.connection_pool_timeout,
+                  db.connection_check_interval)
+    conns = []
+    errors = []
+    ev = threading.Event()
+    def reader():
+        try:
+            with ROCursor(d) as c:
+                c.execute("SELECT COUNT(*) FROM items")
+                c.fetchone()
+                conns.append(d._conn)
+                ev.wait()
+        except db.DBException as e:
+            errors.append(str(e))
+
+    try:
+        db.connection_pool_max_size = 2
+        db.connection_pool_timeout = 0.2
+
+        # each ROCursor holds its connection, up to the max size
+        threads = [threading.Thread(target=reader) for i in range(3)]
+        for t in threads:
+            t.start()
+        time.sleep(0.5)
+        assert(len(conns) == 2)
+        assert(conns[0] != conns[1])
+        assert(len(errors) == 1)
+        assert("ECONNECTIONPOOLFULL" in errors[0])
+
+        # at the end of the ROCursor the connections are reused
+        ev.set()
+        for t in threads:
+            t.join()
+        t = threading.Thread(target=reader)
+        t.start()
+        t.join()
+        assert(len(conns) == 3)
+        assert(conns[2] in conns[:2])
+        assert(d._pool_count == 2)
+        assert(d._conn is None)
+
+        # a broken connection is replaced
+        db.connection_check_interval = -1
+        for conn, last_used in d._pool_idle:
+            conn.close()
+        with ROCursor(d) as c:
+            c.execute("SELECT COUNT(*) FROM items")
+            assert(c.fetchone()[0] == 0)
+            assert(not d._conn in conns)
+        assert(d._pool_count == 1)
+    finally:
+        (db.connection_pool_max_size, db.connection_pool_timeout,
+            db.connection_check_interval) = old_values
+        os.unlink(fn)
+
+def test_connection_pool_full_transaction():
+    fn = tempfile.NamedTemporaryFile(delete=False).name
+    d = db.DBSQLite(fn, False)
+    d.create_db()
+
+    old_values = (db.connection_pool_max_size, db.connection_pool_timeout)
+    errors = []
+    ev = threading.Event()
+    started = threading.Event()
+    def holder():
+        with ROCursor(d) as c:
+            c.execute("SELECT COUNT(*) FROM items")
+            c.fetchone()
+            started.set()
+            ev.wait()
+
+    def writer():
+        for i in range(2):
+            try:
+                with Transaction(d) as c:
+                    c.execute("SELECT COUNT(*) FROM items")
+            except db.DBException as e:
+                errors.append(str(e))
+            ev.set()
+
+    try:
+        db.connection_pool_max_size = 1
+        db.connection_pool_timeout = 0.2
+
+        # the first Transaction fails because the pool is full; after the
+        # connection is released, the next one on the same thread works
+        t = threading.Thread(target=holder)
+        t.start()
+        started.wait()
+        t2 = threading.Thread(target=writer)
+        t2.start()
+        t2.join()
+        t.join()
+        assert(len(errors) == 1)
+        assert("ECONNECTIONPOOLFULL" in errors[0])
+        assert(d._pool_count == 1)
+        assert(len(d._pool_idle) == 1)
+    finally:
+        (db.connection_pool_max_size, db.connection_pool_timeout) = old_values
+        os.unlink(fn)
+
+def test_connection_pool_check_unlocked():
+    fn = tempfile.NamedTemporaryFile(delete=False).name
+    d = db.DBSQLite(fn, False)
+    d.create_db()
+
+    old_values = (db.connection_pool_max_size, db.connection_pool_timeout,
+                  db.connection_check_interval)
+    ev = threading.Event()
+    check_conn = d._check_conn
+    def slow_check_conn(conn):
+        ev.wait(5)
+        return check_conn(conn)
+
+    def reader():
+        with ROCursor(d) as c:
+            c.execute("SELECT COUNT(*) FROM items")
+            c.fetchone()
+
+    try:
+        db.connection_pool_max_size = 2
+        db.connection_pool_timeout = 5
+        db.connection_check_interval = -1
+        t = threading.Thread(target=reader)
+        t.start()
+        t.join()
+        assert(len(d._pool_idle) == 1)
+
+        # while a thread checks the idle connection, the others can still
+        # get a new one
+        d._check_conn = slow_check_conn
+        t = threading.Thread(target=reader)
+        t.start()
+        time.sleep(0.2)
+        time0 = time.time()
+        with ROCursor(d) as c:
+            c.execute("SELECT COUNT(*) FROM items")
+            c.fetchone()
+        assert(time.time() - time0 < 1)
+        ev.set()
+        t.join()
+        assert(d._pool_count == 2)
+    finally:
+        ev.set()
+        (db.connection_pool_max_size, db.connection_pool_timeout,
+            db.connection_check_interval) = old_values
+        os.unlink(fn)
+
+def test_get_cursor_retry_once():
+    fn = tempfile.NamedTemporaryFile(delete=False).name
+    d = db.DBSQLite(fn, False)
+    calls = []
+    def new_cursor(server_side):
+        calls.append(server_side)
+        raise sqlite3.OperationalError("broken")
+    d._new_cursor = new_cursor
+
+    # the error is retried once with a new connection, then raised
+    try:
+        d._get_cursor()
+        assert(False)
+    except sqlite3.OperationalError:
+        pass
+    finally:
+        d._close_conn()
+        os.unlink(fn)
+    assert(len(calls) == 2)
+
 def test_restore_db_with_different_endline():
     d = _init_db()
     with Transaction(d) as c:
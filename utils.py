@@ -252,6 +252,231 @@ def bb_match(s, exp, conv2=None, case_sensitive=True):
 
     return False
 
+class BomColors:
+    """
+        The 'bomcolors' rules (see cfg.get_bomcolors()) compiled once.
+
+        Each rule is a list of filters and a list of actions; the filters
+        are in the form 'key=value' or 'key=!value' and they are checked
+        against the code and its link to the parent. The filters in the
+        form '*key=...' match if any code of the path matches.
+
+        match() evaluates a code and returns a state which is passed to the
+        children; so the '*' filters are inherited instead of re-scanning
+        the path. The results are cached by (code, parent): the bom must
+        not change during the lifetime of the object.
+    """
+
+    def __init__(self, rules):
+        self._terms = []
+        self._rules = []
+        self._inherited = 0
+        self._masks = dict()
+        self._actions = dict()
+
+        terms = dict()
+        for (filters, actions) in rules:
+            mask = 0
+            for f in filters:
+                k, v = f.split("=")[:2]
+                inherited = k.startswith("*")
+                if inherited:
+                    k = k[1:]
+                if not (k, v, inherited) in terms:
+                    bit = 1 << len(self._terms)
+                    terms[(k, v, inherited)] = bit
+                    self._terms.append((bit, k, v, v.startswith("!"), v[1:]))
+                    if inherited:
+                        self._inherited |= bit
+                mask |= terms[(k, v, inherited)]
+            self._rules.append((mask, tuple(actions)))
+
+    def _match_values(self, values):
+        mask = 0
+        for (bit, k, v, neg, v1) in self._terms:
+            if not k in values:
+                continue
+            s = str(values[k])
+            if (neg and s != v1) or s == v:
+                mask |= bit
+        return mask
+
+    def match(self, state, key, node, parent_key=None, edge=None):
+        """
+            Return (state, actions) for the code 'key'; 'node' is its data,
+            'edge' the link from the parent (None for the top), 'state' the
+            one returned for the parent (0 for the top).
+        """
+        mask = self._masks.get((key, parent_key))
+        if mask is None:
+            mask = self._match_values(node)
+            if not edge is None:
+                mask |= self._match_values(edge)
+            self._masks[(key, parent_key)] = mask
+
+        mask |= state
+        actions = self._actions.get(mask)
+        if actions is None:
+            actions = tuple(action for (m, l) in self._rules
+                                if (mask & m) == m for action in l)
+            self._actions[mask] = actions
+
+        return (mask & self._inherited, actions)
+
+def _bom_colors_by_path(rules, data, path):
+    # the rules are checked against all the path at each call; kept as
+    # reference for BomColors
+    def match(k, v):
+        if k.startswith("*"):
+            k = k[1:]
+            l = range(len(path))
+        else:
+            l = [len(path) - 1]
+
+        for idx in l:
+            i = path[idx]
+            tmp = data[i]
+            if k in tmp:
+                if v.startswith("!") and str(tmp[k]) != v[1:]:
+                    return True
+                if str(tmp[k]) == v:
+                    return True
+
+            if idx == 0:
+                continue
+
+            j = path[idx-1]
+            tmp2 = data[j]["deps"][i]
+            if k in tmp2:
+                if v.startswith("!") and str(tmp2[k]) != v[1:]:
+                    return True
+                if str(tmp2[k]) == v:
+                    return True
+
+        return False
+
+    ret = []
+    for (filters, actions) in rules:
+        for f in filters:
+            k,v = f.split("=")[:2]
+            if not match(k, v):
+                break
+        else:
+            ret += actions
+
+    return tuple(ret)
+
+def bom_components(root, data):
+    """
+        Return the strongly connected components of the bom as lists of
+        codes; a component is returned after all the ones reachable from
+        it (the children first). A component with more than one code (or
+        a code child of itself) is a loop.
+
+        It is the Tarjan algorithm without recursion: each code and each
+        link is visited only once.
+    """
+    index = {root: 0}
+    low = {root: 0}
+    stack = [root]
+    onstack = set([root])
+    todo = [(root, iter(data[root]["deps"]))]
+    ret = []
+
+    while len(todo):
+        n, it = todo[-1]
+        for c in it:
+            if not c in index:
+                index[c] = low[c] = len(index)
+                stack.append(c)
+                onstack.add(c)
+                todo.append((c, iter(data[c]["deps"])))
+                break
+            if c in onstack:
+                low[n] = min(low[n], index[c])
+        else:
+            todo.pop()
+            if len(todo):
+                p = todo[-1][0]
+                low[p] = min(low[p], low[n])
+            if low[n] == index[n]:
+                comp = []
+                while True:
+                    k = stack.pop()
+                    onstack.remove(k)
+                    comp.append(k)
+                    if k == n:
+                        break
+                ret.append(comp)
+
+    return ret
+
+def get_loop_codes(root, data):
+    """Return the set of the codes involved in a loop"""
+    ret = set()
+    for comp in bom_components(root, data):
+        if len(comp) > 1 or comp[0] in data[comp[0]]["deps"]:
+            ret.update(comp)
+    return ret
+
+def _shortest_loop(start, members, data):
+    # the shortest path from 'start' back to 'start' inside 'members'
+    prev = {start: None}
+    todo = [start]
+    while len(todo):
+        todo2 = []
+        for n in todo:
+            if start in data[n]["deps"]:
+                path = [start]
+                while not n is None:
+                    path.append(n)
+                    n = prev[n]
+                path.reverse()
+                return path
+            for c in data[n]["deps"]:
+                if c in members and not c in prev:
+                    prev[c] = n
+                    todo2.append(c)
+        todo = todo2
+    return None
+
+def find_loops(root, data):
+    """
+        Return the loops of the bom; each loop is the list of codes of a
+        path which starts and ends with the same code. For each group of
+        codes involved in loops, the shortest loops are returned until
+        every code of the group is in at least one of them; a code child
+        of itself is always reported.
+    """
+    ret = []
+    for comp in bom_components(root, data):
+        members = set(comp)
+        done = set()
+        # start from the first code reached in the group
+        for start in reversed(comp):
+            if start in data[start]["deps"]:
+                ret.append([start, start])
+                done.add(start)
+            if start in done or len(comp) == 1:
+                continue
+            path = _shortest_loop(start, members, data)
+            ret.append(path)
+            done.update(path)
+
+    return ret
+
+def _bom_paths(top, data):
+    # all the paths of the bom, skipping the loops
+    ret = []
+    todo = [[top]]
+    while len(todo):
+        path = todo.pop()
+        ret.append(path)
+        for c in reversed(list(data[path[-1]]["deps"])):
+            if not c in path:
+                todo.append(path + [c])
+    return ret
+
 def find_filename(filename):
     if os.path.dirname(filename) != '':
         return filename
@@ -330,10 +555,10 @@ def open_file_or_url(url):
 
 def add_drawings_to_bom(bom):
     d = db.get_db_instance()
-    for k, v in bom.items():
-        rid = v["rid"]
+    ret = d.get_drawings_by_rids([v["rid"] for v in bom.values()])
+    for v in bom.values():
         drawings_and_urls = []
-        for descr, url in d.get_drawings_and_urls_by_rid(rid):
+        for descr, url in ret[v["rid"]]:
             if is_url(url):
                 drawings_and_urls.append(url)
             else:
@@ -656,6 +881,119 @@ def test_callable_with_args_6():
     
     assert(c(2, n4=77) == (2 - 3 + 8 / 77))
 
+def _test_bom_colors_data():
+    def node(code, gval1, deps):
+        return {"code": code, "gval1": gval1, "unit": "NR",
+                "deps": dict([(k, {"code_id": k, "gaval1": v, "unit": "NR"})
+                                for (k, v) in deps])}
+    return {
+        1: node("TOP", "A", [(2, "X"), (3, "Y")]),
+        2: node("SUB-1", "B", [(4, "Y"), (5, "")]),
+        3: node("SUB-2", "A", [(4, "X"), (2, "Z")]),
+        4: node("LEAF-1", "C", []),
+        5: node("LEAF-2", "", []),
+    }
+
+def test_bom_colors():
+    data = _test_bom_colors_data()
+    rules = [
+        (["gval1=A"], ["fg=red"]),
+        (["gaval1=X"], ["bold"]),
+        (["*gaval1=Y", "gval1=C"], ["bg=gray"]),
+        (["*code=SUB-2"], ["italic"]),
+        (["gval1=!C", "*gaval1=Z"], ["fg=blue"]),
+        ([], ["fg=black"]),
+    ]
+    colors = BomColors(rules)
+
+    def match(path, state):
+        if len(path) == 1:
+            return colors.match(state, path[0], data[path[0]])
+        return colors.match(state, path[-1], data[path[-1]], path[-2],
+                            data[path[-2]]["deps"][path[-1]])
+
+    def check(path, state):
+        state, actions = match(path, state)
+        assert(actions == _bom_colors_by_path(rules, data, path))
+        for c in data[path[-1]]["deps"]:
+            check(path + [c], state)
+
+    check([1], 0)
+
+    # the cached results are the same
+    check([1], 0)
+
+    assert(match([1], 0)[1] == ("fg=red", "fg=black"))
+    state, actions = match([1, 3], 0)
+    assert(actions == ("fg=red", "italic", "fg=black"))
+    state, actions = match([1, 3, 2], state)
+    assert(actions == ("italic", "fg=blue", "fg=black"))
+    state, actions = match([1, 3, 2, 4], state)
+    assert(actions == ("bg=gray", "italic", "fg=black"))
+
+def test_bom_paths():
+    data = _test_bom_colors_data()
+    paths = _bom_paths(1, data)
+    assert(paths == [[1], [1, 2], [1, 2, 4], [1, 2, 5], [1, 3], [1, 3, 4],
+                        [1, 3, 2], [1, 3, 2, 4], [1, 3, 2, 5]])
+
+    data[4]["deps"][1] = {"code_id": 1}
+    assert(_bom_paths(1, data) == paths)
+
+def _test_loops_data(edges):
+    data = dict()
+    for (p, c) in edges:
+        for k in [p, c]:
+            if not k in data:
+                data[k] = {"code": k, "deps": dict()}
+        data[p]["deps"][c] = {"code_id": c}
+    return data
+
+def test_bom_components():
+    data = _test_loops_data([("A", "B"), ("B", "C"), ("C", "B"),
+                             ("A", "D"), ("D", "E"), ("E", "D"), ("D", "B")])
+    comps = bom_components("A", data)
+    assert(sorted(sorted(x) for x in comps) ==
+        [["A"], ["B", "C"], ["D", "E"]])
+    # the children first
+    assert(comps[-1] == ["A"])
+    pos = dict((k, i) for (i, comp) in enumerate(comps) for k in comp)
+    assert(pos["B"] < pos["D"] < pos["A"])
+
+def test_find_loops():
+    data = _test_loops_data([("A", "B"), ("B", "C"), ("C", "D")])
+    assert(find_loops("A", data) == [])
+
+    data = _test_loops_data([("A", "B"), ("B", "C"), ("C", "D"),
+                             ("D", "B"), ("C", "C")])
+    assert(find_loops("A", data) == [["B", "C", "D", "B"], ["C", "C"]])
+
+    # two loops which share a code: each code is reported
+    data = _test_loops_data([("A", "B"), ("B", "C"), ("C", "B"),
+                             ("B", "D"), ("D", "B")])
+    assert(find_loops("A", data) == [["B", "C", "B"], ["D", "B", "D"]])
+
+    data = _test_loops_data([("A", "A")])
+    assert(find_loops("A", data) == [["A", "A"]])
+
+    # the loop B-C is reached by several paths, but it is reported once
+    data = _test_loops_data([("A", "X%d"%(i)) for i in range(10)] +
+                            [("X%d"%(i), "B") for i in range(10)] +
+                            [("B", "C"), ("C", "B")])
+    loops = find_loops("A", data)
+    assert(len(loops) == 1)
+    assert(sorted(loops[0][:-1]) == ["B", "C"])
+    assert(loops[0][0] == loops[0][-1])
+    assert(get_loop_codes("A", data) == set(["B", "C"]))
+
+def test_find_loops_deep():
+    # no recursion limit
+    n = sys.getrecursionlimit() * 2
+    data = _test_loops_data([(i, i + 1) for i in range(n)] + [(n, n // 2)])
+    loops = find_loops(0, data)
+    assert(len(loops) == 1)
+    assert(len(loops[0]) == n - n // 2 + 2)
+
 if __name__ == "__main__":
     last = 1
     import test_db, sys